@@ -1,57 +1,46 @@
 # === IMPORT UNICI E CORRETTI ===
-import os, csv, smtplib, sqlite3, calendar, base64, json, hmac, hashlib, secrets
+import os, csv, sqlite3, calendar, base64, json, hmac, hashlib, secrets
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from urllib.parse import quote_plus
 from email.mime.text import MIMEText
 from collections import deque
 from types import SimpleNamespace
-from time import time
+from time import time, perf_counter
 from functools import wraps
-import qrcode
+from multiprocessing import parent_process
 from io import BytesIO
 
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import cm
-
 def genera_qr_sepa(iban, nome_ente, importo, causale, bic=None):
-    euro = f"EUR{float(importo):.2f}"
-    descrizione = (causale or "")[:140]  # massimo 140 caratteri
-    bic_clean = (bic or "").replace(" ", "")[:11]
-
-    qr_lines = [
-        "BCD",           # Versione
-        "001",           # Codifica
-        "1",             # Identificativo
-        "SCT",           # Tipo bonifico SEPA
-        bic_clean,
-        nome_ente[:70],         # Nome beneficiario
-        iban.replace(" ", ""),  # IBAN senza spazi
-        euro,
-        "",                # Purpose code opzionale
-        descrizione
-    ]
-
-    qr_data = "\n".join(qr_lines)
-
-    img = qrcode.make(qr_data)
-    buffered = BytesIO()
-    img.save(buffered, format="PNG")
-
-    qr_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-    return f"data:image/png;base64,{qr_base64}"
+    """QR SEPA come data URI PNG (payload EPC canonico + cache condivisa qr_cache)."""
+    return qr_cache.data_uri(build_epc_payload(iban, nome_ente, importo, causale, bic or ""))
 
 
 
 # Se usi matplotlib altrove, tieni questa riga PRIMA di qualunque "import matplotlib"
 os.environ.setdefault("MPLBACKEND", "Agg")
 
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for, send_file
+from flask import Flask, render_template, jsonify, request, session, redirect, url_for, send_file, g, has_app_context
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_wtf.csrf import generate_csrf, validate_csrf
 
-from utils.crypto import encrypt_data
+from utils.crypto import encrypt_data, decrypt_data
+from utils.db_pool import get_pool
+from utils.ledger import load_ledger, year_bounds, month_bounds
+from utils.riepilogo import ensure_riepilogo
+from utils.license_cache import LicenseCache
+from utils.outbox import OutboxWorker, ensure_outbox, enqueue, outbox_status
+from utils.scheduler import Scheduler, ensure_scheduler
+from utils.qr import QRCache, QRPoolBroken, build_epc_payload, render_many
+from utils.csv_stream import iter_csv, iter_rows
+from utils.pdf_render import PdfRenderer, PdfQueueFull
+from utils.export_cache import ExportCache, ensure_data_versions, data_version
+from utils.charts import SPESE_LABELS, spese_series
+from utils.backup import BackupManager
+from utils.incremental_backup import IncrementalArchive
+from utils.migrations import MigrationRegistry
+from utils.metrics import RequestMetrics
+from utils.sql_trace import SqlTracer
 
 OPEN_PATHS = ("/login", "/logout", "/register", "/attiva", "/privacy", "/condizioni", "/heartbeat", "/static/")
 
@@ -84,6 +73,25 @@ MONTH_SLUG_TO_NUM = MONTH_MAP
 def mese_nome(mese_num):
     return MONTH_NUM_TO_SLUG.get(mese_num, "sconosciuto")
 
+def _normalize_mese(m: str):
+    m = (m or "").strip().lower()
+    mesi = ["gennaio","febbraio","marzo","aprile","maggio","giugno",
+            "luglio","agosto","settembre","ottobre","novembre","dicembre"]
+    aliases = {
+        "gen":"gennaio","feb":"febbraio","mar":"marzo","apr":"aprile","mag":"maggio","giu":"giugno",
+        "lug":"luglio","ago":"agosto","set":"settembre","sett":"settembre","sep":"settembre",
+        "ott":"ottobre","nov":"novembre","dic":"dicembre"
+    }
+    if m.isdigit():
+        i = int(m)
+        if 1 <= i <= 12:
+            return mesi[i-1], i
+    if m in aliases:
+        m = aliases[m]
+    if m in mesi:
+        return m, mesi.index(m)+1
+    return m, None
+
 def _normalize_amount(value) -> float:
     if value is None:
         return 0.0
@@ -167,6 +175,29 @@ else:
 # Alias legacy per compatibilità con codice esistente (non toccare altre funzioni)
 DB_PATH = app.config['DB_PATH']
 
+# Connessioni inattive tenute aperte nel pool (vedi get_db)
+app.config["DB_POOL_SIZE"] = int(os.getenv("DB_POOL_SIZE", "8"))
+# Export CSV in streaming: righe lette dal cursore e inviate per blocco
+app.config["CSV_STREAM_CHUNK"] = int(os.getenv("CSV_STREAM_CHUNK", "1000"))
+
+# Stato licenza per utente: cache in memoria (secondi, 0 = disattiva)
+app.config["LICENSE_CACHE_TTL"] = float(os.getenv("LICENSE_CACHE_TTL", "60"))
+license_cache = LicenseCache(app.config["LICENSE_CACHE_TTL"])
+
+# PNG dei QR SEPA: LRU in memoria (byte) + livello su disco facoltativo
+app.config["QR_CACHE_BYTES"] = int(os.getenv("QR_CACHE_BYTES", str(8 * 1024 * 1024)))
+app.config["QR_CACHE_DIR"] = os.getenv("QR_CACHE_DIR", "")
+qr_cache = QRCache(app.config["QR_CACHE_BYTES"], app.config["QR_CACHE_DIR"] or None)
+# QR in blocco (stipendi del mese): processi di codifica e tempo massimo per richiesta
+app.config["QR_POOL_WORKERS"] = int(os.getenv("QR_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+app.config["QR_BATCH_TIMEOUT"] = float(os.getenv("QR_BATCH_TIMEOUT", "60"))
+
+# Export PDF: layout reportlab/FPDF in un process pool (0 worker = nel thread della richiesta)
+app.config["PDF_WORKERS"] = int(os.getenv("PDF_WORKERS", str(min(4, os.cpu_count() or 1))))
+app.config["PDF_MAX_PENDING"] = int(os.getenv("PDF_MAX_PENDING", "16"))
+app.config["PDF_TIMEOUT"] = float(os.getenv("PDF_TIMEOUT", "60"))
+pdf_renderer = PdfRenderer(app.config["PDF_WORKERS"], app.config["PDF_MAX_PENDING"], app.config["PDF_TIMEOUT"])
+
 # Crea la directory del DB se non esiste (PASSO 4 OBBLIGATORIO)
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
@@ -244,6 +275,39 @@ def require_csrf(f):
         return f(*a, **kw)
     return wrapper
 
+# === METRICHE PER ENDPOINT ===
+# Durata, tempo DB, numero di statement SQL e dimensione della risposta per ogni
+# richiesta, in istogrammi in memoria (vedi /admin/metrics) + header Server-Timing.
+# Il tempo DB arriva dai contatori della connessione del pool (TimedCursor).
+app.config["METRICS"] = (os.getenv("METRICS", "1") or "1").strip() == "1"
+request_metrics = RequestMetrics()
+
+def _metrics_start():
+    g._t_start = perf_counter()
+
+def _metrics_record(resp):
+    # ogni accesso a request/g passa da un proxy: si risolvono una volta sola
+    ctx_g = g._get_current_object()
+    t0 = getattr(ctx_g, "_t_start", None)
+    if t0 is None:
+        return resp
+    wall = perf_counter() - t0
+    conn = getattr(ctx_g, "_db_conn", None)
+    db, statements = (conn.sql_time, conn.sql_count) if conn is not None else (0.0, 0)
+    req = request._get_current_object()
+    size = sum(map(len, resp.response)) if resp.is_sequence else None  # None: streaming/file
+    request_metrics.observe(req.endpoint or "<nessuna route>", req.method, resp.status_code,
+                            wall, db, statements, size)
+    # add() e non set(): set() scorre e riscrive tutti gli header (~1.5 µs in più)
+    resp.headers.add("Server-Timing", 'app;dur=%.1f, db;dur=%.1f;desc="%d SQL"'
+                     % (wall * 1000, db * 1000, statements))
+    return resp
+
+# con METRICS=0 gli hook non vengono nemmeno registrati
+if app.config["METRICS"]:
+    app.before_request(_metrics_start)
+    app.after_request(_metrics_record)
+
 # === SMTP CONFIG (personalizza o usa env) ===
 
 SMTP_HOST = (os.getenv("SMTP_HOST", "smtp.gmail.com") or "").strip()
@@ -272,7 +336,9 @@ def _ensure_admin_role():
 
 @app.before_request
 def _refresh_license_expiry_in_session():
-    """Aggiorna ad ogni richiesta la scadenza licenza in sessione leggendo dal DB."""
+    """Aggiorna ad ogni richiesta la scadenza licenza in sessione (via license_cache)."""
+    if request.endpoint == "static":
+        return
     uid = session.get("user_id")
     if not uid:
         # utente non loggato → evita mostrare dati stantii
@@ -371,7 +437,7 @@ def send_emails_personalized(items, from_name="RistoSmart FM"):
             subtype = "html" if ("<html" in (body or "").lower() or "<!doctype" in (body or "").lower()) else "plain"
             msg = MIMEText(body, subtype, "utf-8")
             msg["Subject"] = subject
-            msg["From"]    = f"{from_name} <{(SMTP_USER or '').strip()}>"
+            msg["From"]    = f"{it.get('from_name') or from_name} <{(SMTP_USER or '').strip()}>"
             msg["To"]      = to_email
 
             try:
@@ -384,7 +450,7 @@ def send_emails_personalized(items, from_name="RistoSmart FM"):
 
 # --- Wrapper semplice per compatibilità con vecchie chiamate ---
 def invia_email(to: str, oggetto: str, corpo: str):
-    """Invio best-effort di una singola email (HTML o testo).
+    """Invio best-effort di una singola email (HTML o testo), via outbox.
        Non solleva eccezioni: logga l'errore e continua.
     """
     try:
@@ -393,10 +459,64 @@ def invia_email(to: str, oggetto: str, corpo: str):
             "subject": oggetto or "",
             "body": corpo or ""
         }]
-        send_emails_personalized(items)
+        queue_emails(items, tag="invia_email")
     except Exception as e:
         print("[MAIL WARN]", e)
 
+# === INVIO PARALLELO (pool di sessioni SMTP) ===
+app.config["SMTP_SESSIONS"] = int(os.getenv("SMTP_SESSIONS", "4"))
+app.config["SMTP_MAX_PER_SESSION"] = int(os.getenv("SMTP_MAX_PER_SESSION", "100"))
+
+def _smtp_connect():
+    """Apre una sessione SMTP autenticata (STARTTLS su 587), come send_emails_personalized."""
+    import ssl, re, smtplib
+    host = re.sub(r"^\s*(?:smtp://|smtps://|https?://)", "", (SMTP_HOST or "").strip(), flags=re.I)
+    smtp = smtplib.SMTP(host, 587, timeout=20)
+    smtp.ehlo()
+    smtp.starttls(context=ssl.create_default_context())
+    smtp.login((SMTP_USER or "").strip(), (SMTP_PASS or "").strip())
+    return smtp
+
+def send_emails_pooled(items, from_name="RistoSmart FM"):
+    """Come send_emails_personalized ma su più sessioni SMTP in parallelo.
+       Ritorna (results, report) con report = messages/sent/failed/msgs_per_s/...
+    """
+    from utils.smtp_pool import send_parallel  # smtplib/ssl solo al primo invio
+    return send_parallel(
+        items, _smtp_connect, (SMTP_USER or "").strip(),
+        sessions=app.config["SMTP_SESSIONS"],
+        max_per_session=app.config["SMTP_MAX_PER_SESSION"],
+        default_from_name=from_name,
+    )
+
+# === EMAIL OUTBOX: accodamento + worker di consegna in background ===
+app.config["OUTBOX_WORKER"] = (os.getenv("OUTBOX_WORKER", "1") or "1").strip() == "1"
+app.config["OUTBOX_BATCH"] = int(os.getenv("OUTBOX_BATCH", "200"))
+_outbox_worker = None
+
+def queue_emails(items, tag=None, user_id=None) -> list:
+    """Accoda le email in email_outbox (commit immediato) e sveglia il worker.
+       Ritorna gli id creati: lo stato si legge con outbox_status().
+    """
+    conn = get_db()
+    try:
+        ids = enqueue(conn, items, tag=tag, user_id=user_id)
+        conn.commit()
+    finally:
+        conn.close()
+    if _outbox_worker is not None:
+        _outbox_worker.notify()
+    return ids
+
+def start_outbox_worker():
+    """Avvia (una volta per processo) il thread che consegna email_outbox."""
+    global _outbox_worker
+    if _outbox_worker is None or not _outbox_worker.is_alive():
+        _outbox_worker = OutboxWorker(get_db, send_emails_pooled,
+                                      batch_size=app.config["OUTBOX_BATCH"])
+        _outbox_worker.start()
+    return _outbox_worker
+
 
 # === CONFIGURAZIONE DB ===
 BASE_DIR = Path(__file__).resolve().parent
@@ -433,30 +553,143 @@ def download_log_wa():
     return jsonify({"ok": False, "msg": "Nessun log WhatsApp"}), 404
 
 
+def db_pool():
+    # TimedCursor solo se servono metriche o traccia SQL: con METRICS=0 e
+    # SQL_TRACE=0 le query usano l'execute in C, senza wrapper
+    return get_pool(app.config["DB_PATH"], app.config["DB_POOL_SIZE"],
+                    timed=app.config["METRICS"] or app.config["SQL_TRACE"])
+
 def get_db():
-    # Garantisce cartella esistente e connessione solida
-    db_path = app.config["DB_PATH"]
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    """Connessione dal pool condiviso.
 
-    conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-    conn.row_factory = sqlite3.Row
+    Dentro una richiesta (app context) la connessione resta in flask.g ed è
+    la stessa per tutto il ciclo: close() è un no-op e la restituzione al pool
+    avviene nel teardown. Fuori contesto close() la rimette nel pool.
+    """
+    pool = db_pool()
+    if not has_app_context():
+        return pool.acquire()
+
+    conn = g.get("_db_conn")
+    if conn is None:
+        conn = pool.acquire()
+        conn.scoped = True
+        conn.reset_counters()  # i contatori SQL valgono per questa richiesta
+        g._db_conn = conn
+    return conn
 
-    # Stabilità e integrità (PRAGMA sono per-connessione)
-    conn.execute("PRAGMA foreign_keys = ON")   # valida FK su ogni query
-    conn.execute("PRAGMA journal_mode = WAL")  # letture non bloccano scritture
-    conn.execute("PRAGMA synchronous = NORMAL")# bilancia durabilità/velocità in WAL
-    conn.execute("PRAGMA busy_timeout = 5000") # attende lock fino a 5s
+@app.teardown_appcontext
+def _release_db(exc):
+    # Sempre eseguito, anche su eccezione: rollback di ciò che non è committato
+    conn = g.pop("_db_conn", None)
+    if conn is None:
+        return
+    conn.scoped = False
+    try:
+        conn.close()
+    except Exception as e:
+        app.logger.warning("[DB POOL] rilascio connessione fallito: %s", e)
 
-    return conn
+@app.get("/admin/db/pool")
+@require_admin
+def admin_db_pool_stats():
+    pool = db_pool()
+    return jsonify({"ok": True, **pool.stats()})
+
+# === TRACCIA SQL (statement più costosi + log delle query lente) ===
+# Ogni statement eseguito dalle connessioni del pool passa da sql_tracer
+# (normalizzato, con tempo di execute + fetch). Sopra SLOW_SQL_MS finisce in
+# slow_sql.log (rotante) con il suo EXPLAIN QUERY PLAN; "full_scan" elenca le
+# tabelle lette per intero. Diagnostica da accendere quando serve (SQL_TRACE=1):
+# costa ~1 µs in più per statement rispetto ai soli contatori di /admin/metrics.
+app.config["SQL_TRACE"] = (os.getenv("SQL_TRACE", "0") or "0").strip() == "1"
+app.config["SLOW_SQL_MS"] = float(os.getenv("SLOW_SQL_MS", "100"))
+app.config["SLOW_SQL_LOG"] = os.getenv("SLOW_SQL_LOG", str(LOG_DIR / "slow_sql.log"))
+sql_tracer = SqlTracer(slow_ms=app.config["SLOW_SQL_MS"], log_path=app.config["SLOW_SQL_LOG"])
+if app.config["SQL_TRACE"]:
+    db_pool().tracer = sql_tracer
+
+@app.get("/admin/sql")
+@require_admin
+def admin_sql_top():
+    """Statement per tempo totale (?ordine=total|count|max|avg, ?n=20)."""
+    n = min(max(request.args.get("n", 20, type=int), 1), 200)
+    return jsonify({"ok": True, "enabled": app.config["SQL_TRACE"], **sql_tracer.stats(),
+                    "top": sql_tracer.top(n, request.args.get("ordine", "total"))})
+
+@app.get("/admin/sql/slow")
+@require_admin
+def admin_sql_slow():
+    return jsonify({"ok": True, "slow_ms": app.config["SLOW_SQL_MS"], "log": app.config["SLOW_SQL_LOG"],
+                    "recent": sql_tracer.recent_slow()})
+
+@app.post("/admin/sql/reset")
+@require_admin
+@require_csrf
+def admin_sql_reset():
+    sql_tracer.reset()
+    return jsonify({"ok": True})
+
+@app.get("/admin/metrics")
+@require_admin
+def admin_metrics():
+    """Metriche per endpoint: testo Prometheus (default) o ?formato=json."""
+    if request.args.get("formato") == "json":
+        return jsonify({"ok": True, "enabled": app.config["METRICS"], "endpoints": request_metrics.to_json()})
+    return app.response_class(request_metrics.to_prometheus(), mimetype="text/plain; version=0.0.4")
+
+@app.post("/admin/metrics/reset")
+@require_admin
+@require_csrf
+def admin_metrics_reset():
+    request_metrics.reset()
+    return jsonify({"ok": True})
+
+@app.get("/admin/license-cache")
+@require_admin
+def admin_license_cache_stats():
+    return jsonify({"ok": True, **license_cache.stats()})
+
+@app.get("/admin/qr-cache")
+@require_admin
+def admin_qr_cache_stats():
+    return jsonify({"ok": True, **qr_cache.stats()})
+
+@app.get("/admin/pdf-render")
+@require_admin
+def admin_pdf_render_stats():
+    return jsonify({"ok": True, **pdf_renderer.stats()})
+
+def render_pdf(layout, *args):
+    """PDF (o grafico PNG) dal process pool → (bytes, None) oppure (None, risposta di errore)."""
+    try:
+        return pdf_renderer.render(layout, *args), None
+    except PdfQueueFull as e:
+        app.logger.warning("PDF %s rifiutato: %s", layout, e)
+        return None, (jsonify(error="Troppe esportazioni in corso, riprova tra poco"), 503)
+    except TimeoutError as e:
+        app.logger.warning("PDF %s: %s", layout, e)
+        return None, (jsonify(error="Generazione PDF troppo lenta, riprova"), 504)
+    except Exception as e:
+        app.logger.error(f"Errore generazione PDF {layout}: {e}")
+        return None, (jsonify(error="Impossibile generare il PDF"), 500)
 
-def ensure_indexes():
+@app.get("/admin/outbox")
+@require_admin
+def admin_outbox_status():
+    worker = _outbox_worker.stats() if _outbox_worker is not None else {"alive": False}
     with get_db() as conn:
-        conn.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS ux_stipendi_user_pid_anno_mese
-            ON stipendi_personale(user_id, personale_id, anno, mese)
-        """)
-        conn.commit()
-    print("[DB] ux_stipendi_user_pid_anno_mese OK", flush=True)
+        failed = [dict(r) for r in conn.execute("""
+            SELECT id, tag, to_email, subject, attempts, last_error, created_at
+            FROM email_outbox WHERE status = 'failed' ORDER BY id DESC LIMIT 50
+        """)]
+        return jsonify({"ok": True, **outbox_status(conn), "worker": worker, "failed": failed})
+
+@app.get("/admin/schema")
+@require_admin
+def admin_schema_status():
+    with get_db() as conn:
+        return jsonify({"ok": True, **schema_migrations.status(conn)})
 
 def ensure_triggers():
     with get_db() as conn:
@@ -590,260 +823,335 @@ def ensure_data_consistency():
         conn.commit()
     print("[DB] data fix: stato_pagamento NULL -> 'non_pagato'", flush=True)
 
-def init_db():
-    """Crea le tabelle se non esistono già (versione multi-tenant)"""
-    with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute("PRAGMA foreign_keys = ON")
+def _ensure_mese_num(cur, table):
+    """Aggiunge mese_num (1..12) a una tabella con 'mese' testuale e la riempie.
 
-        # --- INCASSI (multi-tenant) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS incassi (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                anno INTEGER NOT NULL,
-                mese TEXT NOT NULL,
-                giorno INTEGER NOT NULL,
-                valore REAL NOT NULL DEFAULT 0
-            )
-        """)
-        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_incassi_user ON incassi(user_id, anno, mese, giorno)")
+    Il backfill usa le stesse regole di _normalize_mese ('marzo', '3', '03', 'mar'),
+    così le letture possono filtrare con un semplice mese_num = ? sull'indice.
+    """
+    cur.execute(f"PRAGMA table_info({table})")
+    if "mese_num" not in {row[1] for row in cur.fetchall()}:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN mese_num INTEGER")
+
+    pending = cur.execute(f"SELECT DISTINCT mese FROM {table} WHERE mese_num IS NULL").fetchall()
+    for row in pending:
+        _, num = _normalize_mese(str(row[0] or ""))
+        if num:
+            cur.execute(f"UPDATE {table} SET mese_num=? WHERE mese_num IS NULL AND mese=?", (num, row[0]))
+
+# === MIGRAZIONI SCHEMA (PRAGMA user_version) ===
+# All'avvio init_db() confronta user_version con l'ultima migrazione e applica
+# solo quelle mancanti. Le migrazioni 1..7 riproducono lo schema storico e sono
+# idempotenti: un DB creato prima del registro (user_version 0) le riattraversa
+# senza perdere nulla.
+# Per modificare lo schema aggiungere una nuova migrazione in fondo, mai toccare
+# quelle già rilasciate. Storico consultabile in /admin/schema.
+schema_migrations = MigrationRegistry()
+
+@schema_migrations.register(1, "tabelle base multi-tenant")
+def _migration_base(conn):
+    cur = conn.cursor()
 
-        # --- SPESE FISSE (multi-tenant) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS spese_fisse (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                anno INTEGER NOT NULL,
-                mese TEXT NOT NULL,
-                categoria TEXT NOT NULL,
-                valore REAL NOT NULL DEFAULT 0
-            )
-        """)
-        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_spese_fisse_user ON spese_fisse(user_id, anno, mese, categoria)")
+    # --- INCASSI (multi-tenant) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS incassi (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            mese TEXT NOT NULL,
+            giorno INTEGER NOT NULL,
+            valore REAL NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_incassi_user ON incassi(user_id, anno, mese, giorno)")
 
-        # --- SPESE FATTURE (multi-tenant) --- (SPOSTATA QUI)
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS spese_fatture (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                anno INTEGER NOT NULL,
-                mese TEXT NOT NULL,
-                categoria TEXT NOT NULL,
-                valore REAL NOT NULL DEFAULT 0,
-                created_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_spese_fatture_user_anno_mese ON spese_fatture(user_id, anno, mese)")
+    # --- SPESE FISSE (multi-tenant) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS spese_fisse (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            mese TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            valore REAL NOT NULL DEFAULT 0
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_spese_fisse_user ON spese_fisse(user_id, anno, mese, categoria)")
 
-        # --- CLIENTI (multi-tenant) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS clienti (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                nome TEXT NOT NULL,
-                telefono TEXT,
-                email TEXT,
-                note TEXT,
-                created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_clienti_user ON clienti(user_id)")
+    # --- SPESE FATTURE (multi-tenant) --- (SPOSTATA QUI)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS spese_fatture (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            mese TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            valore REAL NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_spese_fatture_user_anno_mese ON spese_fatture(user_id, anno, mese)")
 
-        # --- PERSONALE (multi-tenant) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS personale (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                nome TEXT NOT NULL,
-                ruolo TEXT,
-                data_assunzione TEXT,
-                rapporto TEXT,
-                data_fine TEXT,
-                telefono TEXT,
-                email TEXT,
-                iban TEXT,
-                riposo TEXT,
-                created_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_personale_user ON personale(user_id)")
+    # --- CLIENTI (multi-tenant) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS clienti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            nome TEXT NOT NULL,
+            telefono TEXT,
+            email TEXT,
+            note TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_clienti_user ON clienti(user_id)")
 
-        # --- STIPENDI PERSONALE (mensilita dipendente) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS stipendi_personale (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                personale_id INTEGER NOT NULL,
-                anno INTEGER NOT NULL,
-                mese TEXT NOT NULL,
-                lordo REAL NOT NULL DEFAULT 0,
-                netto REAL NOT NULL DEFAULT 0,
-                contributi REAL NOT NULL DEFAULT 0,
-                totale REAL NOT NULL DEFAULT 0,
-                stato_pagamento TEXT NOT NULL DEFAULT 'non_pagato',
-                UNIQUE(user_id, personale_id, anno, mese),
-                FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE,
-                FOREIGN KEY (personale_id) REFERENCES personale (id) ON DELETE CASCADE
-            )
-        """)
-        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_stipendi_personale_key ON stipendi_personale(user_id, personale_id, anno, mese)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_stipendi_personale_user ON stipendi_personale(user_id)")
-        cur.execute("PRAGMA table_info(stipendi_personale)")
-        cols = {row[1] for row in cur.fetchall()}
-        if 'lordo' not in cols:
-            cur.execute("ALTER TABLE stipendi_personale ADD COLUMN lordo REAL NOT NULL DEFAULT 0")
-        if 'netto' not in cols:
-            cur.execute("ALTER TABLE stipendi_personale ADD COLUMN netto REAL NOT NULL DEFAULT 0")
-        if 'contributi' not in cols:
-            cur.execute("ALTER TABLE stipendi_personale ADD COLUMN contributi REAL NOT NULL DEFAULT 0")
-        if 'totale' not in cols:
-            cur.execute("ALTER TABLE stipendi_personale ADD COLUMN totale REAL NOT NULL DEFAULT 0")
-        if 'stato_pagamento' not in cols:
-            cur.execute("ALTER TABLE stipendi_personale ADD COLUMN stato_pagamento TEXT NOT NULL DEFAULT 'non_pagato'")
-
-        # --- FORNITORI (multi-tenant) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS fornitori (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                nomeFornitore TEXT NOT NULL,
-                nomeAgente TEXT,
-                categoria TEXT,
-                telAgente TEXT,
-                telAzienda TEXT,
-                indirizzo TEXT,
-                iban TEXT,
-
-                bic TEXT,
-
-                note TEXT,
-                created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_fornitori_user ON fornitori(user_id)")
+    # --- PERSONALE (multi-tenant) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS personale (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            nome TEXT NOT NULL,
+            ruolo TEXT,
+            data_assunzione TEXT,
+            rapporto TEXT,
+            data_fine TEXT,
+            telefono TEXT,
+            email TEXT,
+            iban TEXT,
+            riposo TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_personale_user ON personale(user_id)")
 
-        cur.execute("PRAGMA table_info(fornitori)")
+    # --- STIPENDI PERSONALE (mensilita dipendente) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS stipendi_personale (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            personale_id INTEGER NOT NULL,
+            anno INTEGER NOT NULL,
+            mese TEXT NOT NULL,
+            lordo REAL NOT NULL DEFAULT 0,
+            netto REAL NOT NULL DEFAULT 0,
+            contributi REAL NOT NULL DEFAULT 0,
+            totale REAL NOT NULL DEFAULT 0,
+            stato_pagamento TEXT NOT NULL DEFAULT 'non_pagato',
+            UNIQUE(user_id, personale_id, anno, mese),
+            FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE,
+            FOREIGN KEY (personale_id) REFERENCES personale (id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_stipendi_personale_key ON stipendi_personale(user_id, personale_id, anno, mese)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stipendi_personale_user ON stipendi_personale(user_id)")
+    cur.execute("PRAGMA table_info(stipendi_personale)")
+    cols = {row[1] for row in cur.fetchall()}
+    if 'lordo' not in cols:
+        cur.execute("ALTER TABLE stipendi_personale ADD COLUMN lordo REAL NOT NULL DEFAULT 0")
+    if 'netto' not in cols:
+        cur.execute("ALTER TABLE stipendi_personale ADD COLUMN netto REAL NOT NULL DEFAULT 0")
+    if 'contributi' not in cols:
+        cur.execute("ALTER TABLE stipendi_personale ADD COLUMN contributi REAL NOT NULL DEFAULT 0")
+    if 'totale' not in cols:
+        cur.execute("ALTER TABLE stipendi_personale ADD COLUMN totale REAL NOT NULL DEFAULT 0")
+    if 'stato_pagamento' not in cols:
+        cur.execute("ALTER TABLE stipendi_personale ADD COLUMN stato_pagamento TEXT NOT NULL DEFAULT 'non_pagato'")
+
+    # --- FORNITORI (multi-tenant) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS fornitori (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            nomeFornitore TEXT NOT NULL,
+            nomeAgente TEXT,
+            categoria TEXT,
+            telAgente TEXT,
+            telAzienda TEXT,
+            indirizzo TEXT,
+            iban TEXT,
+
+            bic TEXT,
+
+            note TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fornitori_user ON fornitori(user_id)")
 
-        fornitori_cols = {row[1] for row in cur.fetchall()}
+    cur.execute("PRAGMA table_info(fornitori)")
 
-        if 'bic' not in fornitori_cols:
+    fornitori_cols = {row[1] for row in cur.fetchall()}
 
-            cur.execute("ALTER TABLE fornitori ADD COLUMN bic TEXT")        
+    if 'bic' not in fornitori_cols:
 
-        # --- FATTURE (multi-tenant) ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS fatture (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                data_inserimento TEXT NOT NULL,
-                fornitore TEXT NOT NULL,
-                categoria TEXT NOT NULL,
-                data_scadenza TEXT NOT NULL,
-                importo REAL NOT NULL,
-                stato TEXT NOT NULL DEFAULT 'Non pagato',
-                numero TEXT,
-                created_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_fatture_user ON fatture(user_id)")
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_fatture_scadenza ON fatture(data_scadenza)")
+        cur.execute("ALTER TABLE fornitori ADD COLUMN bic TEXT")        
 
-        # --- UTENTI ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS utenti (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                nome TEXT NOT NULL,
-                cognome TEXT NOT NULL,
-                email TEXT NOT NULL UNIQUE,
-                password_hash TEXT NOT NULL,
-                newsletter_opt_in INTEGER NOT NULL DEFAULT 0,
-                ruolo TEXT NOT NULL DEFAULT 'user',
-                registered_at TEXT NOT NULL DEFAULT (datetime('now')),
-                promo_last_sent TEXT
-            )
-        """)
+    # --- FATTURE (multi-tenant) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS fatture (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            data_inserimento TEXT NOT NULL,
+            fornitore TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            data_scadenza TEXT NOT NULL,
+            importo REAL NOT NULL,
+            stato TEXT NOT NULL DEFAULT 'Non pagato',
+            numero TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (user_id) REFERENCES utenti (id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fatture_user ON fatture(user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fatture_scadenza ON fatture(data_scadenza)")
 
-        # --- LICENZE ---
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS licenze (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT NOT NULL,
-                license_key TEXT NOT NULL UNIQUE,
-                intestatario TEXT,
-                scadenza TEXT,
-                attiva INTEGER NOT NULL DEFAULT 0,
-                meta TEXT,
-                created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_licenze_email ON licenze(email)")
+    # --- UTENTI ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS utenti (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            cognome TEXT NOT NULL,
+            email TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            newsletter_opt_in INTEGER NOT NULL DEFAULT 0,
+            ruolo TEXT NOT NULL DEFAULT 'user',
+            registered_at TEXT NOT NULL DEFAULT (datetime('now')),
+            promo_last_sent TEXT
+        )
+    """)
 
-        # --- TASSE E ENTE --
-        #               
-                # --- ENTI (multi-tenant, multipli per utente) ---
+    # --- LICENZE ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS licenze (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL,
+            license_key TEXT NOT NULL UNIQUE,
+            intestatario TEXT,
+            scadenza TEXT,
+            attiva INTEGER NOT NULL DEFAULT 0,
+            meta TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_licenze_email ON licenze(email)")
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS ente (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                nome TEXT NOT NULL,
-                indirizzo TEXT,
-                telefono TEXT,
-                email TEXT NOT NULL,
-                iban TEXT,
-                bic TEXT,
-                created_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE CASCADE
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_ente_user ON ente(user_id)")
-        
-                # --- TASSE (multi-tenant) ---
-                
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS tasse (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                ente_id INTEGER NOT NULL,
-                causale TEXT,
-                periodo TEXT,
-                importo REAL,
-                scadenza TEXT,
-                stato TEXT CHECK(stato IN ('non_pagato','pagato','standby')) DEFAULT 'non_pagato',
-                created_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY (ente_id) REFERENCES ente(id) ON DELETE CASCADE,
-                FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE CASCADE
-            )
-        """)
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_tasse_user ON tasse(user_id)")
+    # --- ENTI (multi-tenant, multipli per utente) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS ente (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            nome TEXT NOT NULL,
+            indirizzo TEXT,
+            telefono TEXT,
+            email TEXT NOT NULL,
+            iban TEXT,
+            bic TEXT,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ente_user ON ente(user_id)")
 
-        cur.execute("PRAGMA table_info(tasse)")
-        tasse_cols = {row[1] for row in cur.fetchall()}
-        if "data_inserimento" not in tasse_cols:
-            cur.execute("ALTER TABLE tasse ADD COLUMN data_inserimento TEXT")
-            cur.execute("UPDATE tasse SET data_inserimento = substr(created_at, 1, 10) WHERE data_inserimento IS NULL")
-    
-    with sqlite3.connect(app.config["DB_PATH"]) as conn:
-        cur = conn.cursor()
-        cur.execute("PRAGMA foreign_keys = ON")  # <— aggiungi QUI
-        cur.execute("""CREATE INDEX IF NOT EXISTS ix_spese_fisse_user_anno_mese_cat
-                    ON spese_fisse(user_id, anno, mese, categoria);""")
-        cur.execute("""CREATE INDEX IF NOT EXISTS ix_incassi_user_anno_mese
-                    ON incassi(user_id, anno, mese);""")
-        cur.execute("""CREATE INDEX IF NOT EXISTS ix_tasse_user_scadenza
-                    ON tasse(user_id, scadenza);""")
-        cur.execute("""CREATE INDEX IF NOT EXISTS ix_stipendi_user_anno_mese
-                    ON stipendi_personale(user_id, anno, mese);""")
-        cur.execute("""CREATE INDEX IF NOT EXISTS ix_fatture_user_data
-                    ON fatture(user_id, data_inserimento);""")
-    # NON chiamare conn.commit() - il context manager lo fa automaticamente     
+    # --- TASSE (multi-tenant) ---
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS tasse (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            ente_id INTEGER NOT NULL,
+            causale TEXT,
+            periodo TEXT,
+            importo REAL,
+            scadenza TEXT,
+            stato TEXT CHECK(stato IN ('non_pagato','pagato','standby')) DEFAULT 'non_pagato',
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY (ente_id) REFERENCES ente(id) ON DELETE CASCADE,
+            FOREIGN KEY (user_id) REFERENCES utenti(id) ON DELETE CASCADE
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_tasse_user ON tasse(user_id)")
+
+    cur.execute("PRAGMA table_info(tasse)")
+    tasse_cols = {row[1] for row in cur.fetchall()}
+    if "data_inserimento" not in tasse_cols:
+        cur.execute("ALTER TABLE tasse ADD COLUMN data_inserimento TEXT")
+        cur.execute("UPDATE tasse SET data_inserimento = substr(created_at, 1, 10) WHERE data_inserimento IS NULL")
+
+@schema_migrations.register(2, "mese_num su incassi/spese_fisse/spese_fatture")
+def _migration_mese_num(conn):
+    cur = conn.cursor()
+    for table in ("incassi", "spese_fisse", "spese_fatture"):
+        _ensure_mese_num(cur, table)
+
+@schema_migrations.register(3, "indici di lettura (anno/mese, scadenze, drip)")
+def _migration_read_indexes(conn):
+    cur = conn.cursor()
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_spese_fisse_user_anno_mese_cat
+                ON spese_fisse(user_id, anno, mese, categoria);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_incassi_user_anno_mese
+                ON incassi(user_id, anno, mese);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_incassi_user_anno_mesenum
+                ON incassi(user_id, anno, mese_num, giorno);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_spese_fisse_user_anno_mesenum
+                ON spese_fisse(user_id, anno, mese_num, categoria);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_spese_fatture_user_anno_mesenum
+                ON spese_fatture(user_id, anno, mese_num);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_tasse_user_scadenza
+                ON tasse(user_id, scadenza);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_stipendi_user_anno_mese
+                ON stipendi_personale(user_id, anno, mese);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_fatture_user_data
+                ON fatture(user_id, data_inserimento);""")
+    # Filtri per anno/mese riscritti come intervalli di date (vedi year_bounds)
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_fatture_user_scadenza
+                ON fatture(user_id, data_scadenza);""")
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_tasse_user_data
+                ON tasse(user_id, data_inserimento);""")
+    # selezione drip: solo iscritti alla newsletter, per data di registrazione
+    cur.execute("""CREATE INDEX IF NOT EXISTS ix_utenti_drip_registered
+                ON utenti(registered_at) WHERE newsletter_opt_in = 1""")
+
+@schema_migrations.register(4, "riepilogo_mensile (tabella + trigger, riempita alla creazione)")
+def _migration_riepilogo(conn):
+    ensure_riepilogo(conn)
+
+@schema_migrations.register(5, "email_outbox")
+def _migration_outbox(conn):
+    ensure_outbox(conn)
+
+@schema_migrations.register(6, "scheduler_runs (ultima esecuzione dei job)")
+def _migration_scheduler(conn):
+    ensure_scheduler(conn)
+
+@schema_migrations.register(7, "data_version per utente (chiave della cache degli export)")
+def _migration_data_versions(conn):
+    ensure_data_versions(conn)
+
+@schema_migrations.register(8, "rimuove gli indici unici duplicati di stipendi_personale")
+def _migration_stipendi_dup_indexes(conn):
+    # stessa chiave di UNIQUE(...) e di ux_stipendi_personale_key: ogni scrittura li aggiornava tutti
+    conn.execute("DROP INDEX IF EXISTS ux_stipendi_personale")
+    conn.execute("DROP INDEX IF EXISTS ux_stipendi_user_pid_anno_mese")
+
+def init_db():
+    """Applica le migrazioni mancanti (nessuna DDL se user_version è già all'ultima)."""
+    pool = db_pool()
+    conn = pool.acquire()
+    try:
+        schema_migrations.migrate(conn, logger=app.logger)
+    finally:
+        conn.close()
         
+# Con spawn (Windows, .exe PyInstaller) i processi dei pool PDF/QR rieseguono
+# questo modulo: outbox e scheduler partono solo nel processo principale.
+IS_MAIN_PROCESS = parent_process() is None
+
 # Inizializza DB all'avvio
 init_db()
+if app.config["OUTBOX_WORKER"] and IS_MAIN_PROCESS:
+    start_outbox_worker()
 
 def get_csrf():
     tok = session.get("_csrf")
@@ -921,48 +1229,69 @@ import sqlite3
 import json
 
 def _get_license_expiry_from_db(user_id: int | str):
+    email = session.get("email") or session.get("user_email") or session.get("utente_email")
     try:
-        conn = sqlite3.connect(app.config['DB_PATH'])
-        cur = conn.cursor()        
+        return license_cache.get_or_load(
+            "expiry", user_id, email, lambda: _lookup_license_expiry(user_id)
+        )
+    except Exception as e:
+        app.logger.warning(f"license lookup failed: {e}")
+        return None
 
-        # Trova tabella licenze: 'licenses' o 'licenze'
-        for table in ("licenses", "licenze"):
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
-            if not cur.fetchone():
-                continue
+# Query scadenza licenza risolta una volta sola: (schema_version, ((sql, "id"|"email"), ...))
+_LICENSE_EXPIRY_QUERIES = (None, ())
 
-            # Colonne disponibili
-            cur.execute(f"PRAGMA table_info({table})")
-            cols = [r[1] for r in cur.fetchall()]
-            if not cols:
-                continue
+def _resolve_license_expiry_queries(conn, schema_version):
+    """Individua tabella/colonne licenze e prepara le SELECT della scadenza."""
+    global _LICENSE_EXPIRY_QUERIES
+    queries = []
+    # Trova tabella licenze: 'licenses' o 'licenze'
+    for table in ("licenses", "licenze"):
+        if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
+            continue
 
-            expiry_candidates = [c for c in cols if c in ("expires_at","expiry","valid_to","scadenza","scadenza_licenza")]
-            user_candidates   = [c for c in cols if c in ("user_id","utente_id","email")]
-            if not expiry_candidates or not user_candidates:
-                continue
+        # Colonne disponibili
+        cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})").fetchall()]
+        expiry_candidates = [c for c in cols if c in ("expires_at","expiry","valid_to","scadenza","scadenza_licenza")]
+        user_candidates   = [c for c in cols if c in ("user_id","utente_id","email")]
+        if not expiry_candidates or not user_candidates:
+            continue
 
-            expiry_col = expiry_candidates[0]
+        expiry_col = expiry_candidates[0]
+
+        # Colonna utente: preferisci id; fallback email
+        if "user_id" in user_candidates:
+            ucol, by = "user_id", "id"
+        elif "utente_id" in user_candidates:
+            ucol, by = "utente_id", "id"
+        else:
+            ucol, by = "email", "email"
 
-            # Colonna utente: preferisci id; fallback email
-            if "user_id" in user_candidates:
-                ucol, uval = "user_id", user_id
-            elif "utente_id" in user_candidates:
-                ucol, uval = "utente_id", user_id
-            elif "email" in user_candidates:
-                ucol = "email"
+        queries.append((f"SELECT {expiry_col} FROM {table} WHERE {ucol}=? ORDER BY {expiry_col} DESC LIMIT 1", by))
+
+    _LICENSE_EXPIRY_QUERIES = (schema_version, tuple(queries))
+    return _LICENSE_EXPIRY_QUERIES[1]
+
+def _lookup_license_expiry(user_id: int | str):
+    conn = get_db()
+    try:
+        # schema_version cambia a ogni DDL: unica query di metadati per lookup
+        version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        cached_version, queries = _LICENSE_EXPIRY_QUERIES
+        if version != cached_version:
+            queries = _resolve_license_expiry_queries(conn, version)
+
+        for sql, by in queries:
+            if by == "id":
+                uval = user_id
+            else:
                 uval = session.get("email") or session.get("user_email") or session.get("utente_email")
                 if not uval:
                     continue
-            else:
-                continue
-
-            cur.execute(f"SELECT {expiry_col} FROM {table} WHERE {ucol}=? ORDER BY {expiry_col} DESC LIMIT 1", (uval,))
-            row = cur.fetchone()
+            # SQL costante → riusa lo statement preparato dalla cache della connessione
+            row = conn.execute(sql, (uval,)).fetchone()
             if row and row[0]:
                 return _coerce_to_date(row[0])
-    except Exception as e:
-        app.logger.warning(f"license lookup failed: {e}")
     finally:
         try:
             conn.close()
@@ -1072,10 +1401,6 @@ def logout_post():
 @require_login
 @require_license
 def mese_html(anno, mese):
-    mesi = [
-        "gennaio", "febbraio", "marzo", "aprile", "maggio", "giugno",
-        "luglio", "agosto", "settembre", "ottobre", "novembre", "dicembre"
-    ]
     mese_norm, mese_num = _normalize_mese(mese)
     if not mese_num:
         return f"Mese '{mese}' non valido.", 404
@@ -1088,25 +1413,19 @@ def mese_html(anno, mese):
     conn = get_db()
     cur = conn.cursor()
     
-        # --- Incassi ---
+        # --- Incassi (dettaglio per giorno) ---
     cur.execute(
         "SELECT giorno, valore FROM incassi "
-        "WHERE user_id=? AND anno=? "
-        "AND LOWER(TRIM(mese)) IN (LOWER(TRIM(?)), LOWER(TRIM(?)), LOWER(TRIM(?))) "
+        "WHERE user_id=? AND anno=? AND mese_num=? "
         "ORDER BY giorno",
-        (uid, anno, mese_norm, str(mese_num), f"{mese_num:02d}")
+        (uid, anno, mese_num)
     )
     incassi = {int(r["giorno"]): float(r["valore"]) for r in cur.fetchall()}
     tot_incassi = sum(incassi.values())
 
-    # --- Spese ---
-    cur.execute(
-        "SELECT categoria, valore FROM spese_fisse "
-        "WHERE user_id=? AND anno=? "
-        "AND LOWER(TRIM(mese)) IN (LOWER(TRIM(?)), LOWER(TRIM(?)), LOWER(TRIM(?)))",
-        (uid, anno, mese_norm, str(mese_num), f"{mese_num:02d}")
-    )
-    spese = {r["categoria"]: float(r["valore"]) for r in cur.fetchall()}
+    # --- Spese fisse e tasse del mese: stesse regole di /api/annuale ---
+    mese_ledger = load_ledger(conn, uid, anno, mese_num)[mese_num]
+    spese = dict(mese_ledger.spese_fisse)
     tot_spese = sum(spese.values())
 
     # --- Calcola ricavo PRIMA di caricare le tasse ---
@@ -1129,39 +1448,16 @@ def mese_html(anno, mese):
     for field_id in ente_to_id.values():
         spese[field_id] = 0.0
 
-    # Estrai anno e mese numerico dal mese testuale
-    mese_num = mesi.index(mese_norm) + 1  # gennaio=1, ..., settembre=9
-
-    # Carica le tasse dove data_inserimento appartiene all'anno e al mese richiesto
-    cur.execute("""
-        SELECT 
-            e.nome AS ente_nome,
-            t.importo
-        FROM tasse t
-        JOIN ente e ON t.ente_id = e.id AND e.user_id = t.user_id
-        WHERE t.user_id = ?
-        AND CAST(strftime('%Y', t.data_inserimento) AS INTEGER) = ?
-        AND CAST(strftime('%m', t.data_inserimento) AS INTEGER) = ?
-    """, (uid, anno, mese_num))
-
-    # [Opzionale] Log: stampa i nomi degli enti trovati (utile per debug)
-    app.logger.info(f"[DEBUG] Enti trovati per {anno}-{mese_norm}:")
-    for row in cur.fetchall():
-        ente_nome_raw = row['ente_nome']
-        importo = float(row['importo']) if row['importo'] else 0.0
-
+    for ente_nome_raw, importo in mese_ledger.tasse.items():
         # Normalizza: trim + lower
-        ente_nome = ente_nome_raw.strip().lower()
-
-        app.logger.info(f"  - '{ente_nome_raw}' → normalizzato → '{ente_nome}'")
+        ente_nome = (ente_nome_raw or "").strip().lower()
 
         # Cerca il campo corrispondente
         field_id = ente_to_id.get(ente_nome)
         if field_id:
             spese[field_id] += importo
-            app.logger.info(f"    ✓ Matchato con campo: {field_id} → valore aggiunto: {importo}")
         else:
-            app.logger.warning(f"    ✗ Nessun match per: '{ente_nome}'")
+            app.logger.warning(f"[MESE] Nessun campo tassa per ente: '{ente_nome}'")
     # --- FINE CARICAMENTO TASSE ---
 
     conn.close()
@@ -1267,43 +1563,40 @@ def has_active_license(email: str) -> bool:
         return True
 
     try:
-        with get_db() as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            # cerchiamo la licenza associata allo stesso user_id e stessa email
-            cur.execute("""
-                SELECT chiave, scadenza, attiva
-                FROM licenze
-                WHERE user_id = ? AND email = ? AND attiva = 1
-                ORDER BY id DESC
-                LIMIT 1
-            """, (uid, email_n))
-            row = cur.fetchone()
-            if not row:
-                return False
+        return license_cache.get_or_load(
+            "active", uid, email_n, lambda: _query_active_license(email_n)
+        )
+    except Exception:
+        # in caso di errori di DB non esporre dettagli, neghiamo accesso (non in cache)
+        return False
 
-            chiave = (row["chiave"] or "").strip().upper()
-            scadenza = row["scadenza"]
+def _query_active_license(email_n: str) -> bool:
+    """Lettura DB dello stato licenza (senza cache). Solleva su errori DB."""
+    with get_db() as conn:
+        conn.row_factory = sqlite3.Row
+        # licenze non ha user_id: la licenza è legata all'email (normalizzata
+        # all'attivazione); l'isolamento per utente lo dà la chiave di cache (uid, email)
+        row = conn.execute("""
+            SELECT license_key, scadenza, attiva
+            FROM licenze
+            WHERE email = ? AND attiva = 1
+            ORDER BY id DESC
+            LIMIT 1
+        """, (email_n,)).fetchone()
+        if not row:
+            return False
 
-            # bypass DEV-TRIAL anche se salvata nel DB
-            if chiave == "DEV-TRIAL":
-                return True
+        # bypass DEV-TRIAL anche se salvata nel DB
+        if (row["license_key"] or "").strip().upper() == "DEV-TRIAL":
+            return True
 
-            # se è presente la scadenza la verifichiamo
-            if scadenza:
-                try:
-                    from datetime import datetime
-                    expiry = datetime.strptime(scadenza, "%Y-%m-%d").date()
-                    return expiry >= datetime.utcnow().date()
-                except Exception:
-                    # formato inatteso -> consideriamo non valida
-                    return False
+        # se è presente la scadenza la verifichiamo (formato inatteso -> non valida)
+        if row["scadenza"]:
+            expiry = _coerce_to_date(row["scadenza"])
+            return expiry is not None and expiry >= datetime.utcnow().date()
 
-            # se non c'è scadenza e attiva==1 -> consideriamo valida
-            return True
-    except Exception:
-        # in caso di errori di DB non esporre dettagli, neghiamo accesso
-        return False
+        # se non c'è scadenza e attiva==1 -> consideriamo valida
+        return True
 
 
 def get_license_by_key(key: str):
@@ -1362,6 +1655,7 @@ def activate_license(email: str, key: str):
         # attiva e vincola all'email
         cur.execute("UPDATE licenze SET email = ?, attiva = 1 WHERE id = ?", (email_n, row["id"]))
         conn.commit()
+        license_cache.invalidate(email=email_n)
         return {"ok": True}
     finally:
         conn.close()
@@ -1565,7 +1859,7 @@ def register():
                  "subject": "Nuova registrazione RistoSmart FM",
                  "body": admin_plain}
             ]
-            send_emails_personalized(items)
+            queue_emails(items, tag="register")
         except Exception as e:
             print("[REGISTER EMAIL ERROR]", e)
 
@@ -1725,7 +2019,7 @@ def license_page():
                 { "email": _normalize_email(email), "subject": "Licenza attivata — RistoSmart FM", "body": ok_html },
                 { "email": ADMIN_EMAIL, "subject": "Licenza attivata (notifica admin)", "body": admin_plain },
             ]
-            send_emails_personalized(items)
+            queue_emails(items, tag="license")
         except Exception as e:
             print("[LICENSE OK EMAIL WARN]", e)
 
@@ -1739,62 +2033,71 @@ def license_page():
 @app.get("/admin/drip")
 @require_admin
 def admin_drip():
+    return jsonify({"ok": True, **run_drip()})
+
+def _drip_stage_sql(days_expr: str) -> str:
+    """CASE SQL equivalente a _stage_from_days()."""
+    return (f"CASE WHEN {days_expr} >= 12 THEN 5 WHEN {days_expr} >= 9 THEN 4 "
+            f"WHEN {days_expr} >= 6 THEN 3 WHEN {days_expr} >= 3 THEN 2 ELSE 0 END")
+
+# Utenti a cui spetta uno step drip: iscritti, senza licenza attiva, con step
+# corrente (giorni da registrazione) > step dell'ultimo invio. Una sola query.
+_DRIP_DUE_SQL = f"""
+    WITH cand AS (
+        SELECT u.id, u.nome, lower(trim(u.email)) AS email,
+               CAST(julianday(date('now', 'localtime')) - julianday(date(u.registered_at)) AS INTEGER) AS days,
+               CAST(julianday(date(u.promo_last_sent)) - julianday(date(u.registered_at)) AS INTEGER) AS last_days
+        FROM utenti u
+        WHERE u.newsletter_opt_in = 1
+          AND u.registered_at < date('now', 'localtime', '-2 days')
+          AND trim(u.email) <> ''
+    ), staged AS (
+        SELECT id, nome, email,
+               {_drip_stage_sql("days")} AS stage,
+               CASE WHEN last_days IS NULL THEN 0 ELSE {_drip_stage_sql("last_days")} END AS last_stage
+        FROM cand
+        WHERE days IS NOT NULL
+    )
+    SELECT s.id, s.nome, s.email, s.stage
+    FROM staged s
+    WHERE s.stage > s.last_stage
+      AND NOT EXISTS (
+          SELECT 1 FROM licenze l
+          WHERE l.email = s.email AND l.attiva = 1
+            AND (l.scadenza IS NULL OR l.scadenza = '' OR date(l.scadenza) >= date('now'))
+      )
+"""
+# (niente ORDER BY id: forzerebbe una SCAN della tabella al posto dell'indice su registered_at)
+
+def run_drip():
+    """Accoda le email drip (3/6/9/12 giorni) dovute. Ritorna un riepilogo dict."""
     now = datetime.now()
     conn = get_db()
     cur = conn.cursor()
 
-    users = cur.execute("""
-        SELECT id, nome, cognome, email, registered_at, promo_last_sent, newsletter_opt_in
-        FROM utenti
-        ORDER BY id ASC
-    """).fetchall()
-
-    items = []
-    to_update = []  # (user_id, email)
-    for u in users:
-        if not u["newsletter_opt_in"]:
-            continue
-
-        email = (u["email"] or "").strip().lower()
-        if not email or has_active_license(email):
-            continue
-
-        reg_dt = _parse_dt(u["registered_at"])
-        last_dt = _parse_dt(u["promo_last_sent"])
-        if not reg_dt:
-            continue
-
-        days = (now.date() - reg_dt.date()).days
-        stage = _stage_from_days(days)      # 0 / 2 / 3 / 4  → (3,5,10 giorni)
-        if stage == 0:
-            continue
-
-        last_stage = _stage_from_days((last_dt.date() - reg_dt.date()).days) if last_dt else 0
-        if stage <= last_stage:
-            continue  # già inviato questo step (o successivo)
-
-        subject = _drip_subject(stage)
-        body = _drip_body_html(stage, u["nome"] or "")
-        items.append({"email": email, "subject": subject, "body": body})
-        to_update.append((u["id"], email))
+    due = cur.execute(_DRIP_DUE_SQL).fetchall()
+    items = [
+        {"email": u["email"], "subject": _drip_subject(u["stage"]), "body": _drip_body_html(u["stage"], u["nome"] or "")}
+        for u in due
+    ]
+    to_update = [(u["id"], u["email"]) for u in due]
 
-    results = []
+    outbox_ids = []
     if items:
-        results = send_emails_personalized(items) or []
-        ok_emails = {r.get("email") for r in results if r.get("ok")}
+        # la consegna (con retry) è garantita dall'outbox: lo step si segna all'accodamento
+        outbox_ids = enqueue(conn, items, tag="drip")
         ts = now.strftime("%Y-%m-%d %H:%M:%S")
-        for uid, em in to_update:
-            if em in ok_emails:
-                cur.execute("UPDATE utenti SET promo_last_sent = ? WHERE id = ?", (ts, uid))
+        cur.executemany("UPDATE utenti SET promo_last_sent = ? WHERE id = ?", [(ts, uid) for uid, _ in to_update])
         conn.commit()
+        if _outbox_worker is not None:
+            _outbox_worker.notify()
 
     conn.close()
-    return jsonify({
-        "ok": True,
-        "checked_users": len(users),
-        "sent": sum(1 for r in results if r.get("ok")),
-        "errors": [r for r in results if not r.get("ok")]
-    })
+    return {
+        "due_users": len(due),
+        "queued": len(outbox_ids),
+        "outbox_ids": outbox_ids,
+    }
 
 @app.route("/admin/licenses", methods=["GET", "POST"])
 @require_admin
@@ -1989,11 +2292,8 @@ def run_expiry_reminders():
         items.append({"email": to_email, "subject": subject, "body": body})
         updates.append((lid, stage_key, meta))
 
-    # invia in un colpo solo
-    sent_ok = 0
-    if items:
-        res = send_emails_personalized(items) or []
-        sent_ok = sum(1 for r in res if r.get("ok"))
+    # accoda in un colpo solo (consegna + retry nel worker outbox)
+    outbox_ids = queue_emails(items, tag="expiry") if items else []
 
     # marca invii
     if updates:
@@ -2006,7 +2306,7 @@ def run_expiry_reminders():
                 except Exception:
                     pass
 
-    return {"checked": len(rows), "queued": len(items), "sent": sent_ok}
+    return {"checked": len(rows), "queued": len(outbox_ids), "outbox_ids": outbox_ids}
 
 def _cleanup_backups():
     """Elimina i vecchi ZIP in C:\\RISTO\\BACKUP in base a conteggio e/o età."""
@@ -2063,76 +2363,91 @@ def _cleanup_backups():
 
     return removed
 
-@app.route("/admin/backup/db", methods=["GET", "POST"])
-@require_admin
-def admin_backup_db():
-    # Richieste POST: richiedi il token CSRF
-    if request.method == "POST":
-        tok = request.headers.get("X-CSRF-Token") or request.form.get("csrf_token", "")
-        if not validate_csrf(tok):
-            return "CSRF mancante o non valido", 400
+# Backup online (API di backup SQLite) in un thread: i writer non si fermano
+app.config["BACKUP_PAGES_PER_STEP"] = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+backup_manager = BackupManager(
+    app.config["DB_PATH"], LOG_DIR,
+    pages=app.config["BACKUP_PAGES_PER_STEP"],
+    after=_cleanup_backups,
+)
 
-    from pathlib import Path
-    import zipfile
-    
-    db_path = Path(app.config["DB_PATH"])
-    out_dir = Path(LOG_DIR)
-    out_dir.mkdir(parents=True, exist_ok=True)
+# Backup incrementale: una base completa ogni N giorni + solo le pagine cambiate tra un punto e l'altro.
+# Ripristino a un istante: python -m utils.incremental_backup restore DB ARCHIVIO OUT.db --at "..."
+app.config["INCR_BACKUP_DIR"] = os.getenv("INCR_BACKUP_DIR", str(LOG_DIR / "incrementale"))
+app.config["INCR_BACKUP_EVERY_MIN"] = float(os.getenv("INCR_BACKUP_EVERY_MIN", "60"))  # 0 = disattivato
+app.config["INCR_BACKUP_BASE_DAYS"] = float(os.getenv("INCR_BACKUP_BASE_DAYS", "7"))
+app.config["INCR_BACKUP_KEEP_BASES"] = int(os.getenv("INCR_BACKUP_KEEP_BASES", "2"))
+# DB fino a questa dimensione fotografati in RAM (picco ~3x); oltre, file temporaneo
+app.config["INCR_BACKUP_MAX_RAM_MB"] = float(os.getenv("INCR_BACKUP_MAX_RAM_MB", "64"))
+incremental_backup = IncrementalArchive(
+    app.config["DB_PATH"], app.config["INCR_BACKUP_DIR"],
+    base_every=app.config["INCR_BACKUP_BASE_DAYS"],
+    keep_bases=app.config["INCR_BACKUP_KEEP_BASES"],
+    pages=app.config["BACKUP_PAGES_PER_STEP"],
+    max_memory_mb=app.config["INCR_BACKUP_MAX_RAM_MB"],
+)
 
-    try:
-        with get_db() as c:
-            c.execute("PRAGMA wal_checkpoint(FULL);")
-    except Exception as e:
-        print("[BACKUP WARN] wal_checkpoint:", e)
+@app.get("/admin/backup/incremental")
+@require_admin
+def admin_backup_incremental():
+    return jsonify({"ok": True, **incremental_backup.status()})
 
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    zip_path = out_dir / f"RistoSmartFM_DB_{ts}.zip"
+def _backup_status():
+    st = backup_manager.status()
+    if st.get("status") == "done" and st.get("file"):
+        st["download_url"] = url_for("admin_backup_download", name=st["file"])
+    return st
 
-    files = [db_path]
-    for ext in (".wal", ".shm"):
-        p = Path(str(db_path) + ext)
-        if p.exists():
-            files.append(p)
+@app.post("/admin/backup/db")
+@require_admin
+def admin_backup_db():
+    """Avvia il backup in background; l'avanzamento è su /admin/backup/status."""
+    # solo POST con token CSRF: un GET cross-site non deve avviare backup e pulizia dei vecchi ZIP
+    tok = request.headers.get("X-CSRF-Token") or request.form.get("csrf_token", "")
+    if not validate_csrf(tok):
+        return "CSRF mancante o non valido", 400
 
-    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as z:
-        for p in files:
-            z.write(p, arcname=p.name)
+    backup_manager.start()
+    return jsonify({"ok": True, **_backup_status()}), 202
+
+@app.get("/admin/backup/status")
+@require_admin
+def admin_backup_status():
+    return jsonify({"ok": True, **_backup_status()})
 
-    deleted = _cleanup_backups()
-    app.logger.info("BACKUP CLEANUP: rimossi %s vecchi backup", deleted)
-    app.logger.info("BACKUP creato: %s", zip_path)
-    return send_file(str(zip_path), as_attachment=True, download_name=zip_path.name)
+@app.get("/admin/backup/download/<name>")
+@require_admin
+def admin_backup_download(name):
+    import re
+    if not re.fullmatch(r"RistoSmartFM_DB_\d{8}_\d{6}\.zip", name or ""):
+        return jsonify(ok=False, error="Nome file non valido"), 400
+    path = LOG_DIR / name
+    if not path.exists():
+        return jsonify(ok=False, error="Backup non trovato"), 404
+    return send_file(str(path.resolve()), as_attachment=True, download_name=name)
+
+def _create_db_backup():
+    """Backup sincrono (job dello scheduler): ZIP verificato in LOG_DIR, ritorna il Path."""
+    from pathlib import Path
+    return Path(backup_manager.run())
 
 @app.get("/admin/licenses/export.csv")
 @require_admin
 def admin_licenses_export_csv():
-    import csv
-    from io import StringIO, BytesIO    
+    # CSV in streaming (UTF-8 con BOM per Excel)
+    def rows(r):
+        return [r["id"], r["email"], r["license_key"], r["intestatario"],
+                r["scadenza"], r["attiva"], r["created_at"], (r["meta"] or "")]
 
-    # Prepara CSV in memoria (UTF-8 con BOM per Excel)
-    buf = StringIO()
-    w = csv.writer(buf)
-    w.writerow(["id","email","license_key","intestatario","scadenza","attiva","created_at","meta"])
-
-    with get_db() as conn:
-        rows = conn.execute("""
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return stream_csv_response(
+        """
             SELECT id, email, license_key, intestatario, scadenza, attiva, created_at, meta
             FROM licenze
             ORDER BY id DESC
-        """).fetchall()
-        for r in rows:
-            w.writerow([
-                r["id"], r["email"], r["license_key"], r["intestatario"],
-                r["scadenza"], r["attiva"], r["created_at"], (r["meta"] or "")
-            ])
-
-    csv_bytes = buf.getvalue().encode("utf-8-sig")  # BOM per Excel
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    return send_file(
-        BytesIO(csv_bytes),
-        as_attachment=True,
-        download_name=f"licenses_{ts}.csv",
-        mimetype="text/csv"
+        """, (),
+        ["id","email","license_key","intestatario","scadenza","attiva","created_at","meta"],
+        rows, f"licenses_{ts}.csv", bom=True,
     )
 
 # === ADMIN LICENZE: endpoint AJAX (send_email / mark_sent / revoke) ===========
@@ -2232,11 +2547,15 @@ def admin_license_revoke():
         return jsonify({"ok": False, "msg": "ID mancante"}), 400
 
     with get_db() as conn:
-        row = conn.execute("SELECT id FROM licenze WHERE id=?", (lic_id,)).fetchone()
+        row = conn.execute("SELECT id, email FROM licenze WHERE id=?", (lic_id,)).fetchone()
         if not row:
             return jsonify({"ok": False, "msg": "Licenza non trovata"}), 404
         conn.execute("DELETE FROM licenze WHERE id=?", (lic_id,))
         conn.commit()
+    if row["email"]:
+        license_cache.invalidate(email=row["email"])
+    else:
+        license_cache.invalidate()
 
     return jsonify({"ok": True})
 
@@ -2306,6 +2625,8 @@ def admin_licenses_cleanup():
             )
 
         conn.commit()
+    # cancellazione massiva: più utenti coinvolti → svuota tutta la cache
+    license_cache.invalidate()
 
     session["one_time_msg"] = f"Ripulito: tenute {kept}, eliminate {deleted}."
     return redirect(url_for("admin_licenses"))
@@ -2313,25 +2634,6 @@ def admin_licenses_cleanup():
 
 # =============================================================================
 
-@app.before_request
-def _daily_expiry_cron():
-    """
-    Esegue i promemoria scadenza al primo hit del giorno (qualsiasi pagina).
-    Salva un marker in backup/expiry_cron.txt per non ripetere.
-    """
-    try:        
-        mark_path = LOG_DIR / "expiry_cron.txt"
-        today = datetime.now().date().isoformat()
-        last = ""
-        if mark_path.exists():
-            last = (mark_path.read_text(encoding="utf-8") or "").strip()
-        if last != today:
-            summary = run_expiry_reminders()
-            mark_path.write_text(today, encoding="utf-8")
-            print("[EXPIRY CRON]", summary)
-    except Exception as e:
-        print("[EXPIRY CRON WARN]", e)
-
 @app.get("/admin/licenses/reminders")
 @require_admin
 def admin_licenses_reminders_now():
@@ -2437,7 +2739,9 @@ def _renew_license_core(key: str, email: str, months: int, actor: str):
         """, (key, email.strip().lower(), months, old.isoformat(), new_exp.isoformat(),
               actor, datetime.now().isoformat(timespec="seconds")))
 
-        return old, new_exp, lic
+    # dopo il commit (uscita dal with): la nuova scadenza è subito visibile
+    license_cache.invalidate(email=email)
+    return old, new_exp, lic
 
 def build_renew_url(key: str, email: str):
     tok = sign_renew_token(key, email, hours=48)
@@ -2557,9 +2861,9 @@ def api_incassi(anno, mese):
         cur.execute("""
             SELECT giorno, valore
               FROM incassi
-             WHERE user_id=? AND anno=? AND (mese=? OR mese=? OR mese=?)
+             WHERE user_id=? AND anno=? AND mese_num=?
              ORDER BY giorno
-        """, (uid, anno, m_norm, str(m_num), f"{m_num:02d}"))
+        """, (uid, anno, m_num))
         rows = [{"giorno": r["giorno"], "valore": r["valore"]} for r in cur.fetchall()]
     return jsonify(rows)
 
@@ -2577,8 +2881,8 @@ def api_get_spese(anno, mese):
         cur = conn.cursor()
         cur.execute("""
             SELECT categoria, valore FROM spese_fisse 
-            WHERE user_id=? AND anno=? AND (mese=? OR mese=? OR mese=?)
-        """, (uid, anno, m_norm, str(m_num), f"{m_num:02d}"))
+            WHERE user_id=? AND anno=? AND mese_num=?
+        """, (uid, anno, m_num))
         rows = [{"categoria": r["categoria"], "valore": r["valore"]} for r in cur.fetchall()]
 
     return jsonify(rows)
@@ -2612,9 +2916,11 @@ def salva_incasso():
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            INSERT OR REPLACE INTO incassi (user_id, anno, mese, giorno, valore)
-            VALUES (?, ?, ?, ?, ?)
-        """, (_uid(), anno, mese_norm, giorno, valore))
+            INSERT INTO incassi (user_id, anno, mese, mese_num, giorno, valore)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, anno, mese, giorno) DO UPDATE SET
+                valore = excluded.valore, mese_num = excluded.mese_num
+        """, (_uid(), anno, mese_norm, mese_num, giorno, valore))
         conn.commit()
 
     return jsonify({"success": True})
@@ -2653,13 +2959,89 @@ def salva_spesa():
     with get_db() as conn:
         cur = conn.cursor()
         cur.execute("""
-            INSERT OR REPLACE INTO spese_fisse (user_id, anno, mese, categoria, valore)
-            VALUES (?, ?, ?, ?, ?)
-        """, (_uid(), anno, mese_norm, categoria, valore))
+            INSERT INTO spese_fisse (user_id, anno, mese, mese_num, categoria, valore)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, anno, mese, categoria) DO UPDATE SET
+                valore = excluded.valore, mese_num = excluded.mese_num
+        """, (_uid(), anno, mese_norm, mese_num, categoria, valore))
         conn.commit()
 
     return jsonify({"success": True})
 
+# === API: Salvataggio massivo griglia mese (incassi giornalieri + spese fisse) ===
+def _parse_bulk_pairs(raw, key_name):
+    """Accetta {chiave: valore} oppure [{key_name: chiave, "valore": valore}, ...]."""
+    if isinstance(raw, dict):
+        return list(raw.items())
+    if isinstance(raw, list):
+        return [((it or {}).get(key_name), (it or {}).get("valore")) for it in raw if isinstance(it, dict)]
+    return []
+
+@app.post("/api/salva-mese")
+@require_login
+@require_license
+@require_csrf
+def salva_mese_bulk():
+    data = request.get_json(silent=True) or {}
+    try:
+        anno = int(data.get("anno"))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Anno non valido"}), 400
+
+    mese_norm, mese_num = _normalize_mese(data.get("mese") or "")
+    if not mese_num:
+        return jsonify({"error": "Mese non valido"}), 400
+    giorni_mese = calendar.monthrange(anno, mese_num)[1]
+
+    uid = _uid()
+    incassi_rows, spese_rows = [], []
+    try:
+        for giorno, valore in _parse_bulk_pairs(data.get("incassi"), "giorno"):
+            giorno, valore = int(giorno), float(valore)
+            if not 1 <= giorno <= giorni_mese:
+                return jsonify({"error": f"Giorno non valido: {giorno}"}), 400
+            incassi_rows.append((uid, anno, mese_norm, mese_num, giorno, valore))
+
+        for categoria, valore in _parse_bulk_pairs(data.get("spese"), "categoria"):
+            categoria = (categoria or "").strip().lower()
+            if categoria not in SPESI_FISSE_WHITELIST:
+                return jsonify({"error": f"Categoria non consentita: {categoria}"}), 400
+            spese_rows.append((uid, anno, mese_norm, mese_num, categoria, float(valore)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Dati numerici non validi"}), 400
+
+    conn = get_db()
+    with conn:  # una sola transazione / un solo commit per tutta la griglia
+        if incassi_rows:
+            conn.executemany("""
+                INSERT INTO incassi (user_id, anno, mese, mese_num, giorno, valore)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, anno, mese, giorno) DO UPDATE SET
+                    valore = excluded.valore, mese_num = excluded.mese_num
+            """, incassi_rows)
+        if spese_rows:
+            conn.executemany("""
+                INSERT INTO spese_fisse (user_id, anno, mese, mese_num, categoria, valore)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, anno, mese, categoria) DO UPDATE SET
+                    valore = excluded.valore, mese_num = excluded.mese_num
+            """, spese_rows)
+
+    # totali ricalcolati (riepilogo_mensile già aggiornato dai trigger)
+    m = load_ledger(conn, uid, anno, mese_num)[mese_num]
+    return jsonify({
+        "success": True,
+        "salvati": {"incassi": len(incassi_rows), "spese": len(spese_rows)},
+        "totali": {
+            "incassi": round(m.incassi, 2),
+            "spese_fisse": round(m.tot_spese_fisse, 2),
+            "stipendi": round(m.stipendi, 2),
+            "fatture": round(m.tot_fatture, 2),
+            "tasse": round(m.tot_tasse, 2),
+            "spese": round(m.tot_spese, 2),
+        },
+    })
+
 from flask import abort
 
 def _uid():
@@ -2668,25 +3050,6 @@ def _uid():
         abort(401)
     return int(uid)
 
-def _normalize_mese(m: str):
-    m = (m or "").strip().lower()
-    mesi = ["gennaio","febbraio","marzo","aprile","maggio","giugno",
-            "luglio","agosto","settembre","ottobre","novembre","dicembre"]
-    aliases = {
-        "gen":"gennaio","feb":"febbraio","mar":"marzo","apr":"aprile","mag":"maggio","giu":"giugno",
-        "lug":"luglio","ago":"agosto","set":"settembre","sett":"settembre","sep":"settembre",
-        "ott":"ottobre","nov":"novembre","dic":"dicembre"
-    }
-    if m.isdigit():
-        i = int(m)
-        if 1 <= i <= 12:
-            return mesi[i-1], i
-    if m in aliases:
-        m = aliases[m]
-    if m in mesi:
-        return m, mesi.index(m)+1
-    return m, None
-
 # ---------------------------------------------------------------------------------------------------------------
 
 # === API: Clienti ===
@@ -3135,9 +3498,6 @@ def api_stipendi_qr(personale_id):
     if netto <= 0:
         return jsonify(error="Importo netto non disponibile"), 400
 
-    import qrcode, base64
-    from io import BytesIO
-
     iban = (persona["iban"] or "").strip().replace(" ", "").upper()
     if not iban or len(iban) < 15:
         return jsonify(error="IBAN non valido"), 400
@@ -3148,31 +3508,11 @@ def api_stipendi_qr(personale_id):
 
     remittance = f"Stipendio {periodo} - {categoria}"[:140]
 
-    # 📌 Schema EPC QR SEPA (EPC069-12 v2.2)
-    lines = [
-        "BCD",              # Service tag
-        "002",              # Version
-        "1",                # UTF-8
-        "SCT",              # SEPA Credit Transfer
-        "",                 # BIC (opzionale, lasciato vuoto)
-        nome,               # Beneficiario (max 70)
-        iban,               # IBAN
-        f"EUR{netto:.2f}",  # Importo
-        "",                 # Purpose (opzionale)
-        remittance          # Remittance info (descrizione pagamento)
-    ]
-
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data("\n".join(lines))
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    qr_b64 = base64.b64encode(buf.getvalue()).decode("ascii")
+    # 📌 Schema EPC QR SEPA (EPC069-12) — BIC facoltativo
+    qr_image = qr_cache.data_uri(build_epc_payload(iban, nome, netto, remittance))
 
     return jsonify({
-        "qr_image": f"data:image/png;base64,{qr_b64}",
+        "qr_image": qr_image,
         "periodo": periodo,
         "nome": nome,
         "categoria": categoria,
@@ -3180,124 +3520,178 @@ def api_stipendi_qr(personale_id):
         "iban": iban
     }) 
 
+# --- QR STIPENDI DEL MESE (tutti i non pagati in un colpo solo) ---
+def _payroll_qr_zip(voci, esclusi):
+    """ZIP con un PNG per dipendente (+ esclusi.txt se qualcuno è stato saltato)."""
+    import zipfile, re
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for n, v in enumerate(voci, 1):
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", v["nome"]).strip("_") or "dipendente"
+            z.writestr(f"{n:02d}_{slug}.png", v["png"])
+        if esclusi:
+            z.writestr("esclusi.txt", "\n".join(f"{e['nome']}: {e['motivo']}" for e in esclusi))
+    buf.seek(0)
+    return buf
+
+@app.get("/api/stipendi/qr-mese/<int:anno>/<mese>")
+@require_login
+@require_license
+def api_stipendi_qr_mese(anno, mese):
+    """QR SEPA di tutti gli stipendi non pagati del mese, in un unico PDF (default) o ZIP."""
+    mese_slug, mese_num = _normalize_mese(mese)
+    if not mese_num:
+        return jsonify(error="Mese non valido"), 400
+    formato = (request.args.get("formato") or "pdf").lower()
+    if formato not in ("pdf", "zip"):
+        return jsonify(error="Formato non valido (pdf|zip)"), 400
+
+    rows = get_db().execute("""
+        SELECT p.nome, p.ruolo, p.iban, s.netto
+        FROM stipendi_personale s
+        JOIN personale p ON p.id = s.personale_id AND p.user_id = s.user_id
+        WHERE s.user_id = ? AND s.anno = ? AND CAST(s.mese AS INTEGER) = ?
+          AND COALESCE(s.stato_pagamento, 'non_pagato') <> 'pagato'
+        ORDER BY p.nome
+    """, (_uid(), anno, mese_num)).fetchall()
+    if not rows:
+        return jsonify(error="Nessuno stipendio da pagare nel mese"), 404
+
+    periodo = _format_periodo(mese_slug, anno)
+    voci, esclusi = [], []
+    for r in rows:
+        nome = (r["nome"] or "Dipendente").strip()[:70]
+        iban = (r["iban"] or "").strip().replace(" ", "").upper()
+        netto = float(r["netto"] or 0)
+        if not iban or len(iban) < 15:
+            esclusi.append({"nome": nome, "motivo": "IBAN non valido"})
+            continue
+        if netto <= 0:
+            esclusi.append({"nome": nome, "motivo": "Importo netto non disponibile"})
+            continue
+        categoria = (r["ruolo"] or "Altro").strip()
+        causale = f"Stipendio {periodo} - {categoria}"[:140]
+        voci.append({"nome": nome, "categoria": categoria, "iban": iban, "netto": round(netto, 2),
+                     "causale": causale, "payload": build_epc_payload(iban, nome, netto, causale)})
+
+    try:
+        pngs = render_many([v["payload"] for v in voci], qr_cache,
+                           max_workers=app.config["QR_POOL_WORKERS"],
+                           timeout=app.config["QR_BATCH_TIMEOUT"])
+    except TimeoutError as e:
+        app.logger.warning("QR stipendi mese: %s", e)
+        return jsonify(error="Generazione QR troppo lenta, riprova"), 503
+    except QRPoolBroken as e:
+        app.logger.error("QR stipendi mese: %s", e)
+        return jsonify(error="Generazione QR interrotta, riprova tra poco"), 503
+    for v, png in zip(voci, pngs):
+        v["png"] = png
+
+    nome_file = f"qr_stipendi_{anno}_{mese_num:02d}"
+    if formato == "zip":
+        return send_file(_payroll_qr_zip(voci, esclusi), mimetype="application/zip",
+                         as_attachment=True, download_name=f"{nome_file}.zip")
+    pdf, err = render_pdf("payroll_qr", voci, esclusi, periodo)
+    if err:
+        return err
+    return send_file(BytesIO(pdf), mimetype="application/pdf",
+                     as_attachment=True, download_name=f"{nome_file}.pdf")
+
 from flask import Response
 import csv
 import io
 
-@app.get("/api/stipendi/export/csv/<int:anno>")
-@require_login
-@require_license
-def export_stipendi_csv(anno):
-    uid = _uid()
-    output = io.StringIO()
-    writer = csv.writer(output)
+def stream_csv_response(sql, params, header, row_fn, filename, bom=False, tee=None):
+    """Response CSV generata mentre si scorre il cursore (fetchmany a blocchi).
 
-    # Intestazione
-    writer.writerow([
-        "Nome dipendente", "Ruolo", "Mese",
-        "Lordo", "Netto", "Contributi", "Totale", "Stato pagamento"
-    ])
+    La connessione è presa dal pool apposta per il generatore (la risposta
+    viene consumata dopo il teardown della richiesta) e restituita a fine stream.
+    tee: PendingExport opzionale (export_cache.open_write) che riceve gli stessi
+    blocchi; salvato in cache solo se lo stream arriva in fondo.
+    """
+    pool = db_pool()
+    chunk_rows = app.config["CSV_STREAM_CHUNK"]
 
-    with get_db() as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        rows = cur.execute("""
-            SELECT p.nome, p.ruolo, sp.mese,
-                   sp.lordo, sp.netto, sp.contributi, sp.totale, sp.stato_pagamento
-            FROM stipendi_personale sp
-            JOIN personale p ON p.id = sp.personale_id AND p.user_id = sp.user_id
-            WHERE sp.user_id = ? AND sp.anno = ?
-            ORDER BY p.nome, sp.mese
-        """, (uid, anno)).fetchall()
+    def generate():
+        conn = pool.acquire()
+        done = False
+        try:
+            cur = conn.execute(sql, params)
+            for chunk in iter_csv(header, (row_fn(r) for r in iter_rows(cur, chunk_rows)),
+                                  bom=bom, chunk_rows=chunk_rows):
+                if tee is not None:
+                    tee.write(chunk)
+                yield chunk
+            done = True
+        finally:
+            conn.close()
+            if tee is not None and done:
+                tee.commit()
+            elif tee is not None:
+                tee.abort()
 
-    for r in rows:
-        writer.writerow([
-            r["nome"],
-            r["ruolo"],
-            MONTH_NUM_TO_SLUG.get(r["mese"], f"Mese {r['mese']}").capitalize(),
-            f"{r['lordo']:.2f}",
-            f"{r['netto']:.2f}",
-            f"{r['contributi']:.2f}",
-            f"{r['totale']:.2f}",
-            "Pagato" if r["stato_pagamento"] == "pagato" else "Non pagato"
-        ])
-
-    output.seek(0)
-    filename = f"stipendi_{anno}.csv"
     return Response(
-        output.getvalue(),
+        generate(),
         mimetype="text/csv",
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
+# Righe comuni agli export stipendi (CSV e PDF); tabelle sorgente per la cache export
+_STIPENDI_TABLES = ("personale", "stipendi_personale")
+_STIPENDI_EXPORT_SQL = """
+    SELECT p.nome, p.ruolo, sp.mese,
+           sp.lordo, sp.netto, sp.contributi, sp.totale, sp.stato_pagamento
+    FROM stipendi_personale sp
+    JOIN personale p ON p.id = sp.personale_id AND p.user_id = sp.user_id
+    WHERE sp.user_id = ? AND sp.anno = ?
+    ORDER BY p.nome, sp.mese
+"""
+
+def _stipendi_export_row(r):
+    return [
+        r["nome"],
+        r["ruolo"],
+        MONTH_NUM_TO_SLUG.get(r["mese"], f"Mese {r['mese']}").capitalize(),
+        f"{r['lordo']:.2f}",
+        f"{r['netto']:.2f}",
+        f"{r['contributi']:.2f}",
+        f"{r['totale']:.2f}",
+        "Pagato" if r["stato_pagamento"] == "pagato" else "Non pagato"
+    ]
+
+@app.get("/api/stipendi/export/csv/<int:anno>")
+@require_login
+@require_license
+def export_stipendi_csv(anno):
+    uid = _uid()
+    params = {"anno": anno}
+    path, version = cached_export(uid, "stipendi_csv", params, _STIPENDI_TABLES, "csv")
+    if path is not None:
+        return send_file(path, mimetype="text/csv", as_attachment=True, download_name=f"stipendi_{anno}.csv")
+    # cache mancante: si manda in streaming e intanto si scrive il file per la prossima volta
+    return stream_csv_response(
+        _STIPENDI_EXPORT_SQL, (uid, anno),
+        ["Nome dipendente", "Ruolo", "Mese", "Lordo", "Netto", "Contributi", "Totale", "Stato pagamento"],
+        _stipendi_export_row, f"stipendi_{anno}.csv",
+        tee=export_cache.open_write(uid, "stipendi_csv", params, version, "csv"),
+    )
+
 @app.get("/api/stipendi/export/pdf/<int:anno>")
 @require_login
 @require_license
 def export_stipendi_pdf(anno):
     uid = _uid()
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
-
-    title = f"Riepilogo stipendi - Anno {anno}"
-    c.setFont("Helvetica-Bold", 14)
-    c.drawString(2 * cm, height - 2 * cm, title)
-
-    # Header colonne
-    headers = [
-        "Nome", "Ruolo", "Mese", "Lordo", "Netto", "Contributi", "Totale", "Stato"
-    ]
-    y = height - 3 * cm
-    line_height = 0.6 * cm
-
-    c.setFont("Helvetica-Bold", 10)
-    for i, col in enumerate(headers):
-        c.drawString((1 + i * 2.5) * cm, y, col)
-
-    # Riga dati
-    y -= line_height
-    c.setFont("Helvetica", 9)
-
-    with get_db() as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        rows = cur.execute("""
-            SELECT p.nome, p.ruolo, sp.mese,
-                   sp.lordo, sp.netto, sp.contributi, sp.totale, sp.stato_pagamento
-            FROM stipendi_personale sp
-            JOIN personale p ON p.id = sp.personale_id AND p.user_id = sp.user_id
-            WHERE sp.user_id = ? AND sp.anno = ?
-            ORDER BY p.nome, sp.mese
-        """, (uid, anno)).fetchall()
-
-    for r in rows:
-        if y < 2 * cm:
-            c.showPage()
-            y = height - 3 * cm
-            c.setFont("Helvetica-Bold", 10)
-            for i, col in enumerate(headers):
-                c.drawString((1 + i * 2.5) * cm, y, col)
-            y -= line_height
-            c.setFont("Helvetica", 9)
-
-        row = [
-            r["nome"],
-            r["ruolo"],
-            MONTH_NUM_TO_SLUG.get(r["mese"], f"Mese {r['mese']}").capitalize(),
-            f"{r['lordo']:.2f}",
-            f"{r['netto']:.2f}",
-            f"{r['contributi']:.2f}",
-            f"{r['totale']:.2f}",
-            "Pagato" if r["stato_pagamento"] == "pagato" else "Non pagato"
-        ]
-        for i, value in enumerate(row):
-            c.drawString((1 + i * 2.5) * cm, y, str(value))
-        y -= line_height
-
-    c.save()
-    buffer.seek(0)
+    params = {"anno": anno}
+    path, version = cached_export(uid, "stipendi_pdf", params, _STIPENDI_TABLES, "pdf")
+    if path is None:
+        with get_db() as conn:
+            rows = conn.execute(_STIPENDI_EXPORT_SQL, (uid, anno)).fetchall()
+        pdf, err = render_pdf("stipendi", anno, [_stipendi_export_row(r) for r in rows])
+        if err:
+            return err
+        path = export_cache.store(uid, "stipendi_pdf", params, version, "pdf", pdf)
     filename = f"stipendi_{anno}.pdf"
-    return send_file(buffer, mimetype='application/pdf', as_attachment=True, download_name=filename)
+    return send_file(path, mimetype='application/pdf', as_attachment=True, download_name=filename)
 
 # --------FINE --- API --- STIPENDI --- 
 
@@ -3436,16 +3830,18 @@ def api_dettaglio_fornitori():
                 SUM(importo) as totale_mensile
             FROM fatture
             WHERE user_id = ? 
-              AND CAST(strftime('%Y', data_inserimento) AS INTEGER) = ?
+              AND data_inserimento >= ? AND data_inserimento < ?
             GROUP BY fornitore, categoria, mese_num
             ORDER BY fornitore, categoria
         """
-        cur.execute(query, [uid, anno])
+        cur.execute(query, [uid, *year_bounds(anno)])
         rows = cur.fetchall()
 
         # Costruisci struttura dati
         result = {}
         for row in rows:
+            if not row["mese_num"]:
+                continue  # data non ISO: nessun mese ricavabile
             key = (row["fornitore"], row["categoria"])
             if key not in result:
                 result[key] = {
@@ -3471,6 +3867,30 @@ USER_FILES_DIR = app.config.get(
 )
 os.makedirs(USER_FILES_DIR, exist_ok=True)
 
+# Export già generati (CSV/PDF) in USER_FILES_DIR/<uid>/exports, con limiti per utente
+app.config["EXPORT_CACHE_MAX_BYTES"] = int(os.getenv("EXPORT_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+app.config["EXPORT_CACHE_MAX_AGE_DAYS"] = float(os.getenv("EXPORT_CACHE_MAX_AGE_DAYS", "30"))
+export_cache = ExportCache(
+    USER_FILES_DIR,
+    max_bytes=app.config["EXPORT_CACHE_MAX_BYTES"],
+    max_age=app.config["EXPORT_CACHE_MAX_AGE_DAYS"] * 86400,
+    # copie con timestamp del vecchio export enti: le scriveva in user_files/<uid>
+    # relativo alla cartella di lavoro, non sotto USER_FILES_DIR
+    legacy_globs=("enti_tasse_*.pdf",),
+    legacy_root=os.path.abspath(app.config.get("USER_FILES_DIR", "user_files")),
+)
+
+def cached_export(uid, kind, params, tables, ext):
+    """(path o None, versione dati): path se lo stesso export è già su disco."""
+    with get_db() as conn:
+        version = data_version(conn, uid, tables)
+    return export_cache.lookup(uid, kind, params, version, ext), version
+
+@app.get("/admin/export-cache")
+@require_admin
+def admin_export_cache_stats():
+    return jsonify({"ok": True, **export_cache.stats()})
+
 
 @app.post("/api/fornitori/<int:fid>/upload_pdf")
 @require_login
@@ -3548,9 +3968,9 @@ def api_get_fatture():
                    data_scadenza, importo, stato, numero
             FROM fatture
             WHERE user_id = ?
-              AND CAST(strftime('%Y', data_inserimento) AS INTEGER) = ?
-            ORDER BY date(data_inserimento) DESC
-        """, (uid, anno)).fetchall()
+              AND data_inserimento >= ? AND data_inserimento < ?
+            ORDER BY data_inserimento DESC
+        """, (uid, *year_bounds(anno))).fetchall()
     return jsonify([dict(r) for r in rows])
 
 @app.route("/dettaglio_fornitori")
@@ -3718,20 +4138,7 @@ def api_fattura_qr(fid):
     causale = f"Fattura {row['numero'] or row['id']} - {row['categoria'] or ''}"
 
     # --- Stringa EPC QR (standard europeo) ---
-    sepa_string = f"""BCD
-002
-1
-SCT
-{bic}
-{beneficiario}
-{iban}
-EUR{importo}
-{causale}"""
-
-    import qrcode, base64, io
-    buf = io.BytesIO()
-    qrcode.make(sepa_string.strip()).save(buf, format="PNG")
-    qr_b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+    sepa_string = build_epc_payload(iban, beneficiario, row["importo"], causale, bic)
 
     return jsonify({
         "ok": True,
@@ -3743,8 +4150,8 @@ EUR{importo}
         "data_scadenza": row["data_scadenza"],
         "iban": iban,
         "bic": bic,
-        "sepa": sepa_string.strip(),
-        "qr_image": f"data:image/png;base64,{qr_b64}"
+        "sepa": sepa_string,
+        "qr_image": qr_cache.data_uri(sepa_string)
     })
 
 @app.route("/api/spese_fatture/<int:anno>/<mese>")
@@ -3778,14 +4185,13 @@ def api_spese_fatture(anno, mese):
             FROM fatture
             WHERE 
                 user_id = ? 
-                AND CAST(strftime('%Y', data_inserimento) AS INTEGER) = ?
-                AND CAST(strftime('%m', data_inserimento) AS INTEGER) = ?
+                AND data_inserimento >= ? AND data_inserimento < ?
             GROUP BY cat
         """
 
         with get_db() as conn:
             cur = conn.cursor()
-            cur.execute(query, [user_id, anno, mese_num])
+            cur.execute(query, [user_id, *month_bounds(anno, mese_num)])
             rows = cur.fetchall()
 
         result = {}
@@ -3818,12 +4224,9 @@ def api_fatture_scadenze(anno: int):
                    data_scadenza, importo, stato, numero
             FROM fatture
             WHERE user_id = ?
-              AND (
-                   CAST(strftime('%Y', data_scadenza) AS INTEGER) = ?
-                   OR CAST(strftime('%Y', data_scadenza) AS INTEGER) = ?
-              )
-            ORDER BY date(data_scadenza) ASC
-        """, (uid, anno, anno_prec)).fetchall()
+              AND data_scadenza >= ? AND data_scadenza < ?
+            ORDER BY data_scadenza ASC
+        """, (uid, year_bounds(anno_prec)[0], year_bounds(anno)[1])).fetchall()
     return jsonify([dict(r) for r in rows])
     
 # ----------------------#-----------------------------------------------------------------------------
@@ -4179,27 +4582,10 @@ def api_tassa_qr(t_id):
         causale = f"{row['causale']} - {t_id}"
 
         # Stringa EPC QR Code
-        sepa_string = f"""BCD
-002
-1
-SCT
-{bic}
-{beneficiario}
-{iban}
-EUR{importo}
-
-{causale}"""
-
-        qr = qrcode.QRCode(version=1, box_size=10, border=4)
-        qr.add_data(sepa_string.strip())
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white")
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        qr_b64 = base64.b64encode(buf.getvalue()).decode("ascii")
+        sepa_string = build_epc_payload(iban, beneficiario, row["importo"], causale, bic)
 
         return jsonify({
-            "qr_image": f"data:image/png;base64,{qr_b64}",
+            "qr_image": qr_cache.data_uri(sepa_string),
             "importo": importo,
             "iban": iban,
             "bic": bic,
@@ -4226,7 +4612,6 @@ def conferma_pagamento(tassa_id):
 
 # --- APP PER PDF PAGAMENTO-TASSE ---
 
-from fpdf import FPDF
 from io import BytesIO
 from datetime import datetime
 from flask import request, jsonify, send_file
@@ -4265,36 +4650,25 @@ def scarica_pdf_pagamenti_tasse():
         params.append(stato)
 
     query += " ORDER BY date(t.scadenza) DESC, t.id DESC"
+    nome_file = f"pagamenti_tasse_{stato or 'tutte'}_{datetime.today().strftime('%Y%m%d')}.pdf"
 
-    with get_db() as conn:
-        conn.row_factory = sqlite3.Row
-        tasse = conn.execute(query, params).fetchall()
-
-    if not tasse:
-        return jsonify(success=False, error="❌ Non hai tasse in questa categoria"), 404
-
-    # Generazione PDF
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", size=12)
-    pdf.cell(0, 10, "Dettaglio Tasse", ln=True, align="C")
-    pdf.ln(5)
-
-    for idx, t in enumerate(tasse, start=1):
-        pdf.set_font("Arial", "B", 11)
-        pdf.multi_cell(0, 8, f"{idx}) Ente: {t['ente_nome']}")
-        pdf.set_font("Arial", "", 10)
-        pdf.multi_cell(0, 6, f"Causale: {t['causale']}")
-        pdf.multi_cell(0, 6, f"Scadenza: {t['scadenza']} - Inserita: {t['data_inserimento']}")
-        pdf.multi_cell(0, 6, f"Importo: EUR {t['importo']:.2f} | Stato: {t['stato'].capitalize()}")
-        pdf.ln(6)
-
-    pdf_bytes = pdf.output(dest="S").encode("latin-1")
-    output = BytesIO(pdf_bytes)
+    cache_params = {"sql": query, "params": params}
+    path, version = cached_export(uid, "pagamenti_tasse_pdf", cache_params, ("tasse", "ente"), "pdf")
+    if path is None:
+        with get_db() as conn:
+            conn.row_factory = sqlite3.Row
+            tasse = conn.execute(query, params).fetchall()
 
-    nome_file = f"pagamenti_tasse_{stato or 'tutte'}_{datetime.today().strftime('%Y%m%d')}.pdf"
+        if not tasse:
+            return jsonify(success=False, error="❌ Non hai tasse in questa categoria"), 404
+
+        # Generazione PDF (process pool)
+        pdf_bytes, err = render_pdf("pagamenti_tasse", [dict(t) for t in tasse])
+        if err:
+            return err
+        path = export_cache.store(uid, "pagamenti_tasse_pdf", cache_params, version, "pdf", pdf_bytes)
 
-    return send_file(output, mimetype="application/pdf", as_attachment=True, download_name=nome_file)
+    return send_file(path, mimetype="application/pdf", as_attachment=True, download_name=nome_file)
 
 # --- FINE APP PER PDF PAGAMENTO-TASSE
 
@@ -4409,30 +4783,17 @@ def api_incassi_annuali(anno):
     with get_db() as conn:
         cur = conn.cursor()
         
-        # Calcola totale incassi per ogni mese
+        # Calcola totale incassi per ogni mese (mese_num: ordinamento sull'indice)
         cur.execute("""
-            SELECT mese, SUM(valore) as valore 
+            SELECT mese_num, SUM(valore) as valore 
             FROM incassi 
-            WHERE user_id = ? AND anno = ?
-            GROUP BY mese 
-            ORDER BY CASE 
-                WHEN mese = 'gennaio' THEN 1
-                WHEN mese = 'febbraio' THEN 2
-                WHEN mese = 'marzo' THEN 3
-                WHEN mese = 'aprile' THEN 4
-                WHEN mese = 'maggio' THEN 5
-                WHEN mese = 'giugno' THEN 6
-                WHEN mese = 'luglio' THEN 7
-                WHEN mese = 'agosto' THEN 8
-                WHEN mese = 'settembre' THEN 9
-                WHEN mese = 'ottobre' THEN 10
-                WHEN mese = 'novembre' THEN 11
-                WHEN mese = 'dicembre' THEN 12
-            END
+            WHERE user_id = ? AND anno = ? AND mese_num IS NOT NULL
+            GROUP BY mese_num 
+            ORDER BY mese_num
         """, (user_id, anno))
         
         rows = cur.fetchall()
-        return jsonify([dict(r) for r in rows])
+        return jsonify([{"mese": mese_nome(r["mese_num"]), "valore": r["valore"]} for r in rows])
 
 
 # === API: Spese Annuali ===
@@ -4446,81 +4807,25 @@ def api_spese_annuali(anno):
     with get_db() as conn:
         cur = conn.cursor()
         
-        # Calcola totale spese fisse per ogni mese
-        cur.execute("""
-            SELECT mese, SUM(valore) as valore 
-            FROM spese_fisse 
-            WHERE user_id = ? AND anno = ?
-            GROUP BY mese 
-            ORDER BY CASE 
-                WHEN mese = 'gennaio' THEN 1
-                WHEN mese = 'febbraio' THEN 2
-                WHEN mese = 'marzo' THEN 3
-                WHEN mese = 'aprile' THEN 4
-                WHEN mese = 'maggio' THEN 5
-                WHEN mese = 'giugno' THEN 6
-                WHEN mese = 'luglio' THEN 7
-                WHEN mese = 'agosto' THEN 8
-                WHEN mese = 'settembre' THEN 9
-                WHEN mese = 'ottobre' THEN 10
-                WHEN mese = 'novembre' THEN 11
-                WHEN mese = 'dicembre' THEN 12
-            END
-        """, (user_id, anno))
-        
-        spese_fisse = cur.fetchall()
-        
-        # Calcola totale spese fatture per ogni mese
-        cur.execute("""
-            SELECT mese, SUM(valore) as valore 
-            FROM spese_fatture 
-            WHERE user_id = ? AND anno = ?
-            GROUP BY mese 
-            ORDER BY CASE 
-                WHEN mese = 'gennaio' THEN 1
-                WHEN mese = 'febbraio' THEN 2
-                WHEN mese = 'marzo' THEN 3
-                WHEN mese = 'aprile' THEN 4
-                WHEN mese = 'maggio' THEN 5
-                WHEN mese = 'giugno' THEN 6
-                WHEN mese = 'luglio' THEN 7
-                WHEN mese = 'agosto' THEN 8
-                WHEN mese = 'settembre' THEN 9
-                WHEN mese = 'ottobre' THEN 10
-                WHEN mese = 'novembre' THEN 11
-                WHEN mese = 'dicembre' THEN 12
-            END
-        """, (user_id, anno))
-        
-        spese_fatture = cur.fetchall()
-        
-        # Combina i totali per mese
+        # Totale per mese di spese fisse + spese fatture, raggruppato su mese_num
         totali_mensili = {}
-        
-        # Aggiungi spese fisse
-        for row in spese_fisse:
-            mese = row['mese']
-            if mese not in totali_mensili:
-                totali_mensili[mese] = 0
-            totali_mensili[mese] += row['valore']
-        
-        # Aggiungi spese fatture
-        for row in spese_fatture:
-            mese = row['mese']
-            if mese not in totali_mensili:
-                totali_mensili[mese] = 0
-            totali_mensili[mese] += row['valore']
+        for table in ("spese_fisse", "spese_fatture"):
+            cur.execute(f"""
+                SELECT mese_num, SUM(valore) as valore 
+                FROM {table} 
+                WHERE user_id = ? AND anno = ? AND mese_num IS NOT NULL
+                GROUP BY mese_num
+            """, (user_id, anno))
+            for row in cur.fetchall():
+                n = row['mese_num']
+                totali_mensili[n] = totali_mensili.get(n, 0) + row['valore']
         
         # Formatta il risultato
         result = []
-        ordine_mesi = ['gennaio', 'febbraio', 'marzo', 'aprile', 'maggio', 'giugno',
-                      'luglio', 'agosto', 'settembre', 'ottobre', 'novembre', 'dicembre']
-        
-        for mese in ordine_mesi:
-            valore = totali_mensili.get(mese, 0)
+        for n, mese in MONTH_NUM_TO_SLUG.items():
             result.append({
                 'mese': mese,
-                'valore': valore
+                'valore': totali_mensili.get(n, 0)
             })
         
         return jsonify(result)
@@ -4535,76 +4840,24 @@ def api_spese_annuali(anno):
 def api_percentuali_dati(anno):
     """
     Calcola i totali e le percentuali mensili solo per l'anno selezionato.
-    Tutte le query filtrano rigorosamente per user_id e anno.
+    I totali arrivano dal libro mastro annuale (utils.ledger), lo stesso di /api/annuale.
     """
     uid = _uid()
-    db = get_db()
+    ledger = load_ledger(get_db(), uid, anno)
 
-    mesi = [
-        "gennaio","febbraio","marzo","aprile","maggio","giugno",
-        "luglio","agosto","settembre","ottobre","novembre","dicembre"
-    ]
+    # spese fisse: solo le categorie ammesse (null-safe), il ledger le ha tutte
+    spese_fisse_ok = ("canone", "finanziamento1", "finanziamento2", "finanziamento-altro")
     risultato = {}
 
-    for num_mese, mese in enumerate(mesi, start=1):
-
-        # 1️⃣ INCASSI — usa colonne anno e mese (no data_inserimento)
-        q_incassi = """
-            SELECT COALESCE(SUM(valore), 0) AS totale
-            FROM incassi
-            WHERE user_id = ? AND anno = ? AND LOWER(COALESCE(mese,'')) = ?
-        """
-        totale_incasso = db.execute(q_incassi, (uid, anno, mese)).fetchone()["totale"] or 0.0
-
-        # 2️⃣ SPESE FISSE — anno + mese + categorie ammesse (null-safe)
-        spese_fisse_ok = ("canone", "finanziamento1", "finanziamento2", "finanziamento-altro")
-        placeholders = ",".join("?" * len(spese_fisse_ok))
-        q_fisse = f"""
-            SELECT COALESCE(SUM(valore), 0) AS totale
-            FROM spese_fisse
-            WHERE user_id = ?
-            AND anno = ?
-            AND LOWER(COALESCE(mese,'')) = ?
-            AND LOWER(COALESCE(categoria,'')) IN ({placeholders})
-        """
-        totale_spese_fisse = db.execute(q_fisse, [uid, anno, mese, *spese_fisse_ok]).fetchone()["totale"] or 0.0
-
-
-        # 3️⃣ TASSE — filtrate per anno e mese da campo scadenza
-        q_tasse = """
-            SELECT COALESCE(SUM(importo), 0) AS totale
-            FROM tasse
-            WHERE user_id = ?
-              AND CAST(strftime('%Y', scadenza) AS INTEGER) = ?
-              AND CAST(strftime('%m', scadenza) AS INTEGER) = ?
-        """
-        totale_tasse = db.execute(q_tasse, (uid, anno, num_mese)).fetchone()["totale"] or 0.0
-
-        # 4️⃣ STIPENDI PERSONALE — anno e mese numerici
-        q_stip = """
-            SELECT COALESCE(SUM(lordo), 0) AS totale
-            FROM stipendi_personale
-            WHERE user_id = ? AND anno = ? AND mese = ?
-        """
-        totale_stipendi = db.execute(q_stip, (uid, anno, num_mese)).fetchone()["totale"] or 0.0
-
-        # 5️⃣ FATTURE — anno e mese da data_inserimento (questa tabella ce l'ha)
-        q_fatture = """
-            SELECT categoria, COALESCE(SUM(importo), 0) AS valore
-            FROM fatture
-            WHERE user_id = ?
-              AND CAST(strftime('%Y', data_inserimento) AS INTEGER) = ?
-              AND CAST(strftime('%m', data_inserimento) AS INTEGER) = ?
-            GROUP BY categoria
-        """
-        spese_fatture = {
-            r["categoria"]: r["valore"]
-            for r in db.execute(q_fatture, (uid, anno, num_mese)).fetchall()
-        }
+    for m in ledger:
+        mese = MONTH_NUM_TO_SLUG[m.mese_num]
+        totale_incasso = m.incassi
+        totale_spese_fisse = sum(v for cat, v in m.spese_fisse.items() if (cat or "").lower() in spese_fisse_ok)
+        totale_tasse = m.tot_tasse
+        totale_stipendi = m.stipendi
 
         # Totali e percentuali
-        totale_spese_fatture = sum(spese_fatture.values())
-        totale_spese = totale_spese_fisse + totale_tasse + totale_stipendi + totale_spese_fatture
+        totale_spese = totale_spese_fisse + totale_tasse + totale_stipendi + m.tot_fatture
         base = totale_incasso or 1
 
         risultato[mese] = {
@@ -4616,7 +4869,7 @@ def api_percentuali_dati(anno):
             "totale_incasso": totale_incasso
         }
 
-        for cat, val in spese_fatture.items():
+        for cat, val in m.fatture.items():
             risultato[mese]["spese_fatture"]["categorie"][cat] = {
                 "valore": val,
                 "percentuale": (val / base * 100)
@@ -4684,7 +4937,11 @@ def api_newsletter_send():
                     "body": body_personale
                 })
 
-            email_results = send_emails_personalized(items) if items else []
+            outbox_ids = queue_emails(items, tag="newsletter", user_id=session["user_id"]) if items else []
+            email_results = [
+                {"email": it["email"], "ok": True, "queued": True, "id": oid}
+                for it, oid in zip(items, outbox_ids)
+            ]
 
             # LOG email
             try:
@@ -4698,7 +4955,7 @@ def api_newsletter_send():
                         "to_email": it["email"],
                         "subject": it["subject"],
                         "body": it["body"],
-                        "ok": bool(rec.get("ok")),
+                        "ok": "queued" if rec.get("queued") else bool(rec.get("ok")),
                         "error": rec.get("err", "")
                     })
                 _log_rows(LOG_EMAIL_CSV, ["ts","to_email","subject","body","ok","error"], rows)
@@ -4752,8 +5009,20 @@ def api_newsletter_send():
     return jsonify({
         "ok": True,
         "email_results": email_results,
+        "outbox_ids": [r["id"] for r in email_results if r.get("id")],
         "wa_links": wa_links
     })
+
+@app.get("/api/outbox/status")
+@require_login
+def api_outbox_status():
+    """Stato di consegna delle email accodate dall'utente (?ids=1,2,3 per il dettaglio)."""
+    raw = (request.args.get("ids") or "").strip()
+    try:
+        ids = [int(x) for x in raw.split(",") if x.strip()][:500]
+    except ValueError:
+        return jsonify({"ok": False, "msg": "ids non validi"}), 400
+    return jsonify({"ok": True, **outbox_status(get_db(), ids=ids, user_id=_uid())})
  
     
 #=== ALTRE  PAGINE PLACEHOLDER ===
@@ -4883,70 +5152,22 @@ def situazione_annuale(anno):
 @require_license
 def api_annuale(anno):
     uid = _uid()
-    db = get_db()
-
-    # Mesi in formato testuale (come salvati nel DB)
-    mesi = [
-        "gennaio","febbraio","marzo","aprile","maggio","giugno",
-        "luglio","agosto","settembre","ottobre","novembre","dicembre"
-    ]
+    ledger = load_ledger(get_db(), uid, anno)
 
     dati = []
     tot_inc = tot_spe = 0.0
 
-    # Incassi, spese fisse, stipendi, fatture e tasse per ogni mese
-    for m in mesi:
-        # 1. Incassi
-        inc = db.execute("""
-            SELECT COALESCE(SUM(valore), 0)
-            FROM incassi
-            WHERE user_id=? AND anno=? AND LOWER(mese)=?
-        """, (uid, anno, m.lower())).fetchone()[0] or 0.0
-
-        # 2. Spese Fisse
-        spese_fisse = db.execute("""
-            SELECT COALESCE(SUM(valore), 0)
-            FROM spese_fisse
-            WHERE user_id=? AND anno=? AND LOWER(mese)=?
-        """, (uid, anno, m.lower())).fetchone()[0] or 0.0
-
-                # 3. Stipendi (lordo)
-        try:
-            mese_num = mesi.index(m) + 1  # gennaio=1, ..., ottobre=10
-            stipendi = db.execute("""
-                SELECT COALESCE(SUM(lordo), 0)
-                FROM stipendi_personale
-                WHERE user_id=? AND anno=? AND mese=?
-            """, (uid, anno, mese_num)).fetchone()[0] or 0.0
-        except Exception as e:
-            app.logger.warning(f"Errore lettura stipendi per {m} {anno}: {e}")
-            stipendi = 0.0
-
-        # 4. Spese Fatture
-        fatture = db.execute("""
-            SELECT COALESCE(SUM(importo), 0)
-            FROM fatture
-            WHERE user_id=? AND CAST(strftime('%Y', data_inserimento) AS INTEGER)=? 
-            AND LOWER(strftime('%m', data_inserimento))=?
-        """, (uid, anno, f"{mesi.index(m)+1:02d}")).fetchone()[0] or 0.0
-
-        # 5. Tasse (da tasse + ente)
-        tasse = db.execute("""
-            SELECT COALESCE(SUM(t.importo), 0)
-            FROM tasse t
-            JOIN ente e ON t.ente_id = e.id AND e.user_id = t.user_id
-            WHERE t.user_id = ?
-            AND CAST(strftime('%Y', t.data_inserimento) AS INTEGER) = ?
-            AND CAST(strftime('%m', t.data_inserimento) AS INTEGER) = ?
-        """, (uid, anno, mesi.index(m) + 1)).fetchone()[0] or 0.0
+    # Incassi, spese fisse, stipendi, fatture e tasse per ogni mese (vedi utils.ledger)
+    for m in ledger:
+        inc = m.incassi
 
         # Totale spese
-        spese = round(spese_fisse + stipendi + fatture + tasse, 2)
+        spese = round(m.tot_spese, 2)
         ricavo = inc - spese
         perc = (ricavo / inc * 100.0) if inc else 0.0
 
         dati.append({
-            "mese": m,
+            "mese": MONTH_NUM_TO_SLUG[m.mese_num],
             "incassi": round(inc, 2),
             "spese": round(spese, 2),
             "ricavo": round(ricavo, 2),
@@ -5124,73 +5345,29 @@ def handle_413(e):
     return "Payload troppo grande (max 2MB).", 413
 
 # route: grafico totale annuale per categorie (bar left + pie right)
-from io import BytesIO
-import sqlite3
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 from flask import send_file, current_app
 
 @app.route('/report_spese_plot/<int:anno>')
+@require_login
+@require_license
 def report_spese_plot(anno):
+    """PNG del grafico costi annuali; ?formato=json restituisce solo le serie numeriche."""
+    uid = _uid()
     try:
-        db_path = globals().get('DB_PATH') or globals().get('DBFILE') or 'ristosmart.db'
-        conn = sqlite3.connect(db_path)
-        cur = conn.cursor()
-
-        # 1) spese fisse (somma anno)
-        cur.execute("SELECT SUM(valore) FROM spese_fisse WHERE anno = ?", (int(anno),))
-        tot_fisse = float(cur.fetchone()[0] or 0.0)
-
-        # 2) spese_fatture (somma anno)
-        cur.execute("SELECT SUM(valore) FROM spese_fatture WHERE anno = ?", (int(anno),))
-        tot_spese_fatture = float(cur.fetchone()[0] or 0.0)
-
-        # 3) fatture importo (somma per anno dalla data)
-        cur.execute("SELECT SUM(importo) FROM fatture WHERE strftime('%Y', data_inserimento) = ?", (str(anno),))
-        tot_fatture_importo = float(cur.fetchone()[0] or 0.0)
-
-        # unisco le due sorgenti invoice-like
-        tot_fatture = tot_spese_fatture + tot_fatture_importo
-
-        # 4) personale: somma (netto + contributi)
-        # ASSUNZIONE: i valori in 'personale' sono mensili -> moltiplico per 12 per ottenere annuo
-        cur.execute("SELECT SUM(COALESCE(netto,0) + COALESCE(contributi,0)) FROM personale")
-        personale_mensile_sum = float(cur.fetchone()[0] or 0.0)
-        tot_personale = personale_mensile_sum * 12.0
-
-        conn.close()
-
-        # prepara dati per grafico (tre categorie)
-        labels = ['Spese fisse', 'Personale (annuo)', 'Spese fatture']
-        values = [tot_fisse, tot_personale, tot_fatture]
-
-        # evita torta vuota
-        if sum(values) == 0:
-            values = [1.0, 0.0, 0.0]
-
-        # subplot 1x2 (bar + pie), sharey=True per allineare l'altezza dei plot
-        fig, (ax_bar, ax_pie) = plt.subplots(1, 2, figsize=(12,5), sharey=True)
-        fig.patch.set_facecolor('white')
-
-        # barre (sinistra)
-        colors = ['#4e79a7','#59a14f','#f28e2c']
-        ax_bar.bar(labels, values, color=colors, edgecolor='none')
-        ax_bar.set_title(f"Costi annuali per categoria — {anno}")
-        ax_bar.set_ylabel("€")
-        ax_bar.tick_params(axis='x', rotation=15)
-        ax_bar.grid(axis='y', linestyle='--', alpha=0.25)
-
-        # torta (destra)
-        ax_pie.pie(values, labels=labels, autopct=lambda p: f"{p:.1f}%" if p>0 else '', colors=colors, textprops={'fontsize':9})
-        ax_pie.set_title("Distribuzione")
-
-        fig.tight_layout()
-        buf = BytesIO()
-        fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
-        plt.close(fig)
-        buf.seek(0)
-        return send_file(buf, mimetype='image/png')
+        if (request.args.get("formato") or "").lower() == "json":
+            # Totali annui dal libro mastro dell'utente (stesse regole di /api/annuale)
+            values = spese_series(load_ledger(get_db(), uid, int(anno)).totali())
+            return jsonify(anno=anno, labels=SPESE_LABELS, values=values, totale=round(sum(values), 2))
+
+        # riepilogo_mensile + ente: tutto ciò che entra nei totali del grafico
+        path, version = cached_export(uid, "spese_plot", {"anno": anno}, ("riepilogo_mensile", "ente"), "png")
+        if path is None:
+            values = spese_series(load_ledger(get_db(), uid, int(anno)).totali())
+            png, err = render_pdf("spese_plot", anno, values)
+            if err:
+                return err
+            path = export_cache.store(uid, "spese_plot", {"anno": anno}, version, "png", png)
+        return send_file(path, mimetype='image/png')
 
     except Exception:
         current_app.logger.exception("Errore generazione plot spese")
@@ -5259,25 +5436,10 @@ def rigenera_stipendi_tutti():
     finally:
         conn.close()
 
-# --- one-off migration: indice unico per upsert stipendi ---
-try:
-    with get_db() as conn:
-        conn.execute("""
-            CREATE UNIQUE INDEX IF NOT EXISTS ux_stipendi_personale
-            ON stipendi_personale(user_id, personale_id, anno, mese)
-        """)
-except Exception as e:
-    app.logger.warning(f"ux_stipendi_personale non creato: {e}")
-
 # --- INIZIO --- APP --- PDF --- PER --- TASSE.HTML --- (NO --- PER PAGAMENTO-TASSE.HTML) ---
 
 from flask import send_file
 import os
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.lib.units import inch
-from reportlab.lib import colors
 from datetime import datetime
 
 @app.get("/api/tasse/pdf")
@@ -5285,102 +5447,76 @@ from datetime import datetime
 @require_license
 def download_tasse_pdf():
     uid = _uid()
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"enti_tasse_{timestamp}.pdf"
-    filepath = os.path.join(app.config.get("USER_FILES_DIR", "user_files"), str(uid), filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    oggi = datetime.today().date().strftime('%d/%m/%Y')  # stampata nel PDF → parte della chiave
 
-    # Carica enti dal DB — SENZA 'sito'
-    with get_db() as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT nome, telefono, email, iban, bic 
-            FROM ente 
-            WHERE user_id = ? 
-            ORDER BY nome ASC
-        """, (uid,))
-        enti = [dict(row) for row in cur.fetchall()]
-
-    if not enti:
-        return {"error": "Nessun ente da esportare"}, 404
-
-    # Genera PDF
-    doc = SimpleDocTemplate(filepath, pagesize=A4)
-    styles = getSampleStyleSheet()
-    elements = []
-
-    # Titolo
-    title = Paragraph("📋 Elenco Enti Fiscali & Contributivi", styles['Title'])
-    subtitle = Paragraph(f"Esportato il {datetime.today().date().strftime('%d/%m/%Y')}", styles['Normal'])
-    elements.append(title)
-    elements.append(Spacer(1, 12))
-    elements.append(subtitle)
-    elements.append(Spacer(1, 24))
-
-    # Dati tabella — SENZA 'Sito'
-    data = [["Nome", "Telefono", "Email", "IBAN", "BIC"]]
-    for e in enti:
-        data.append([
-            e["nome"],
-            e["telefono"] or "",
-            e["email"] or "",
-            e["iban"] or "",
-            e["bic"] or ""
-        ])
-
-    # Larghezze colonne ottimizzate (totale ~7.5")
-    col_widths = [
-        1.3 * inch,   # Nome
-        1.2 * inch,   # Telefono
-        1.8 * inch,   # Email
-        1.8 * inch,   # IBAN
-        1.4 * inch    # BIC
-    ]
+    path, version = cached_export(uid, "enti_pdf", {"data": oggi}, ("ente",), "pdf")
+    if path is None:
+        # Carica enti dal DB — SENZA 'sito'
+        with get_db() as conn:
+            conn.row_factory = sqlite3.Row
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT nome, telefono, email, iban, bic 
+                FROM ente 
+                WHERE user_id = ? 
+                ORDER BY nome ASC
+            """, (uid,))
+            enti = [dict(row) for row in cur.fetchall()]
 
-    # ✅ Crea la tabella PRIMA di impostare lo stile
-    table = Table(data, colWidths=col_widths, repeatRows=1)
-
-    # ✅ Ora applica lo stile
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#003366")),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 8),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 4),
-        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor("#cccccc")),
-        ('FONTSIZE', (0, 1), (-1, -1), 7),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('WORDWRAP', (0, 0), (-1, -1), True),
-        ('TEXT_OVERFLOW', (0, 0), (-1, -1), 'ELLIPSIS'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 2),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 2)
-    ]))
-
-    # ✅ Aggiungi la tabella agli elementi del documento
-    elements.append(table)
-    elements.append(Spacer(1, 12))
-    footer = Paragraph("Documento generato da RistoSmartFM", styles['Italic'])
-    elements.append(footer)
+        if not enti:
+            return {"error": "Nessun ente da esportare"}, 404
 
-    try:
-        doc.build(elements)
-        return send_file(
-            filepath,
-            as_attachment=True,
-            download_name=f"enti_tasse_{datetime.today().year}.pdf"
-        )
-    except Exception as e:
-        app.logger.error(f"Errore generazione PDF tasse: {e}")
-        return {"error": "Impossibile generare il PDF"}, 500
+        # Genera PDF (process pool)
+        pdf, err = render_pdf("enti", enti, oggi)
+        if err:
+            return err
+        path = export_cache.store(uid, "enti_pdf", {"data": oggi}, version, "pdf", pdf)
+
+    return send_file(
+        path,
+        mimetype="application/pdf",
+        as_attachment=True,
+        download_name=f"enti_tasse_{datetime.today().year}.pdf"
+    )
 
 # --- FINE --- APP --- PDF --- PER --- TASSE.HTML --- (NO --- PER PAGAMENTO-TASSE.HTML) ---
 
-        
+
+# === SCHEDULER: job periodici fuori dal percorso delle richieste ===
+app.config["SCHEDULER"] = (os.getenv("SCHEDULER", "1") or "1").strip() == "1"
+app.config["SCHEDULER_TICK"] = float(os.getenv("SCHEDULER_TICK", "30"))
+app.config["EXPIRY_REMINDERS_AT"] = os.getenv("EXPIRY_REMINDERS_AT", "08:00")
+app.config["DRIP_AT"] = os.getenv("DRIP_AT", "09:00")
+app.config["BACKUP_AT"] = os.getenv("BACKUP_AT", "02:00")
+app.config["EXPORT_EVICT_AT"] = os.getenv("EXPORT_EVICT_AT", "03:00")
+
+scheduler = Scheduler(get_db, tick=app.config["SCHEDULER_TICK"])
+scheduler.at("expiry_reminders", app.config["EXPIRY_REMINDERS_AT"], run_expiry_reminders)
+scheduler.at("drip", app.config["DRIP_AT"], run_drip)
+scheduler.at("backup_db", app.config["BACKUP_AT"], lambda: str(_create_db_backup()))
+scheduler.at("evict_exports", app.config["EXPORT_EVICT_AT"], export_cache.evict_all)
+if app.config["INCR_BACKUP_EVERY_MIN"] > 0:
+    scheduler.interval("backup_incremental", app.config["INCR_BACKUP_EVERY_MIN"] * 60, incremental_backup.run)
+
+if app.config["SCHEDULER"] and IS_MAIN_PROCESS:
+    scheduler.start()
+
+@app.get("/admin/scheduler")
+@require_admin
+def admin_scheduler_status():
+    return jsonify({"ok": True, "alive": scheduler.is_alive(), "owner": scheduler.owner, "jobs": scheduler.status()})
+
+@app.post("/admin/scheduler/run/<job>")
+@require_admin
+@require_csrf
+def admin_scheduler_run(job):
+    if job not in scheduler.jobs:
+        return jsonify({"ok": False, "msg": "Job sconosciuto"}), 404
+    result = scheduler.run_now(job)
+    return jsonify({"ok": True, "job": job, "result": result if isinstance(result, dict) else str(result)})
+
 # === MAIN ===
 if __name__ == "__main__":
-    ensure_indexes()
     ensure_triggers()
     ensure_data_consistency()   # <-- aggiungi qui
     app.config["PROPAGATE_EXCEPTIONS"] = False
@@ -1,14 +1,36 @@
+import multiprocessing
 import os
+import socket
+import time
 import webview
 from threading import Thread
-from flask import Flask
 
 os.environ["FLASK_SECRET_KEY"] = "la_tua_chiave_segreta"
 os.environ["DB_PATH"] = os.path.join(os.getenv("APPDATA"), "RistoSmartFM", "ristosmart.db")
 
+HOST, PORT = '127.0.0.1', 5000
+
+# Mostrata subito, mentre app.py si carica nel thread del server
+LOADING_HTML = """
+<html><body style="font-family:sans-serif;display:flex;align-items:center;justify-content:center;height:100vh;color:#336699">
+<h2>RistoSmart FM si sta avviando…</h2>
+</body></html>
+"""
+
 def run_flask():
     from app import app
-    app.run(host='127.0.0.1', port=5000, threaded=True, use_reloader=False)
+    app.run(host=HOST, port=PORT, threaded=True, use_reloader=False)
+
+def wait_and_load(window, timeout=60):
+    # appena il server risponde, la finestra passa dalla schermata di caricamento all'app
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((HOST, PORT), timeout=0.5):
+                break
+        except OSError:
+            time.sleep(0.1)
+    window.load_url(f"http://{HOST}:{PORT}")
 
 def start_app():
     t = Thread(target=run_flask)
@@ -16,13 +38,16 @@ def start_app():
     t.start()
     window = webview.create_window(
         title="RistoSmart FM",
-        url="http://127.0.0.1:5000",
+        html=LOADING_HTML,
         width=1200,
         height=800,
         resizable=True,
         confirm_close=True
     )
-    webview.start()
+    webview.start(wait_and_load, window)
 
 if __name__ == '__main__':
-    start_app()
\ No newline at end of file
+    # nell'eseguibile PyInstaller i processi dei pool PDF/QR devono fermarsi qui,
+    # non riavviare server e finestra
+    multiprocessing.freeze_support()
+    start_app()
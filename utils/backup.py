@@ -0,0 +1,169 @@
+# utils/backup.py
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+log = logging.getLogger("ristosmart.backup")
+
+# Backup "online" con l'API di backup di SQLite: la copia procede a blocchi di
+# pagine e tra un blocco e l'altro gli altri processi possono scrivere.
+# Niente checkpoint FULL e niente copia dei file -wal/-shm vivi.
+
+
+def _copy_snapshot(src_path: str, dst, pages: int, pause: float, progress=None):
+    # La sorgente tiene aperta una transazione di lettura per tutta la copia: in WAL
+    # legge sempre la stessa fotografia e le scritture degli altri non fanno
+    # ripartire il backup (senza, con scritture continue non finirebbe mai).
+    src = sqlite3.connect(src_path, timeout=30)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()  # fissa lo snapshot
+        src.backup(dst, pages=max(int(pages), 1), sleep=pause,
+                   progress=(lambda status, remaining, total: progress(remaining, total)) if progress else None)
+    finally:
+        src.rollback()
+        src.close()
+
+
+def online_backup(db_path: str, dest_path: str, pages: int = 256, pause: float = 0.005, progress=None):
+    """Copia coerente di db_path in dest_path (file SQLite autonomo, journal DELETE).
+
+    progress(remaining, total) è chiamata dopo ogni blocco di `pages` pagine.
+    """
+    dst = sqlite3.connect(dest_path)
+    try:
+        _copy_snapshot(db_path, dst, pages, pause, progress)
+        dst.execute("PRAGMA journal_mode = DELETE")  # snapshot in un solo file
+    finally:
+        dst.close()
+
+
+def snapshot_bytes(db_path: str, pages: int = 256, pause: float = 0.005) -> bytes:
+    """Snapshot coerente di db_path come bytes (immagine del file), senza scrivere su disco.
+
+    Copia in un DB :memory: e lo serializza: per un attimo in RAM ci sono due
+    copie del DB, poi resta solo quella ritornata. L'header è quello della
+    sorgente (bytes 18-19 = 2 se è in WAL): chi lo scrive su file lo corregge.
+    Solleva RuntimeError se l'integrity_check dello snapshot fallisce.
+    """
+    dst = sqlite3.connect(":memory:")
+    try:
+        _copy_snapshot(db_path, dst, pages, pause)
+        check = dst.execute("PRAGMA integrity_check").fetchone()[0]
+        if check != "ok":
+            raise RuntimeError(f"integrity_check: {check}")
+        return dst.serialize()
+    finally:
+        dst.close()
+
+
+def verify_snapshot(path: str) -> str:
+    """'ok' se PRAGMA integrity_check passa, altrimenti il primo errore."""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def compress_snapshot(snapshot: str, zip_path: str, arcname: str) -> int:
+    """ZIP (deflate) dello snapshot, ricontrollato con testzip(). Ritorna la dimensione."""
+    tmp = zip_path + ".tmp"
+    with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.write(snapshot, arcname=arcname)
+    with zipfile.ZipFile(tmp) as z:
+        bad = z.testzip()
+        if bad is not None:
+            raise RuntimeError(f"ZIP corrotto: {bad}")
+    os.replace(tmp, zip_path)
+    return os.path.getsize(zip_path)
+
+
+class BackupManager:
+    """Un backup alla volta, in un thread; stato consultabile con status().
+
+    out_dir: dove finiscono gli ZIP ({prefix}_{YYYYmmdd_HHMMSS}.zip).
+    after:   callable opzionale eseguita a backup riuscito (es. pulizia dei vecchi ZIP).
+    """
+
+    def __init__(self, db_path: str, out_dir, prefix: str = "RistoSmartFM_DB",
+                 pages: int = 256, pause: float = 0.005, after=None):
+        self.db_path = db_path
+        self.out_dir = str(out_dir)
+        self.prefix = prefix
+        self.pages = pages
+        self.pause = pause
+        self.after = after
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()  # thread e scheduler non copiano mai insieme
+        self._thread = None
+        self._state = {"status": "idle"}
+
+    def _set(self, **kw):
+        with self._lock:
+            self._state.update(kw)
+
+    def status(self) -> dict:
+        with self._lock:
+            st = dict(self._state)
+        total, remaining = st.get("pages_total"), st.get("pages_remaining")
+        if total:
+            st["percent"] = round(100.0 * (total - remaining) / total, 1)
+        return st
+
+    def start(self) -> dict:
+        """Avvia un backup in background (se ce n'è già uno in corso, non ne parte un altro)."""
+        with self._lock:
+            if not (self._thread is not None and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run_safe, name="db-backup", daemon=True)
+                self._state = {"status": "queued"}
+                self._thread.start()
+        return self.status()
+
+    def _run_safe(self):
+        try:
+            self.run()
+        except Exception:
+            pass  # già registrato nello stato da run()
+
+    def run(self) -> str:
+        """Backup sincrono (usato dal thread e dallo scheduler). Ritorna il path dello ZIP."""
+        with self._run_lock:
+            return self._run()
+
+    def _run(self) -> str:
+        os.makedirs(self.out_dir, exist_ok=True)
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        name = f"{self.prefix}_{ts}"
+        snapshot = os.path.join(self.out_dir, f".{name}.db")
+        zip_path = os.path.join(self.out_dir, f"{name}.zip")
+        t0 = time.perf_counter()
+        self._set(status="copying", started_at=datetime.now().isoformat(timespec="seconds"),
+                  finished_at=None, error=None, file=None, size=None, pages_total=None, pages_remaining=None)
+        try:
+            online_backup(self.db_path, snapshot, self.pages, self.pause,
+                          progress=lambda remaining, total: self._set(pages_total=total, pages_remaining=remaining))
+            self._set(status="verifying")
+            check = verify_snapshot(snapshot)
+            if check != "ok":
+                raise RuntimeError(f"integrity_check: {check}")
+            self._set(status="compressing")
+            size = compress_snapshot(snapshot, zip_path, arcname=os.path.basename(self.db_path))
+            removed = self.after() if self.after else None
+            self._set(status="done", file=os.path.basename(zip_path), size=size, removed_old=removed,
+                      seconds=round(time.perf_counter() - t0, 2),
+                      finished_at=datetime.now().isoformat(timespec="seconds"))
+            log.info(f"[BACKUP] creato {zip_path} ({size} byte)")
+            return zip_path
+        except Exception as e:
+            self._set(status="error", error=str(e), finished_at=datetime.now().isoformat(timespec="seconds"))
+            log.warning(f"[BACKUP] fallito: {e}")
+            raise
+        finally:
+            for p in (snapshot, snapshot + "-journal", zip_path + ".tmp"):
+                if os.path.exists(p):
+                    os.remove(p)
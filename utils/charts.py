@@ -0,0 +1,45 @@
+# utils/charts.py
+from io import BytesIO
+
+SPESE_LABELS = ['Spese fisse', 'Personale (annuo)', 'Spese fatture', 'Tasse']
+SPESE_COLORS = ['#4e79a7', '#59a14f', '#f28e2c', '#e15759']
+
+
+def spese_series(tot: dict) -> list:
+    """Valori del grafico costi annuali (stesso ordine di SPESE_LABELS) dai totali del ledger."""
+    return [round(float(tot[k] or 0.0), 2) for k in ("spese_fisse", "stipendi", "fatture", "tasse")]
+
+
+def spese_plot_png(anno, values, dpi=150) -> bytes:
+    """Grafico costi annuali per categoria (barre a sinistra, torta a destra) in PNG.
+
+    matplotlib è importato qui: il costo resta nel processo che disegna.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    labels = SPESE_LABELS
+    # evita torta vuota
+    if sum(values) == 0:
+        values = [1.0, 0.0, 0.0, 0.0]
+
+    # subplot 1x2 (bar + pie), sharey=True per allineare l'altezza dei plot
+    fig, (ax_bar, ax_pie) = plt.subplots(1, 2, figsize=(12, 5), sharey=True)
+    fig.patch.set_facecolor('white')
+
+    ax_bar.bar(labels, values, color=SPESE_COLORS, edgecolor='none')
+    ax_bar.set_title(f"Costi annuali per categoria — {anno}")
+    ax_bar.set_ylabel("€")
+    ax_bar.tick_params(axis='x', rotation=15)
+    ax_bar.grid(axis='y', linestyle='--', alpha=0.25)
+
+    ax_pie.pie(values, labels=labels, autopct=lambda p: f"{p:.1f}%" if p > 0 else '',
+               colors=SPESE_COLORS, textprops={'fontsize': 9})
+    ax_pie.set_title("Distribuzione")
+
+    fig.tight_layout()
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return buf.getvalue()
@@ -1,30 +1,54 @@
 # utils/crypto.py
 import os
 import base64
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import threading
 
 # SALT fisso (non segreto, ma necessario per la derivazione)
 SALT = b"RistoSmartSalt2025"
+ITERATIONS = 480000
 
-# Ottiene la chiave di crittografia dal file .env
-def get_fernet():
-    # Recupera la chiave segreta dall'ambiente
-    secret = os.getenv("BANK_DATA_SECRET")
-    if not secret:
-        raise ValueError("❌ Variabile BANK_DATA_SECRET non impostata nel file .env")
+# Chiave derivata in memoria, una per valore di BANK_DATA_SECRET (rotazione → nuova derivazione)
+_FERNET_CACHE = {}
+_FERNET_LOCK = threading.Lock()
+
+def _derive_fernet(secret: str):
+    # cryptography importata qui: serve solo quando si cifra/decifra davvero
+    from cryptography.fernet import Fernet
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
-    # Deriva una chiave di 32 byte usando PBKDF2HMAC
+    # Deriva una chiave di 32 byte usando PBKDF2HMAC (lento per scelta: ~centinaia di ms)
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
         length=32,
         salt=SALT,
-        iterations=480000,
+        iterations=ITERATIONS,
     )
     key = base64.urlsafe_b64encode(kdf.derive(secret.encode()))
     return Fernet(key)
 
+# Ottiene la chiave di crittografia dal file .env
+def get_fernet():
+    # Recupera la chiave segreta dall'ambiente
+    secret = os.getenv("BANK_DATA_SECRET")
+    if not secret:
+        raise ValueError("❌ Variabile BANK_DATA_SECRET non impostata nel file .env")
+
+    f = _FERNET_CACHE.get(secret)
+    if f is None:
+        with _FERNET_LOCK:
+            f = _FERNET_CACHE.get(secret)
+            if f is None:
+                # tieni solo la chiave del segreto corrente
+                _FERNET_CACHE.clear()
+                f = _FERNET_CACHE[secret] = _derive_fernet(secret)
+    return f
+
+def clear_key_cache():
+    """Dimentica le chiavi derivate (es. dopo una rotazione nello stesso processo)."""
+    with _FERNET_LOCK:
+        _FERNET_CACHE.clear()
+
 # Crittografa una stringa
 def encrypt_data(data: str) -> str:
     f = get_fernet()
@@ -33,4 +57,48 @@ def encrypt_data(data: str) -> str:
 # Decrittografa una stringa
 def decrypt_data(encrypted_data: str) -> str:
     f = get_fernet()
-    return f.decrypt(encrypted_data.encode()).decode()
\ No newline at end of file
+    return f.decrypt(encrypted_data.encode()).decode()
+
+# Versioni batch (migrazioni / ri-cifratura): una sola chiave per tutta la lista.
+# None e stringa vuota passano invariati.
+def encrypt_many(values) -> list:
+    f = get_fernet()
+    return [f.encrypt(v.encode()).decode() if v else v for v in values]
+
+def decrypt_many(values) -> list:
+    f = get_fernet()
+    return [f.decrypt(v.encode()).decode() if v else v for v in values]
+
+def reencrypt_many(values, old_secret: str) -> list:
+    """Decifra con old_secret e ricifra con il BANK_DATA_SECRET corrente."""
+    old = _derive_fernet(old_secret)
+    new = get_fernet()
+    return [new.encrypt(old.decrypt(v.encode())).decode() if v else v for v in values]
+
+
+def benchmark(n: int = 20):
+    """Micro-benchmark: costo per chiamata con derivazione ogni volta vs chiave in cache."""
+    import time
+    secret = os.getenv("BANK_DATA_SECRET") or "benchmark-secret"
+    os.environ["BANK_DATA_SECRET"] = secret
+    token = _derive_fernet(secret).encrypt(b"IT60X0542811101000000123456").decode()
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        _derive_fernet(secret).decrypt(token.encode())
+    before = (time.perf_counter() - t0) / n
+
+    clear_key_cache()
+    decrypt_data(token)  # prima chiamata: deriva e mette in cache
+    t0 = time.perf_counter()
+    for _ in range(n * 100):
+        decrypt_data(token)
+    after = (time.perf_counter() - t0) / (n * 100)
+
+    print(f"decrypt_data senza cache: {before * 1000:.2f} ms/chiamata")
+    print(f"decrypt_data con cache:   {after * 1000:.4f} ms/chiamata  (x{before / after:.0f})")
+    return before, after
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,112 @@
+# utils/csv_stream.py
+import csv
+import io
+import os
+import sqlite3
+import sys
+import time
+
+BOM = "\ufeff"
+
+
+def iter_rows(cur, size: int = 1000):
+    """Righe di un cursore a blocchi di `size` (fetchmany), senza fetchall()."""
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+def iter_csv(header, rows, bom: bool = False, chunk_rows: int = 1000, encoding: str = "utf-8"):
+    """Genera il CSV a pezzi (bytes): intestazione, poi un chunk ogni `chunk_rows` righe.
+
+    La memoria resta quella di un chunk, qualunque sia il numero di righe.
+    bom=True antepone il BOM UTF-8 (Excel riconosce così gli accenti).
+    """
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    if bom:
+        buf.write(BOM)
+    if header:
+        w.writerow(header)
+    n = 0
+    for row in rows:
+        w.writerow(row)
+        n += 1
+        if n >= chunk_rows:
+            yield buf.getvalue().encode(encoding)
+            buf.seek(0)
+            buf.truncate()
+            n = 0
+    tail = buf.getvalue()
+    if tail:
+        yield tail.encode(encoding)
+
+
+# --- Benchmark: picco RSS per export di N righe, bufferizzato vs streaming ---
+_BENCH_SQL = "SELECT id, email, license_key, intestatario, scadenza, attiva, created_at, meta FROM licenze ORDER BY id DESC"
+_BENCH_HEADER = ["id", "email", "license_key", "intestatario", "scadenza", "attiva", "created_at", "meta"]
+
+
+def _bench_db(path: str, rows: int):
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE licenze (id INTEGER PRIMARY KEY, email TEXT, license_key TEXT, intestatario TEXT,
+                              scadenza TEXT, attiva INTEGER, created_at TEXT, meta TEXT)
+    """)
+    conn.executemany(
+        "INSERT INTO licenze VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        ((i, f"cliente{i}@example.com", f"RS-{i:010d}-ABCDEF", f"Ristorante Numero {i}",
+          "2026-12-31", i % 2, "2025-01-01 10:00:00", "") for i in range(1, rows + 1)))
+    conn.commit()
+    conn.close()
+
+
+def _bench_run(path: str, mode: str):
+    """Eseguito in un processo separato: scrive il CSV su /dev/null e stampa picco RSS (KB) e secondi."""
+    import resource
+    conn = sqlite3.connect(path)
+    t0 = time.perf_counter()
+    with open(os.devnull, "wb") as out:
+        if mode == "buffered":
+            # com'era prima: fetchall() + StringIO completo + encode
+            buf = io.StringIO()
+            w = csv.writer(buf)
+            w.writerow(_BENCH_HEADER)
+            for r in conn.execute(_BENCH_SQL).fetchall():
+                w.writerow(r)
+            out.write(buf.getvalue().encode("utf-8-sig"))
+        else:
+            for chunk in iter_csv(_BENCH_HEADER, iter_rows(conn.execute(_BENCH_SQL)), bom=True):
+                out.write(chunk)
+    elapsed = time.perf_counter() - t0
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, round(elapsed, 2))
+
+
+def main(argv=None):
+    """Dalla root del progetto: `python -m utils.csv_stream --rows 1000000`."""
+    import argparse
+    import subprocess
+    import tempfile
+    parser = argparse.ArgumentParser(description="Benchmark export CSV: picco RSS bufferizzato vs streaming")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--_run", nargs=2, metavar=("DB", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args._run:
+        return _bench_run(*args._run)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        print(f"preparo {args.rows} righe...")
+        _bench_db(path, args.rows)
+        for mode in ("buffered", "stream"):
+            out = subprocess.run([sys.executable, "-m", "utils.csv_stream", "--_run", path, mode],
+                                 capture_output=True, text=True, check=True).stdout.split()
+            rss_kb, secs = int(out[0]), out[1]
+            print(f"{mode:>9}: picco RSS {rss_kb / 1024:8.1f} MB   {secs}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+# utils/db_pool.py
+import os
+import sqlite3
+import threading
+from collections import deque
+from time import perf_counter
+
+# PRAGMA per-connessione: applicati UNA volta, quando la connessione nasce
+PRAGMAS = (
+    "PRAGMA foreign_keys = ON",    # valida FK su ogni query
+    "PRAGMA journal_mode = WAL",   # letture non bloccano scritture
+    "PRAGMA synchronous = NORMAL", # bilancia durabilità/velocità in WAL
+    "PRAGMA busy_timeout = 5000",  # attende lock fino a 5s
+    "PRAGMA recursive_triggers = ON",  # REPLACE fa scattare i trigger DELETE (riepilogo_mensile)
+)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursore che somma sulla connessione numero di statement e tempo passato in SQLite.
+
+    Cronometrati solo execute/executemany/executescript (per una SELECT l'execute
+    comprende il primo passo): i fetch* restano quelli in C. Con un tracer attivo
+    la connessione usa TracedCursor, che misura anche i fetch.
+    """
+
+    def execute(self, sql, parameters=()):
+        t0 = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            conn = self.connection
+            conn.sql_count += 1
+            conn.sql_time += perf_counter() - t0
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            conn = self.connection
+            conn.sql_count += 1
+            conn.sql_time += perf_counter() - t0
+
+    def executescript(self, sql_script):
+        t0 = perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            conn = self.connection
+            conn.sql_count += 1
+            conn.sql_time += perf_counter() - t0
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Come TimedCursor, più i fetch* e il passaggio di ogni statement al tracer (utils.sql_trace).
+
+    Le righe lette iterando il cursore (for row in cur) non entrano nel tempo.
+    """
+    _trace = None  # stato del tracer per lo statement corrente
+
+    def execute(self, sql, parameters=()):
+        t0 = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed = perf_counter() - t0
+            conn = self.connection
+            conn.sql_count += 1
+            conn.sql_time += elapsed
+            conn.tracer.executed(self, sql, parameters, elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        t0 = perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            elapsed = perf_counter() - t0
+            conn = self.connection
+            conn.sql_count += 1
+            conn.sql_time += elapsed
+            conn.tracer.executed(self, sql, None, elapsed)
+
+    def executescript(self, sql_script):
+        self._trace = None  # script (DDL): non tracciati
+        t0 = perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            conn = self.connection
+            conn.sql_count += 1
+            conn.sql_time += perf_counter() - t0
+
+    def fetchone(self):
+        t0 = perf_counter()
+        row = None
+        try:
+            row = super().fetchone()
+            return row
+        finally:
+            elapsed = perf_counter() - t0
+            conn = self.connection
+            conn.sql_time += elapsed
+            if self._trace is not None:
+                conn.tracer.fetched(self, elapsed, row is not None)
+
+    def fetchmany(self, size=None):
+        t0 = perf_counter()
+        rows = ()
+        try:
+            rows = super().fetchmany(self.arraysize if size is None else size)
+            return rows
+        finally:
+            elapsed = perf_counter() - t0
+            conn = self.connection
+            conn.sql_time += elapsed
+            if self._trace is not None:
+                conn.tracer.fetched(self, elapsed, len(rows))
+
+    def fetchall(self):
+        t0 = perf_counter()
+        rows = ()
+        try:
+            rows = super().fetchall()
+            return rows
+        finally:
+            elapsed = perf_counter() - t0
+            conn = self.connection
+            conn.sql_time += elapsed
+            if self._trace is not None:
+                conn.tracer.fetched(self, elapsed, len(rows))
+
+
+_cursor = sqlite3.Connection.cursor
+
+
+class PooledConnection(sqlite3.Connection):
+    """Connessione SQLite che al close() torna nel pool invece di chiudersi.
+
+    Finché è legata a una richiesta (scoped=True) close() non fa nulla:
+    la restituzione avviene nel teardown dell'app context.
+    sql_count/sql_time accumulano gli statement eseguiti (solo con TimedConnection,
+    qui restano a zero): chi misura li azzera con reset_counters().
+    """
+    pool = None
+    scoped = False
+    idle = False
+    sql_count = 0
+    sql_time = 0.0
+    tracer = None
+
+    def reset_counters(self):
+        self.sql_count = 0
+        self.sql_time = 0.0
+
+    def close(self):
+        if self.scoped:
+            return
+        if self.pool is None:
+            return super().close()
+        self.pool.release(self)
+
+    def really_close(self):
+        self.pool = None
+        self.scoped = False
+        super().close()
+
+
+class TimedConnection(PooledConnection):
+    """PooledConnection i cui cursori sono TimedCursor, o TracedCursor se c'è un tracer."""
+    cursor_class = TimedCursor  # scelto dal pool all'acquire
+
+    # conn.execute() in C non passa da cursor(): si reindirizza qui per contarlo
+    def cursor(self, factory=None):
+        return super().cursor(factory or self.cursor_class)
+
+    def execute(self, sql, parameters=()):
+        return _cursor(self, self.cursor_class).execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return _cursor(self, self.cursor_class).executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return _cursor(self, self.cursor_class).executescript(sql_script)
+
+
+class ConnectionPool:
+    """Pool LIFO di connessioni riutilizzabili verso un unico file DB.
+
+    Ogni connessione è usata da un solo thread alla volta (acquire/release),
+    per questo può essere aperta con check_same_thread=False.
+    timed=True apre TimedConnection (tempi e conteggi SQL); altrimenti le query
+    vanno dritte all'execute in C, senza wrapper Python.
+    """
+
+    def __init__(self, db_path: str, max_idle: int = 8, timed: bool = True):
+        self.db_path = db_path
+        self.timed = bool(timed)
+        self.max_idle = max(int(max_idle or 0), 0)
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.released = 0
+        self.discarded = 0
+        self.created = 0
+        self.tracer = None  # utils.sql_trace.SqlTracer, assegnato alle connessioni all'acquire
+        # cartella del DB: una sola volta per pool, non a ogni connessione
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+
+    def _connect(self) -> PooledConnection:
+        conn = sqlite3.connect(
+            self.db_path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            factory=TimedConnection if self.timed else PooledConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def _checkout(self, conn: PooledConnection) -> PooledConnection:
+        conn.tracer = self.tracer
+        if self.timed:
+            conn.cursor_class = TimedCursor if self.tracer is None else TracedCursor
+        return conn
+
+    def acquire(self) -> PooledConnection:
+        with self._lock:
+            if self._idle:
+                conn = self._idle.pop()
+                conn.idle = False
+                self.hits += 1
+                return self._checkout(conn)
+            self.misses += 1
+        return self._checkout(self._connect())
+
+    def release(self, conn: PooledConnection):
+        if conn.idle:
+            return  # doppio close(): già nel pool
+        try:
+            # transazione lasciata aperta dal chiamante → scartata, come con close()
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = sqlite3.Row
+        except sqlite3.Error:
+            with self._lock:
+                self.discarded += 1
+            conn.really_close()
+            return
+
+        with self._lock:
+            self.released += 1
+            if len(self._idle) < self.max_idle:
+                conn.idle = True
+                self._idle.append(conn)
+                return
+            self.discarded += 1
+        conn.really_close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            try:
+                conn.really_close()
+            except sqlite3.Error:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "db_path": self.db_path,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "released": self.released,
+                "discarded": self.discarded,
+                "created": self.created,
+                "idle": len(self._idle),
+                "max_idle": self.max_idle,
+                "timed": self.timed,
+            }
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_pool(db_path: str, max_idle: int = 8, timed: bool = True) -> ConnectionPool:
+    """Ritorna (creandolo se serve) il pool associato al file DB.
+
+    max_idle e timed contano solo alla prima chiamata, quando il pool nasce.
+    """
+    pool = _POOLS.get(db_path)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.get(db_path)
+            if pool is None:
+                pool = _POOLS[db_path] = ConnectionPool(db_path, max_idle, timed)
+    return pool
@@ -0,0 +1,226 @@
+# utils/export_cache.py
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Versione dei dati per (utente, tabella): incrementata dai trigger a ogni
+# INSERT/UPDATE/DELETE, così un export sa se i suoi dati sorgente sono cambiati.
+DDL_DATA_VERSION = """
+    CREATE TABLE IF NOT EXISTS data_version (
+        user_id INTEGER NOT NULL,
+        tabella TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, tabella)
+    ) WITHOUT ROWID
+"""
+
+VERSIONED_TABLES = ("personale", "stipendi_personale", "ente", "tasse", "riepilogo_mensile")
+
+
+def _bump_sql(table: str, ref: str) -> str:
+    return f"""
+        INSERT INTO data_version (user_id, tabella, version) VALUES ({ref}.user_id, '{table}', 1)
+        ON CONFLICT (user_id, tabella) DO UPDATE SET version = version + 1;"""
+
+
+def version_trigger_ddl(table: str) -> list:
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS dv_{table}_ins AFTER INSERT ON {table}
+        BEGIN{_bump_sql(table, 'NEW')}
+        END;""",
+        f"""CREATE TRIGGER IF NOT EXISTS dv_{table}_del AFTER DELETE ON {table}
+        BEGIN{_bump_sql(table, 'OLD')}
+        END;""",
+        # OLD e NEW: se cambia user_id sono due utenti diversi
+        f"""CREATE TRIGGER IF NOT EXISTS dv_{table}_upd AFTER UPDATE ON {table}
+        BEGIN{_bump_sql(table, 'OLD')}{_bump_sql(table, 'NEW')}
+        END;""",
+    ]
+
+
+def ensure_data_versions(conn):
+    conn.execute(DDL_DATA_VERSION)
+    for table in VERSIONED_TABLES:
+        for ddl in version_trigger_ddl(table):
+            conn.execute(ddl)
+
+
+def data_version(conn, user_id, tables) -> str:
+    """Firma della versione dati dell'utente per le tabelle indicate (es. 'ente:3,tasse:7')."""
+    tables = sorted(tables)
+    found = dict(conn.execute(
+        f"SELECT tabella, version FROM data_version WHERE user_id = ? AND tabella IN ({','.join('?' * len(tables))})",
+        (user_id, *tables),
+    ).fetchall())
+    return ",".join(f"{t}:{found.get(t, 0)}" for t in tables)
+
+
+class ExportCache:
+    """Export già generati, su disco in <root>/<user_id>/exports/.
+
+    Il nome file è l'hash di (tipo export, parametri, versione dati): se nulla è
+    cambiato lo stesso export viene servito dal file. Per ogni utente i file più
+    vecchi di max_age secondi vengono eliminati e, oltre max_bytes, i meno usati.
+    legacy_globs: file sparsi in <legacy_root>/<user_id>/ da gestire con le stesse regole
+    (es. i vecchi 'enti_tasse_*.pdf' con timestamp); legacy_root di default è root.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 50 * 1024 * 1024, max_age: float = 30 * 86400,
+                 legacy_globs=(), legacy_root: str | None = None):
+        self.root = root
+        self.legacy_root = legacy_root or root
+        self.max_bytes = int(max_bytes)
+        self.max_age = float(max_age)
+        self.legacy_globs = tuple(legacy_globs)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+    def _dir(self, user_id) -> str:
+        return os.path.join(self.root, str(int(user_id)), "exports")
+
+    def path_for(self, user_id, kind: str, params, version: str, ext: str) -> str:
+        raw = json.dumps([kind, params, version], sort_keys=True, default=str)
+        digest = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self._dir(user_id), f"{kind}-{digest}.{ext}")
+
+    def lookup(self, user_id, kind: str, params, version: str, ext: str) -> str | None:
+        """Path dell'export già pronto oppure None."""
+        path = self.path_for(user_id, kind, params, version, ext)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)  # "ultimo uso" per l'eviction a dimensione
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def store(self, user_id, kind: str, params, version: str, ext: str, data) -> str:
+        """Salva l'export (bytes oppure callable(fh) che scrive nel file) e ritorna il path."""
+        pending = self.open_write(user_id, kind, params, version, ext)
+        try:
+            if callable(data):
+                data(pending.fh)
+            else:
+                pending.fh.write(data)
+        except BaseException:
+            pending.abort()
+            raise
+        return pending.commit()
+
+    def open_write(self, user_id, kind: str, params, version: str, ext: str) -> "PendingExport":
+        """File temporaneo da riempire a pezzi (es. mentre si manda in streaming la risposta).
+
+        commit() lo rende visibile alla lookup; abort() lo scarta (stream interrotto).
+        """
+        path = self.path_for(user_id, kind, params, version, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return PendingExport(self, user_id, path)
+
+    def _tenant_files(self, user_id) -> list:
+        base = os.path.join(self.legacy_root, str(int(user_id)))
+        paths = glob.glob(os.path.join(self._dir(user_id), "*"))
+        for pattern in self.legacy_globs:
+            paths += glob.glob(os.path.join(base, pattern))
+        out = []
+        for p in paths:
+            if p.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, p))
+        return out
+
+    def evict(self, user_id, keep: str | None = None) -> dict:
+        """Applica età massima e budget in byte ai file dell'utente."""
+        now = time.time()
+        files = sorted(self._tenant_files(user_id))  # dal meno recente
+        removed, freed = 0, 0
+        total = sum(size for _, size, _ in files)
+        for mtime, size, p in files:
+            too_old = now - mtime > self.max_age
+            over = total > self.max_bytes
+            if p == keep or not (too_old or over):
+                continue
+            try:
+                os.remove(p)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            freed += size
+        with self._lock:
+            self.evicted_files += removed
+            self.evicted_bytes += freed
+        return {"user_id": int(user_id), "removed": removed, "freed_bytes": freed, "bytes": total}
+
+    def evict_all(self) -> dict:
+        removed, freed, tenants = 0, 0, 0
+        roots = {self.root, self.legacy_root} if self.legacy_globs else {self.root}
+        users = {int(name) for r in roots if os.path.isdir(r) for name in os.listdir(r) if name.isdigit()}
+        for uid in sorted(users):
+            res = self.evict(uid)
+            tenants += 1
+            removed += res["removed"]
+            freed += res["freed_bytes"]
+        return {"tenants": tenants, "removed": removed, "freed_bytes": freed}
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "root": self.root,
+                "max_bytes_per_user": self.max_bytes,
+                "max_age_seconds": self.max_age,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evicted_files": self.evicted_files,
+                "evicted_bytes": self.evicted_bytes,
+            }
+
+
+class PendingExport:
+    """Export in scrittura: il file temporaneo si apre alla prima write()."""
+
+    def __init__(self, cache: ExportCache, user_id, path: str):
+        self.cache = cache
+        self.user_id = user_id
+        self.path = path
+        self.tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        self._fh = None
+
+    @property
+    def fh(self):
+        if self._fh is None:
+            self._fh = open(self.tmp, "wb")
+        return self._fh
+
+    def write(self, data: bytes):
+        self.fh.write(data)
+
+    def commit(self) -> str:
+        try:
+            self.fh.close()
+            os.replace(self.tmp, self.path)
+        finally:
+            self.abort()
+        with self.cache._lock:
+            self.cache.misses += 1
+        self.cache.evict(self.user_id, keep=self.path)
+        return self.path
+
+    def abort(self):
+        if self._fh is not None:
+            self._fh.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
@@ -0,0 +1,75 @@
+# utils/import_budget.py
+# Budget del tempo di import di app.py (avvio a freddo della versione desktop).
+# Dalla root del progetto:
+#     python -m utils.import_budget              # budget: IMPORT_BUDGET_MS o 1500 ms
+#     python -m utils.import_budget --budget 800 --top 15
+# Esegue `python -X importtime -c "import app"` in un processo pulito (DB temporaneo,
+# scheduler e worker email spenti) ed esce con codice 1 se l'import supera il budget
+# o se carica uno dei moduli pesanti che devono restare lazy.
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+# Moduli che app.py deve importare solo al primo uso (vedi gli accessor in utils/)
+HEAVY_MODULES = ("qrcode", "PIL", "reportlab", "fpdf", "matplotlib", "pandas", "cryptography", "smtplib")
+
+
+def parse_importtime(stderr: str) -> list:
+    """Righe di -X importtime → [(modulo, profondità, self_us, cumulative_us)]."""
+    out = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        out.append((name.strip(), depth, int(self_us), int(cum)))
+    return out
+
+
+def measure(project_root: str) -> list:
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   DB_PATH=os.path.join(tmp, "budget.db"),
+                   SCHEDULER="0", OUTBOX_WORKER="0",
+                   PYTHONPATH=project_root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                              cwd=tmp, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import app fallito:\n{proc.stderr[-2000:]}")
+    return parse_importtime(proc.stderr)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Budget tempo di import di app.py")
+    parser.add_argument("--budget", type=float, default=float(os.getenv("IMPORT_BUDGET_MS", "1500")),
+                        help="millisecondi massimi per 'import app' (cumulativo)")
+    parser.add_argument("--top", type=int, default=10, help="quanti moduli più lenti mostrare")
+    args = parser.parse_args(argv)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    rows = measure(root)
+    total_ms = next((cum for name, depth, _, cum in rows if name == "app" and depth == 0), 0) / 1000
+
+    # moduli importati direttamente da app.py
+    top_level = [(name, cum) for name, depth, _, cum in rows if depth == 1]
+    print(f"import app: {total_ms:.0f} ms (budget {args.budget:.0f} ms)")
+    for name, cum in sorted(top_level, key=lambda r: -r[1])[:args.top]:
+        print(f"  {cum / 1000:8.1f} ms  {name}")
+
+    loaded = sorted({name.split(".")[0] for name, _, _, _ in rows} & set(HEAVY_MODULES))
+    failed = False
+    if loaded:
+        print(f"FAIL: moduli pesanti importati all'avvio: {', '.join(loaded)}")
+        failed = True
+    if total_ms > args.budget:
+        print(f"FAIL: import oltre il budget di {total_ms - args.budget:.0f} ms")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
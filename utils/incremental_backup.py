@@ -0,0 +1,280 @@
+# utils/incremental_backup.py
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from utils.backup import online_backup, snapshot_bytes, verify_snapshot
+
+log = logging.getLogger("ristosmart.incremental_backup")
+
+# Backup incrementale a pagine:
+#   base_<ts>.db.gz      copia completa (una ogni base_every giorni)
+#   delta_<ts>.bin.gz    solo le pagine cambiate dal punto precedente
+#   pages.sha            hash (sha1) di ogni pagina dell'ultimo punto archiviato
+# Il ripristino parte dalla base e applica i delta fino al timestamp richiesto.
+# (sqlite_dbpage non è disponibile nel modulo sqlite3 standard, quindi le pagine
+#  si leggono da uno snapshot fatto con l'API di backup: in RAM se il DB è sotto
+#  max_memory_mb, così su disco finiscono solo le pagine cambiate; oltre, su un
+#  file temporaneo letto a pagine, per non tenere in memoria ~3 copie del DB.)
+
+TS_FORMAT = "%Y%m%d_%H%M%S_%f"
+_NAME = re.compile(r"^(base|delta)_(\d{8}_\d{6}_\d{6})\.(db|bin)\.gz$")
+_HASH_LEN = 20
+_REC = struct.Struct(">I")  # numero pagina, seguito dai byte della pagina
+
+
+def _iter_pages(view: memoryview, page_size: int):
+    # fette della memoryview: nessuna copia delle pagine
+    for pgno, off in enumerate(range(0, len(view), page_size), 1):
+        yield pgno, view[off:off + page_size]
+
+
+def _iter_file_pages(path: str, page_size: int):
+    with open(path, "rb") as fh:
+        pgno = 0
+        while True:
+            data = fh.read(page_size)
+            if not data:
+                return
+            pgno += 1
+            yield pgno, data
+
+
+def _rollback_header(page1) -> bytes:
+    # bytes 18-19 dell'header = 1 (journal rollback, come online_backup): il file
+    # ripristinato non deve aprirsi in WAL. Copia solo la prima pagina.
+    return bytes(page1[:18]) + b"\x01\x01" + bytes(page1[20:])
+
+
+def _page_size(header) -> int:
+    size = struct.unpack(">H", header[16:18])[0]
+    return 65536 if size == 1 else size
+
+
+class IncrementalArchive:
+    """Archivio incrementale di un DB SQLite in archive_dir.
+
+    base_every: giorni dopo i quali il prossimo punto è una nuova base completa.
+    keep_bases: quante catene (base + delta) tenere; le più vecchie vengono eliminate.
+    max_memory_mb: DB fino a questa dimensione letti in RAM (picco ~3x), oltre da file temporaneo.
+    """
+
+    def __init__(self, db_path: str, archive_dir, base_every: float = 7, keep_bases: int = 2,
+                 pages: int = 256, max_memory_mb: float = 64):
+        self.db_path = db_path
+        self.archive_dir = str(archive_dir)
+        self.base_every = float(base_every)
+        self.keep_bases = max(int(keep_bases), 1)
+        self.pages = pages
+        self.max_memory = float(max_memory_mb) * 1024 * 1024
+        self._lock = threading.Lock()
+        self.last_report = None
+
+    # --- elenco dei punti ---
+    def points(self) -> list:
+        """[(datetime, 'base'|'delta', filename)] in ordine cronologico."""
+        out = []
+        if not os.path.isdir(self.archive_dir):
+            return out
+        for name in os.listdir(self.archive_dir):
+            m = _NAME.match(name)
+            if m:
+                out.append((datetime.strptime(m.group(2), TS_FORMAT), m.group(1), name))
+        return sorted(out)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.archive_dir, name)
+
+    # --- archiviazione ---
+    def run(self, force_base: bool = False) -> dict:
+        """Archivia un nuovo punto (base o delta). Ritorna un report con pagine e byte scritti."""
+        with self._lock:
+            report = self._run(force_base)
+        self.last_report = report
+        return report
+
+    @contextmanager
+    def _snapshot(self, ts: str):
+        """(page_size, page_count, pagine) di uno snapshot coerente del DB."""
+        if os.path.getsize(self.db_path) <= self.max_memory:
+            view = memoryview(snapshot_bytes(self.db_path, self.pages))
+            page_size = _page_size(view[:100])
+            yield page_size, len(view) // page_size, _iter_pages(view, page_size)
+            return
+        path = self._path(f".snapshot_{ts}.db")
+        try:
+            online_backup(self.db_path, path, self.pages)
+            check = verify_snapshot(path)
+            if check != "ok":
+                raise RuntimeError(f"integrity_check: {check}")
+            with open(path, "rb") as fh:
+                page_size = _page_size(fh.read(100))
+            yield page_size, os.path.getsize(path) // page_size, _iter_file_pages(path, page_size)
+        finally:
+            for p in (path, path + "-journal"):
+                if os.path.exists(p):
+                    os.remove(p)
+
+    def _run(self, force_base: bool) -> dict:
+        os.makedirs(self.archive_dir, exist_ok=True)
+        t0 = time.perf_counter()
+        now = datetime.now()
+        ts = now.strftime(TS_FORMAT)
+        hashes_path = self._path("pages.sha")
+        with self._snapshot(ts) as (page_size, page_count, pages):
+            bases = [p for p in self.points() if p[1] == "base"]
+            need_base = (force_base or not bases or not os.path.exists(hashes_path)
+                         or now - bases[-1][0] > timedelta(days=self.base_every)
+                         or self._meta().get("page_size") != page_size)
+            old_hashes = b""
+            if not need_base:
+                with open(hashes_path, "rb") as fh:
+                    old_hashes = fh.read()
+
+            # base: tutte le pagine in fila; delta: (numero pagina, pagina) solo se cambiata
+            name = f"base_{ts}.db.gz" if need_base else f"delta_{ts}.bin.gz"
+            parts, changed = [], 0
+            with gzip.open(self._path(name) + ".tmp", "wb") as dst:
+                if not need_base:
+                    dst.write(json.dumps({"page_size": page_size, "page_count": page_count}).encode() + b"\n")
+                for pgno, data in pages:
+                    digest = hashlib.sha1(data).digest()
+                    parts.append(digest)
+                    i = (pgno - 1) * _HASH_LEN
+                    if need_base or old_hashes[i:i + _HASH_LEN] != digest:
+                        if not need_base:
+                            dst.write(_REC.pack(pgno))
+                        dst.write(_rollback_header(data) if pgno == 1 else data)
+                        changed += 1
+            os.replace(self._path(name) + ".tmp", self._path(name))
+            new_hashes = b"".join(parts)
+
+        with open(hashes_path + ".tmp", "wb") as fh:
+            fh.write(new_hashes)
+        os.replace(hashes_path + ".tmp", hashes_path)
+        self._write_meta({"page_size": page_size})
+        removed = self._prune()
+
+        report = {
+            "mode": "base" if need_base else "delta",
+            "file": name,
+            "pages_total": page_count,
+            "pages_written": changed,
+            "bytes_written": os.path.getsize(self._path(name)),
+            "db_bytes": page_count * page_size,
+            "removed_files": removed,
+            "seconds": round(time.perf_counter() - t0, 2),
+        }
+        log.info(f"[BACKUP INCR] {report}")
+        return report
+
+    def _meta(self) -> dict:
+        try:
+            with open(self._path("meta.json"), encoding="utf-8") as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_meta(self, meta: dict):
+        with open(self._path("meta.json"), "w", encoding="utf-8") as fh:
+            json.dump(meta, fh)
+
+    def _prune(self) -> int:
+        """Tiene le ultime keep_bases catene (ogni base con i delta che la seguono)."""
+        pts = self.points()
+        bases = [p for p in pts if p[1] == "base"]
+        if len(bases) <= self.keep_bases:
+            return 0
+        cutoff = bases[-self.keep_bases][0]
+        removed = 0
+        for when, _, name in pts:
+            if when < cutoff:
+                os.remove(self._path(name))
+                removed += 1
+        return removed
+
+    # --- ripristino ---
+    def restore(self, out_path: str, at: datetime | None = None) -> dict:
+        """Ricostruisce in out_path il DB com'era all'ultimo punto <= at (default: il più recente)."""
+        pts = [p for p in self.points() if at is None or p[0] <= at]
+        bases = [i for i, p in enumerate(pts) if p[1] == "base"]
+        if not bases:
+            raise ValueError("nessuna base archiviata prima del momento richiesto")
+        chain = pts[bases[-1]:]
+
+        tmp = out_path + ".restore"
+        with gzip.open(self._path(chain[0][2]), "rb") as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        with open(tmp, "r+b") as db:
+            for _, _, name in chain[1:]:
+                with gzip.open(self._path(name), "rb") as fh:
+                    head = json.loads(fh.readline())
+                    size = head["page_size"]
+                    while True:
+                        rec = fh.read(_REC.size)
+                        if not rec:
+                            break
+                        (pgno,) = _REC.unpack(rec)
+                        db.seek((pgno - 1) * size)
+                        db.write(fh.read(size))
+                    db.truncate(head["page_count"] * size)
+
+        check = verify_snapshot(tmp)
+        if check != "ok":
+            os.remove(tmp)
+            raise RuntimeError(f"DB ripristinato non valido: {check}")
+        os.replace(tmp, out_path)
+        return {"restored_at": chain[-1][0].isoformat(timespec="seconds"),
+                "base": chain[0][2], "deltas": len(chain) - 1, "path": out_path}
+
+    def status(self) -> dict:
+        pts = self.points()
+        return {
+            "archive_dir": self.archive_dir,
+            "points": [{"at": w.isoformat(timespec="seconds"), "kind": k, "file": n,
+                        "bytes": os.path.getsize(self._path(n))} for w, k, n in pts],
+            "archive_bytes": sum(os.path.getsize(self._path(n)) for _, _, n in pts),
+            "last_report": self.last_report,
+        }
+
+
+def main(argv=None):
+    """Dalla root del progetto:
+        python -m utils.incremental_backup run     DB ARCHIVIO [--base]
+        python -m utils.incremental_backup list    DB ARCHIVIO
+        python -m utils.incremental_backup restore DB ARCHIVIO OUT.db [--at "2025-10-18 14:30"]
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Backup incrementale a pagine e ripristino a un istante")
+    parser.add_argument("cmd", choices=("run", "list", "restore"))
+    parser.add_argument("db", help="percorso del file ristosmart.db")
+    parser.add_argument("archive", help="cartella dell'archivio incrementale")
+    parser.add_argument("out", nargs="?", help="(restore) file DB da creare")
+    parser.add_argument("--at", help="(restore) istante, es. '2025-10-18 14:30' (default: ultimo punto)")
+    parser.add_argument("--base", action="store_true", help="(run) forza una nuova base completa")
+    args = parser.parse_args(argv)
+
+    arch = IncrementalArchive(args.db, args.archive)
+    if args.cmd == "run":
+        print(json.dumps(arch.run(force_base=args.base), indent=2))
+    elif args.cmd == "list":
+        for p in arch.status()["points"]:
+            print(f"{p['at']}  {p['kind']:<5}  {p['bytes']:>12} byte  {p['file']}")
+    else:
+        if not args.out:
+            parser.error("restore richiede il file di destinazione")
+        at = datetime.fromisoformat(args.at) if args.at else None
+        print(json.dumps(arch.restore(args.out, at), indent=2))
+
+
+if __name__ == "__main__":
+    main()
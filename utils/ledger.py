@@ -0,0 +1,183 @@
+# utils/ledger.py
+from dataclasses import dataclass, field
+
+
+def year_bounds(anno: int):
+    """Intervallo [inizio, fine) dell'anno come date ISO, per filtri indicizzabili.
+
+    Con colonne data in formato 'YYYY-MM-DD[ HH:MM:SS]' il confronto testuale
+    equivale a strftime('%Y', col) = anno, ma usa gli indici (user_id, data).
+    """
+    return f"{int(anno):04d}-01-01", f"{int(anno) + 1:04d}-01-01"
+
+
+def month_bounds(anno: int, mese_num: int):
+    """Intervallo [inizio, fine) del mese come date ISO (vedi year_bounds)."""
+    anno, mese_num = int(anno), int(mese_num)
+    nxt_anno, nxt_mese = (anno + 1, 1) if mese_num == 12 else (anno, mese_num + 1)
+    return f"{anno:04d}-{mese_num:02d}-01", f"{nxt_anno:04d}-{nxt_mese:02d}-01"
+
+
+@dataclass
+class MonthLedger:
+    """Totali di un mese. I dict sono categoria/ente -> importo."""
+    mese_num: int
+    incassi: float = 0.0
+    spese_fisse: dict = field(default_factory=dict)
+    stipendi: float = 0.0
+    fatture: dict = field(default_factory=dict)
+    tasse: dict = field(default_factory=dict)
+
+    @property
+    def tot_spese_fisse(self) -> float:
+        return sum(self.spese_fisse.values())
+
+    @property
+    def tot_fatture(self) -> float:
+        return sum(self.fatture.values())
+
+    @property
+    def tot_tasse(self) -> float:
+        return sum(self.tasse.values())
+
+    @property
+    def tot_spese(self) -> float:
+        return self.tot_spese_fisse + self.stipendi + self.tot_fatture + self.tot_tasse
+
+
+@dataclass
+class AnnualLedger:
+    """Mese (1..12) x categoria per un utente e un anno."""
+    user_id: int
+    anno: int
+    mesi: dict = field(default_factory=lambda: {n: MonthLedger(n) for n in range(1, 13)})
+
+    def __getitem__(self, mese_num: int) -> MonthLedger:
+        return self.mesi[mese_num]
+
+    def __iter__(self):
+        return iter(self.mesi[n] for n in sorted(self.mesi))
+
+    def totali(self) -> dict:
+        """Totali annui per macro-categoria (usati dal grafico spese)."""
+        return {
+            "incassi": sum(m.incassi for m in self),
+            "spese_fisse": sum(m.tot_spese_fisse for m in self),
+            "stipendi": sum(m.stipendi for m in self),
+            "fatture": sum(m.tot_fatture for m in self),
+            "tasse": sum(m.tot_tasse for m in self),
+        }
+
+
+def _add(bucket: dict, key, value):
+    bucket[key] = bucket.get(key, 0.0) + float(value or 0.0)
+
+
+def compute_ledger(conn, user_id: int, anno: int, mese_num: int | None = None) -> AnnualLedger:
+    """Calcola tutti i totali mensili con una query GROUP BY per tabella sorgente.
+
+    Regole di competenza (uniche per tutte le pagine):
+      - incassi / spese_fisse / spese_fatture → anno + mese_num
+      - stipendi_personale                    → anno + mese (numerico), importo lordo
+      - fatture                               → data_inserimento
+      - tasse                                 → data_inserimento (solo enti dell'utente)
+    Le righe della vecchia tabella spese_fatture confluiscono nelle fatture.
+    Con mese_num valorizzato calcola solo quel mese (gli altri restano a zero).
+    """
+    ledger = AnnualLedger(user_id, anno)
+    if mese_num:
+        date_from, date_to = month_bounds(anno, mese_num)
+        m_sql, m_args = " AND mese_num = ?", (mese_num,)
+        sp_sql = " AND mese = ?"
+    else:
+        date_from, date_to = year_bounds(anno)
+        m_sql, m_args = " AND mese_num IS NOT NULL", ()
+        sp_sql = ""
+
+    for r in conn.execute(f"""
+        SELECT mese_num, SUM(valore) AS totale
+        FROM incassi
+        WHERE user_id = ? AND anno = ?{m_sql}
+        GROUP BY mese_num
+    """, (user_id, anno, *m_args)):
+        ledger[r[0]].incassi += float(r[1] or 0.0)
+
+    for r in conn.execute(f"""
+        SELECT mese_num, categoria, SUM(valore) AS totale
+        FROM spese_fisse
+        WHERE user_id = ? AND anno = ?{m_sql}
+        GROUP BY mese_num, categoria
+    """, (user_id, anno, *m_args)):
+        _add(ledger[r[0]].spese_fisse, r[1], r[2])
+
+    for r in conn.execute(f"""
+        SELECT mese_num, categoria, SUM(valore) AS totale
+        FROM spese_fatture
+        WHERE user_id = ? AND anno = ?{m_sql}
+        GROUP BY mese_num, categoria
+    """, (user_id, anno, *m_args)):
+        _add(ledger[r[0]].fatture, r[1], r[2])
+
+    for r in conn.execute(f"""
+        SELECT CAST(mese AS INTEGER) AS m, SUM(lordo) AS totale
+        FROM stipendi_personale
+        WHERE user_id = ? AND anno = ?{sp_sql}
+        GROUP BY m
+    """, (user_id, anno, *m_args)):
+        if r[0] in ledger.mesi:
+            ledger[r[0]].stipendi += float(r[1] or 0.0)
+
+    for r in conn.execute("""
+        SELECT CAST(strftime('%m', data_inserimento) AS INTEGER) AS m, categoria, SUM(importo) AS totale
+        FROM fatture
+        WHERE user_id = ? AND data_inserimento >= ? AND data_inserimento < ?
+        GROUP BY m, categoria
+    """, (user_id, date_from, date_to)):
+        if r[0] in ledger.mesi:
+            _add(ledger[r[0]].fatture, r[1], r[2])
+
+    for r in conn.execute("""
+        SELECT CAST(strftime('%m', t.data_inserimento) AS INTEGER) AS m, e.nome, SUM(t.importo) AS totale
+        FROM tasse t
+        JOIN ente e ON t.ente_id = e.id AND e.user_id = t.user_id
+        WHERE t.user_id = ? AND t.data_inserimento >= ? AND t.data_inserimento < ?
+        GROUP BY m, e.nome
+    """, (user_id, date_from, date_to)):
+        if r[0] in ledger.mesi:
+            _add(ledger[r[0]].tasse, r[1], r[2])
+
+    return ledger
+
+
+def load_ledger(conn, user_id: int, anno: int, mese_num: int | None = None) -> AnnualLedger:
+    """Come compute_ledger, ma legge i totali già aggregati da riepilogo_mensile.
+
+    Una sola query indicizzata sulla chiave primaria (user_id, anno, mese_num, ...);
+    la tabella è mantenuta dai trigger definiti in utils.riepilogo.
+    """
+    ledger = AnnualLedger(user_id, anno)
+    m_sql, m_args = (" AND r.mese_num = ?", (mese_num,)) if mese_num else ("", ())
+
+    for r in conn.execute(f"""
+        SELECT r.mese_num, r.source, r.categoria, r.totale, e.nome
+        FROM riepilogo_mensile r
+        LEFT JOIN ente e
+               ON r.source = 'tasse' AND e.id = CAST(r.categoria AS INTEGER) AND e.user_id = r.user_id
+        WHERE r.user_id = ? AND r.anno = ?{m_sql}
+    """, (user_id, anno, *m_args)):
+        mese, source, categoria, totale, ente = r[0], r[1], r[2], r[3], r[4]
+        if mese not in ledger.mesi:
+            continue
+        m = ledger[mese]
+        if source == "incassi":
+            m.incassi += float(totale or 0.0)
+        elif source == "spese_fisse":
+            _add(m.spese_fisse, categoria, totale)
+        elif source in ("spese_fatture", "fatture"):
+            _add(m.fatture, categoria, totale)
+        elif source == "stipendi":
+            m.stipendi += float(totale or 0.0)
+        elif source == "tasse" and ente is not None:
+            _add(m.tasse, ente, totale)
+
+    return ledger
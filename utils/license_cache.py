@@ -0,0 +1,95 @@
+# utils/license_cache.py
+import threading
+import time
+
+
+class LicenseCache:
+    """Cache TTL per-processo dello stato licenza, chiave (tipo, user_id, email).
+
+    I valori scadono dopo `ttl` secondi; le modifiche a licenze devono
+    comunque chiamare invalidate() per renderle visibili subito.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, ttl: float = 60.0, max_entries: int = 10000):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self._data = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _norm_email(email) -> str:
+        return (email or "").strip().lower()
+
+    def _key(self, kind: str, user_id, email):
+        return (kind, str(user_id or ""), self._norm_email(email))
+
+    def get(self, kind: str, user_id, email, default=None):
+        key = self._key(kind, user_id, email)
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+        return default
+
+    def set(self, kind: str, user_id, email, value):
+        if self.ttl <= 0:
+            return
+        key = self._key(kind, user_id, email)
+        with self._lock:
+            if len(self._data) >= self.max_entries and key not in self._data:
+                self._purge_expired()
+                if len(self._data) >= self.max_entries:
+                    self._data.clear()
+            self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def get_or_load(self, kind: str, user_id, email, loader):
+        """Ritorna il valore in cache o lo carica con loader() (le eccezioni non si cachano)."""
+        value = self.get(kind, user_id, email, self._MISSING)
+        if value is self._MISSING:
+            value = loader()
+            self.set(kind, user_id, email, value)
+        return value
+
+    def invalidate(self, user_id=None, email=None) -> int:
+        """Rimuove le voci dell'utente (per user_id e/o email). Senza argomenti svuota tutto."""
+        uid = str(user_id) if user_id not in (None, "") else None
+        em = self._norm_email(email) or None
+        with self._lock:
+            if uid is None and em is None:
+                n = len(self._data)
+                self._data.clear()
+            else:
+                drop = [k for k in self._data if (uid is not None and k[1] == uid) or (em is not None and k[2] == em)]
+                for k in drop:
+                    del self._data[k]
+                n = len(drop)
+            self.invalidations += 1
+        return n
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in self._data.items() if exp <= now]:
+            del self._data[k]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "ttl": self.ttl,
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "invalidations": self.invalidations,
+            }
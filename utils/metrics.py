@@ -0,0 +1,178 @@
+# utils/metrics.py
+import threading
+from bisect import bisect_left
+from collections import deque
+
+# Metriche per endpoint tenute in memoria (per processo): istogrammi a bucket
+# fissi, in stile Prometheus, di durata, tempo DB, numero di statement SQL e
+# dimensione della risposta.
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# nome Prometheus → (bucket, descrizione)
+METRICS = {
+    "request_duration_seconds": (SECONDS_BUCKETS, "Durata della richiesta (wall time)"),
+    "request_db_seconds": (SECONDS_BUCKETS, "Tempo speso in SQLite durante la richiesta"),
+    "request_sql_statements": (STATEMENT_BUCKETS, "Statement SQL eseguiti per richiesta"),
+    "response_size_bytes": (BYTES_BUCKETS, "Dimensione del corpo della risposta"),
+}
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count", "max")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # l'ultimo è +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float):
+        """Stima dal bucket: limite superiore del bucket che contiene il quantile."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def cumulative(self):
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            yield ("+Inf" if i == len(self.bounds) else _num(self.bounds[i])), seen
+
+
+class EndpointStats:
+    __slots__ = ("hist", "ordered", "status")
+
+    def __init__(self):
+        self.hist = {name: Histogram(bounds) for name, (bounds, _) in METRICS.items()}
+        self.ordered = tuple(self.hist.values())  # stesso ordine di METRICS, per _flush
+        self.status = {}
+
+
+class RequestMetrics:
+    """Registro delle metriche per (endpoint, metodo).
+
+    observe() accoda solo una tupla (deque.append è atomico): gli istogrammi si
+    aggiornano a blocchi di flush_every osservazioni o quando si leggono.
+    """
+
+    def __init__(self, prefix: str = "ristosmart", flush_every: int = 256):
+        self.prefix = prefix
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._stats = {}
+
+    def observe(self, endpoint: str, method: str, status: int, wall: float, db: float,
+                statements: int, size: int | None):
+        self._pending.append((endpoint, method, status, wall, db, statements, size))
+        if len(self._pending) >= self.flush_every:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            pending, stats = self._pending, self._stats
+            while pending:
+                try:
+                    endpoint, method, status, wall, db, statements, size = pending.popleft()
+                except IndexError:
+                    break
+                st = stats.get((endpoint, method))
+                if st is None:
+                    st = stats[(endpoint, method)] = EndpointStats()
+                st.status[status] = st.status.get(status, 0) + 1
+                w, d, n, z = st.ordered
+                w.observe(wall)
+                d.observe(db)
+                n.observe(statements)
+                if size is not None:  # dimensione ignota per le risposte in streaming
+                    z.observe(size)
+
+    def reset(self):
+        with self._lock:
+            self._pending.clear()
+            self._stats = {}
+
+    def _snapshot(self):
+        self._flush()
+        # copia sotto lock: l'export non blocca le richieste mentre formatta
+        with self._lock:
+            out = []
+            for key, st in self._stats.items():
+                copy = EndpointStats()
+                copy.status = dict(st.status)
+                for name, h in st.hist.items():
+                    c = copy.hist[name]
+                    c.counts, c.sum, c.count, c.max = list(h.counts), h.sum, h.count, h.max
+                out.append((key, copy))
+        return out
+
+    def to_json(self) -> list:
+        """Un record per endpoint, ordinati per tempo totale decrescente."""
+        rows = []
+        for (endpoint, method), st in self._snapshot():
+            wall, db = st.hist["request_duration_seconds"], st.hist["request_db_seconds"]
+            sql, size = st.hist["request_sql_statements"], st.hist["response_size_bytes"]
+            n = wall.count or 1
+            rows.append({
+                "endpoint": endpoint,
+                "method": method,
+                "requests": wall.count,
+                "status": {str(k): v for k, v in sorted(st.status.items())},
+                "total_ms": round(wall.sum * 1000, 1),
+                "avg_ms": round(wall.sum * 1000 / n, 2),
+                "p50_ms": round(wall.quantile(0.5) * 1000, 1),
+                "p95_ms": round(wall.quantile(0.95) * 1000, 1),
+                "max_ms": round(wall.max * 1000, 2),
+                "db_avg_ms": round(db.sum * 1000 / n, 2),
+                "db_share": round(db.sum / wall.sum, 3) if wall.sum else 0.0,
+                "sql_avg": round(sql.sum / n, 1),
+                "sql_max": int(sql.max),
+                "bytes_avg": round(size.sum / size.count) if size.count else None,
+            })
+        rows.sort(key=lambda r: -r["total_ms"])
+        return rows
+
+    def to_prometheus(self) -> str:
+        """Formato di esposizione testuale di Prometheus (version 0.0.4)."""
+        snap = sorted(self._snapshot(), key=lambda item: item[0])
+        p = self.prefix
+        lines = [f"# HELP {p}_requests_total Richieste servite per endpoint, metodo e status",
+                 f"# TYPE {p}_requests_total counter"]
+        for (endpoint, method), st in snap:
+            for status, n in sorted(st.status.items()):
+                lines.append(f'{p}_requests_total{{{_labels(endpoint, method)},status="{status}"}} {n}')
+        for name, (_, help_text) in METRICS.items():
+            lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} histogram")
+            for (endpoint, method), st in snap:
+                h, labels = st.hist[name], _labels(endpoint, method)
+                for le, n in h.cumulative():
+                    lines.append(f'{p}_{name}_bucket{{{labels},le="{le}"}} {n}')
+                lines.append(f"{p}_{name}_sum{{{labels}}} {_num(h.sum)}")
+                lines.append(f"{p}_{name}_count{{{labels}}} {h.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(endpoint: str, method: str) -> str:
+    esc = endpoint.replace("\\", "\\\\").replace('"', '\\"')
+    return f'endpoint="{esc}",method="{method}"'
+
+
+def _num(v) -> str:
+    return repr(float(v)) if isinstance(v, float) else str(v)
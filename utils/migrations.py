@@ -0,0 +1,107 @@
+# utils/migrations.py
+import time
+from datetime import datetime
+
+# Registro delle migrazioni dello schema. La versione del DB è PRAGMA user_version
+# (un intero nell'header del file): all'avvio basta confrontarla con l'ultima
+# migrazione registrata. Se il DB è indietro si applicano solo quelle mancanti,
+# tutte in un'unica transazione, e ognuna lascia una riga in schema_migrations.
+DDL_SCHEMA_MIGRATIONS = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version     INTEGER PRIMARY KEY,
+        name        TEXT NOT NULL,
+        applied_at  TEXT NOT NULL,
+        duration_ms REAL NOT NULL DEFAULT 0
+    )
+"""
+
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+class Migration:
+    def __init__(self, version: int, name: str, func):
+        self.version = version
+        self.name = name
+        self.func = func
+
+
+class MigrationRegistry:
+    """Migrazioni numerate 1..N, registrate con @registry.register(n, "descrizione").
+
+    Le funzioni ricevono la connessione e non fanno commit: ci pensa migrate().
+    Una migrazione già rilasciata non si modifica più; per cambiare lo schema
+    se ne aggiunge una nuova con il numero successivo.
+    """
+
+    def __init__(self):
+        self._items = {}
+
+    def register(self, version: int, name: str):
+        def deco(func):
+            if version in self._items:
+                raise ValueError(f"migrazione {version} già registrata")
+            self._items[version] = Migration(version, name, func)
+            return func
+        return deco
+
+    @property
+    def latest(self) -> int:
+        return max(self._items, default=0)
+
+    def pending(self, current: int) -> list:
+        return [self._items[v] for v in sorted(self._items) if v > current]
+
+    def migrate(self, conn, logger=None) -> list:
+        """Porta il DB all'ultima versione. Ritorna le migrazioni applicate [(versione, nome)]."""
+        if schema_version(conn) >= self.latest:
+            return []  # percorso normale all'avvio: un solo PRAGMA
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # riletta sotto lock: un altro processo può averle appena applicate
+            current = schema_version(conn)
+            conn.execute(DDL_SCHEMA_MIGRATIONS)
+            applied = []
+            for m in self.pending(current):
+                t0 = time.perf_counter()
+                m.func(conn)
+                conn.execute(
+                    "INSERT OR REPLACE INTO schema_migrations (version, name, applied_at, duration_ms) VALUES (?, ?, ?, ?)",
+                    (m.version, m.name, datetime.now().isoformat(timespec="seconds"),
+                     round((time.perf_counter() - t0) * 1000, 1)),
+                )
+                applied.append((m.version, m.name))
+            if applied:
+                conn.execute(f"PRAGMA user_version = {int(self.latest)}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+        for version, name in applied:
+            msg = f"[DB] migrazione {version} applicata: {name}"
+            if logger is not None:
+                logger.info(msg)
+            else:
+                print(msg, flush=True)
+        return applied
+
+    def status(self, conn) -> dict:
+        """Versione del DB, ultima disponibile, storico applicato e migrazioni mancanti."""
+        current = schema_version(conn)
+        has_log = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='schema_migrations'"
+        ).fetchone()
+        history = [dict(zip(("version", "name", "applied_at", "duration_ms"), row)) for row in conn.execute(
+            "SELECT version, name, applied_at, duration_ms FROM schema_migrations ORDER BY version"
+        )] if has_log else []
+        return {
+            "user_version": current,
+            "latest": self.latest,
+            "up_to_date": current == self.latest,
+            "ahead": current > self.latest,  # DB migrato da una versione più nuova dell'app
+            "pending": [{"version": m.version, "name": m.name} for m in self.pending(current)],
+            "history": history,
+        }
@@ -0,0 +1,247 @@
+# utils/outbox.py
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+from email.mime.text import MIMEText
+
+log = logging.getLogger("ristosmart.outbox")
+
+# Coda persistente delle email: chi invia fa enqueue() e ritorna subito,
+# il worker in background consegna con retry + backoff esponenziale.
+DDL_OUTBOX = """
+    CREATE TABLE IF NOT EXISTS email_outbox (
+        id              INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id         INTEGER,
+        tag             TEXT,
+        to_email        TEXT NOT NULL,
+        subject         TEXT NOT NULL DEFAULT '',
+        body            TEXT NOT NULL DEFAULT '',
+        from_name       TEXT NOT NULL DEFAULT 'RistoSmart FM',
+        status          TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | sent | failed
+        attempts        INTEGER NOT NULL DEFAULT 0,
+        max_attempts    INTEGER NOT NULL DEFAULT 5,
+        next_attempt_at REAL NOT NULL,                    -- epoch secondi
+        claimed_at      REAL,
+        last_error      TEXT,
+        created_at      TEXT NOT NULL DEFAULT (datetime('now')),
+        sent_at         TEXT
+    )
+"""
+
+OUTBOX_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_outbox_status_next ON email_outbox(status, next_attempt_at)",
+    "CREATE INDEX IF NOT EXISTS ix_outbox_user ON email_outbox(user_id, id)",
+)
+
+
+def ensure_outbox(conn):
+    conn.execute(DDL_OUTBOX)
+    for ddl in OUTBOX_INDEXES:
+        conn.execute(ddl)
+
+
+def enqueue(conn, items, tag=None, user_id=None, from_name="RistoSmart FM", max_attempts=5) -> list:
+    """Accoda items ([{"email", "subject", "body"}]) e ritorna gli id creati. Non fa commit."""
+    now = time.time()
+    ids = []
+    for it in items:
+        to_email = (it.get("email") or "").strip()
+        if not to_email:
+            continue
+        cur = conn.execute("""
+            INSERT INTO email_outbox (user_id, tag, to_email, subject, body, from_name, max_attempts, next_attempt_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, tag, to_email, it.get("subject") or "", it.get("body") or "",
+              from_name, int(max_attempts), now))
+        ids.append(cur.lastrowid)
+    return ids
+
+
+def outbox_status(conn, ids=None, user_id=None) -> dict:
+    """Stato di consegna: conteggi per stato e (se richiesti) il dettaglio degli id."""
+    where, args = [], []
+    if user_id is not None:
+        where.append("user_id = ?")
+        args.append(user_id)
+    if ids:
+        where.append(f"id IN ({','.join('?' * len(ids))})")
+        args.extend(int(i) for i in ids)
+    w = (" WHERE " + " AND ".join(where)) if where else ""
+
+    counts = {s: 0 for s in ("pending", "sending", "sent", "failed")}
+    for r in conn.execute(f"SELECT status, COUNT(*) FROM email_outbox{w} GROUP BY status", args):
+        counts[r[0]] = r[1]
+
+    out = {"counts": counts}
+    if ids:
+        out["items"] = [
+            {"id": r[0], "email": r[1], "status": r[2], "attempts": r[3], "last_error": r[4], "sent_at": r[5]}
+            for r in conn.execute(
+                f"SELECT id, to_email, status, attempts, last_error, sent_at FROM email_outbox{w} ORDER BY id", args
+            )
+        ]
+    return out
+
+
+def build_message(to_email: str, subject: str, body: str, from_name: str, from_addr: str) -> MIMEText:
+    subtype = "html" if ("<html" in (body or "").lower() or "<!doctype" in (body or "").lower()) else "plain"
+    msg = MIMEText(body, subtype, "utf-8")
+    msg["Subject"] = subject
+    msg["From"] = f"{from_name} <{from_addr}>"
+    msg["To"] = to_email
+    return msg
+
+
+def smtp_sender(host, port, user="", password="", starttls=True, timeout=20):
+    """Ritorna send(items) → results che invia tutto su UNA sessione SMTP.
+
+    Con starttls=False e senza credenziali funziona contro un SMTP locale
+    (es. `python -m aiosmtpd -n -l localhost:8025`) per i test.
+    """
+    def send(items):
+        import smtplib, ssl
+        results = []
+        with smtplib.SMTP(host, port, timeout=timeout) as smtp:
+            smtp.ehlo()
+            if starttls:
+                smtp.starttls(context=ssl.create_default_context())
+            if user:
+                smtp.login(user, password)
+            for it in items:
+                to_email = (it.get("email") or "").strip()
+                msg = build_message(to_email, it.get("subject") or "", it.get("body") or "",
+                                    it.get("from_name") or "RistoSmart FM", user or "noreply@localhost")
+                try:
+                    smtp.sendmail(user or "noreply@localhost", [to_email], msg.as_string())
+                    results.append({"email": to_email, "ok": True})
+                except Exception as e:
+                    results.append({"email": to_email, "ok": False, "err": str(e)})
+        return results
+    return send
+
+
+class OutboxWorker(threading.Thread):
+    """Thread che svuota email_outbox.
+
+    connect: callable che ritorna una connessione sqlite3 (chiusa dal worker con close()).
+    send:    callable(items) → [{"email", "ok", "err"}] nello stesso ordine degli items,
+             oppure (results, report): il report (es. throughput) resta in last_report.
+    I record vengono presi con un UPDATE atomico (status → 'sending'), quindi più
+    worker/processi sullo stesso DB non consegnano due volte lo stesso messaggio.
+    """
+
+    def __init__(self, connect, send, batch_size=50, poll_interval=5.0,
+                 backoff_base=30.0, backoff_max=3600.0, lease_seconds=600.0):
+        super().__init__(name="email-outbox", daemon=True)
+        self.connect = connect
+        self.send = send
+        self.batch_size = int(batch_size)
+        self.poll_interval = float(poll_interval)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.lease_seconds = float(lease_seconds)
+        self._wake = threading.Event()
+        self._halt = threading.Event()
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.last_report = None
+
+    # --- controllo ---
+    def notify(self):
+        """Sveglia il worker (dopo un enqueue) senza attendere il poll."""
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        self._halt.set()
+        self._wake.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._halt.is_set():
+            try:
+                n = self.drain_once()
+            except Exception as e:
+                n = 0
+                log.warning(f"[OUTBOX WARN] {e}")
+            if n == 0:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    # --- lavoro ---
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_base * (2 ** max(attempts - 1, 0)), self.backoff_max)
+        return delay * random.uniform(0.8, 1.2)
+
+    def _claim(self, conn) -> list:
+        now = time.time()
+        with conn:
+            # lease scaduto: il processo che li aveva presi è morto a metà invio
+            conn.execute("""
+                UPDATE email_outbox SET status = 'pending', claimed_at = NULL
+                WHERE status = 'sending' AND claimed_at < ?
+            """, (now - self.lease_seconds,))
+            rows = conn.execute("""
+                UPDATE email_outbox SET status = 'sending', claimed_at = ?, attempts = attempts + 1
+                WHERE id IN (
+                    SELECT id FROM email_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id
+                    LIMIT ?
+                )
+                RETURNING id, to_email, subject, body, from_name, attempts, max_attempts
+            """, (now, now, self.batch_size)).fetchall()
+        return [tuple(r) for r in rows]
+
+    def drain_once(self) -> int:
+        """Consegna un lotto di messaggi in scadenza. Ritorna quanti ne ha processati."""
+        conn = self.connect()
+        try:
+            rows = self._claim(conn)
+            if not rows:
+                return 0
+
+            items = [{"email": r[1], "subject": r[2], "body": r[3], "from_name": r[4]} for r in rows]
+            try:
+                out = self.send(items)
+                if isinstance(out, tuple):
+                    out, self.last_report = out
+                results = list(out or [])
+            except Exception as e:
+                # connessione/login falliti: tutto il lotto va in retry
+                results = [{"email": it["email"], "ok": False, "err": str(e)} for it in items]
+            results += [{"ok": False, "err": "nessun esito dal sender"}] * (len(rows) - len(results))
+
+            now = time.time()
+            ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with conn:
+                for (oid, _, _, _, _, attempts, max_attempts), res in zip(rows, results):
+                    if res.get("ok"):
+                        conn.execute("""
+                            UPDATE email_outbox SET status = 'sent', sent_at = ?, last_error = NULL, claimed_at = NULL
+                            WHERE id = ?
+                        """, (ts, oid))
+                        self.sent += 1
+                    elif attempts >= max_attempts:
+                        conn.execute("""
+                            UPDATE email_outbox SET status = 'failed', last_error = ?, claimed_at = NULL
+                            WHERE id = ?
+                        """, (res.get("err") or "", oid))
+                        self.failed += 1
+                    else:
+                        conn.execute("""
+                            UPDATE email_outbox SET status = 'pending', last_error = ?, claimed_at = NULL,
+                                   next_attempt_at = ?
+                            WHERE id = ?
+                        """, (res.get("err") or "", now + self.backoff(attempts), oid))
+                        self.retried += 1
+            return len(rows)
+        finally:
+            conn.close()
+
+    def stats(self) -> dict:
+        return {"alive": self.is_alive(), "sent": self.sent, "failed": self.failed,
+                "retried": self.retried, "last_report": self.last_report}
@@ -0,0 +1,294 @@
+# utils/pdf_render.py
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+
+from utils.charts import spese_plot_png
+
+# Layout PDF: funzioni pure, dati semplici in ingresso (liste/dict/str) e bytes in uscita,
+# così possono girare in un processo separato senza toccare DB o Flask.
+
+
+def stipendi_pdf(anno, rows) -> bytes:
+    """Riepilogo stipendi dell'anno; rows: liste già formattate (8 colonne)."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import cm
+    from reportlab.pdfgen import canvas
+
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+
+    c.setFont("Helvetica-Bold", 14)
+    c.drawString(2 * cm, height - 2 * cm, f"Riepilogo stipendi - Anno {anno}")
+
+    headers = ["Nome", "Ruolo", "Mese", "Lordo", "Netto", "Contributi", "Totale", "Stato"]
+    y = height - 3 * cm
+    line_height = 0.6 * cm
+
+    c.setFont("Helvetica-Bold", 10)
+    for i, col in enumerate(headers):
+        c.drawString((1 + i * 2.5) * cm, y, col)
+    y -= line_height
+    c.setFont("Helvetica", 9)
+
+    for row in rows:
+        if y < 2 * cm:
+            c.showPage()
+            y = height - 3 * cm
+            c.setFont("Helvetica-Bold", 10)
+            for i, col in enumerate(headers):
+                c.drawString((1 + i * 2.5) * cm, y, col)
+            y -= line_height
+            c.setFont("Helvetica", 9)
+        for i, value in enumerate(row):
+            c.drawString((1 + i * 2.5) * cm, y, str(value))
+        y -= line_height
+
+    c.save()
+    return buffer.getvalue()
+
+
+def payroll_qr_pdf(voci, esclusi, periodo) -> bytes:
+    """Una pagina per dipendente (QR + dati), più l'elenco degli esclusi."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import cm
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    buf = BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    w, h = A4
+    for v in voci:
+        c.setFont("Helvetica-Bold", 16)
+        c.drawString(2 * cm, h - 2.5 * cm, f"Stipendio {periodo}")
+        c.setFont("Helvetica", 11)
+        y = h - 4 * cm
+        for label, val in (("Beneficiario", v["nome"]), ("Categoria", v["categoria"]),
+                           ("Importo netto", f"€ {v['netto']:.2f}"), ("IBAN", v["iban"]),
+                           ("Causale", v["causale"])):
+            c.drawString(2 * cm, y, f"{label}: {val}")
+            y -= 0.7 * cm
+        c.drawImage(ImageReader(BytesIO(v["png"])), 2 * cm, y - 10 * cm, width=9 * cm, height=9 * cm)
+        c.showPage()
+    if esclusi:
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(2 * cm, h - 2.5 * cm, "Dipendenti esclusi")
+        c.setFont("Helvetica", 10)
+        y = h - 3.5 * cm
+        for e in esclusi:
+            c.drawString(2 * cm, y, f"{e['nome']}: {e['motivo']}")
+            y -= 0.6 * cm
+            if y < 2 * cm:
+                c.showPage()
+                c.setFont("Helvetica", 10)
+                y = h - 2 * cm
+        c.showPage()
+    c.save()
+    return buf.getvalue()
+
+
+def pagamenti_tasse_pdf(tasse) -> bytes:
+    """Dettaglio tasse (FPDF); tasse: dict con ente_nome, causale, scadenza, data_inserimento, importo, stato."""
+    from fpdf import FPDF
+
+    pdf = FPDF()
+    pdf.add_page()
+    pdf.set_font("Arial", size=12)
+    pdf.cell(0, 10, "Dettaglio Tasse", ln=True, align="C")
+    pdf.ln(5)
+
+    for idx, t in enumerate(tasse, start=1):
+        pdf.set_font("Arial", "B", 11)
+        pdf.multi_cell(0, 8, f"{idx}) Ente: {t['ente_nome']}")
+        pdf.set_font("Arial", "", 10)
+        pdf.multi_cell(0, 6, f"Causale: {t['causale']}")
+        pdf.multi_cell(0, 6, f"Scadenza: {t['scadenza']} - Inserita: {t['data_inserimento']}")
+        pdf.multi_cell(0, 6, f"Importo: EUR {t['importo']:.2f} | Stato: {t['stato'].capitalize()}")
+        pdf.ln(6)
+
+    return pdf.output(dest="S").encode("latin-1")
+
+
+def enti_pdf(enti, data_export) -> bytes:
+    """Elenco enti fiscali e contributivi (platypus); enti: dict con nome, telefono, email, iban, bic."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    buf = BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4)
+    styles = getSampleStyleSheet()
+    elements = [
+        Paragraph("📋 Elenco Enti Fiscali & Contributivi", styles['Title']),
+        Spacer(1, 12),
+        Paragraph(f"Esportato il {data_export}", styles['Normal']),
+        Spacer(1, 24),
+    ]
+
+    data = [["Nome", "Telefono", "Email", "IBAN", "BIC"]]
+    for e in enti:
+        data.append([e["nome"], e["telefono"] or "", e["email"] or "", e["iban"] or "", e["bic"] or ""])
+
+    # Larghezze colonne ottimizzate (totale ~7.5")
+    col_widths = [1.3 * inch, 1.2 * inch, 1.8 * inch, 1.8 * inch, 1.4 * inch]
+    table = Table(data, colWidths=col_widths, repeatRows=1)
+    table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor("#003366")),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 8),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 4),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.HexColor("#cccccc")),
+        ('FONTSIZE', (0, 1), (-1, -1), 7),
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('WORDWRAP', (0, 0), (-1, -1), True),
+        ('TEXT_OVERFLOW', (0, 0), (-1, -1), 'ELLIPSIS'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 2),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 2)
+    ]))
+    elements += [table, Spacer(1, 12), Paragraph("Documento generato da RistoSmartFM", styles['Italic'])]
+
+    doc.build(elements)
+    return buf.getvalue()
+
+
+LAYOUTS = {
+    "stipendi": stipendi_pdf,
+    "payroll_qr": payroll_qr_pdf,
+    "pagamenti_tasse": pagamenti_tasse_pdf,
+    "enti": enti_pdf,
+    # non solo PDF: anche i grafici matplotlib (PNG) girano nello stesso pool
+    "spese_plot": spese_plot_png,
+}
+
+
+def _render(layout, args):
+    # eseguita nel processo worker
+    return LAYOUTS[layout](*args)
+
+
+class PdfQueueFull(RuntimeError):
+    """Troppi PDF in attesa: la richiesta va rifiutata (503) invece di accodarla."""
+
+
+class PdfRenderer:
+    """Rendering PDF in un process pool limitato.
+
+    workers=0 esegue il layout nel thread chiamante (utile in debug).
+    max_pending limita i lavori in coda + in esecuzione; oltre si solleva PdfQueueFull.
+    Il pool nasce al primo render(), non all'import; se un worker muore il pool
+    rotto viene scartato e il render ritentato una volta su uno nuovo.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 16, timeout: float = 60.0):
+        self.workers = max(int(workers or 0), 0)
+        self.max_pending = max(int(max_pending or 1), 1)
+        self.timeout = float(timeout)
+        self._pool = None
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.broken = 0
+        self.total_seconds = 0.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _drop_pool(self, pool):
+        # un worker morto (OOM, kill) rompe tutto il pool: si butta e il prossimo
+        # _get_pool() ne crea uno nuovo (se un altro thread non l'ha già fatto)
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self.broken += 1
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def render(self, layout: str, *args, timeout: float | None = None) -> bytes:
+        """Bytes del PDF. Solleva PdfQueueFull, TimeoutError o l'eccezione del layout."""
+        if layout not in LAYOUTS:
+            raise KeyError(f"layout PDF sconosciuto: {layout}")
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise PdfQueueFull(f"{self.pending} PDF già in coda")
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+
+        t0 = time.perf_counter()
+        ok = held = False
+        try:
+            if self.workers == 0:
+                out = _render(layout, args)
+            else:
+                for attempt in (1, 2):
+                    pool = self._get_pool()
+                    try:
+                        fut = pool.submit(_render, layout, args)
+                        out = fut.result(timeout=self.timeout if timeout is None else timeout)
+                        break
+                    except BrokenProcessPool:
+                        self._drop_pool(pool)
+                        if attempt == 2:
+                            raise
+                    except FuturesTimeout:
+                        # se è già partito il worker lo finisce comunque: il suo posto
+                        # in coda si libera solo quando termina, così max_pending
+                        # limita anche il lavoro che nessuno aspetta più
+                        if not fut.cancel():
+                            fut.add_done_callback(self._release)
+                            held = True
+                        with self._lock:
+                            self.timeouts += 1
+                        raise TimeoutError(f"PDF '{layout}' non pronto entro il timeout") from None
+            ok = True
+            return out
+        finally:
+            with self._lock:
+                if not held:
+                    self.pending -= 1
+                self.total_seconds += time.perf_counter() - t0
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def _release(self, fut):
+        with self._lock:
+            self.pending -= 1
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self.completed + self.failed
+            return {
+                "workers": self.workers,
+                "max_pending": self.max_pending,
+                "timeout": self.timeout,
+                "queue_depth": self.pending,
+                "peak_queue_depth": self.peak_pending,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "broken_pools": self.broken,
+                "avg_seconds": round(self.total_seconds / done, 4) if done else 0.0,
+            }
@@ -0,0 +1,227 @@
+# utils/qr.py
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+
+def _qrcode():
+    """Modulo qrcode (con PIL) importato al primo QR, non all'avvio."""
+    import qrcode
+    return qrcode
+
+
+def build_epc_payload(iban, beneficiario, importo, causale="", bic="", purpose="") -> str:
+    """Stringa EPC QR (EPC069-12, versione 002) per bonifico SEPA.
+
+    Unico builder per tutti i QR di pagamento: stessi limiti di lunghezza,
+    stesso formato importo, causale nel campo "remittance" non strutturato.
+    """
+    lines = [
+        "BCD",                                            # Service tag
+        "002",                                            # Versione (BIC facoltativo)
+        "1",                                              # UTF-8
+        "SCT",                                            # SEPA Credit Transfer
+        (bic or "").replace(" ", "").upper()[:11],        # BIC
+        (beneficiario or "").strip()[:70],                # Beneficiario
+        (iban or "").replace(" ", "").upper()[:34],       # IBAN
+        f"EUR{float(importo or 0):.2f}",                  # Importo
+        (purpose or "")[:4],                              # Purpose code
+        "",                                               # Riferimento strutturato (non usato)
+        (causale or "").strip()[:140],                    # Causale
+    ]
+    return "\n".join(lines)
+
+
+def render_png(payload: str) -> bytes:
+    qr = _qrcode().QRCode(version=1, box_size=10, border=4)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buf = BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class QRCache:
+    """PNG dei QR per hash del payload: LRU in memoria con budget in byte
+    e, se disk_dir è impostata, un secondo livello su disco.
+    """
+
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024, disk_dir: str | None = None):
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = disk_dir or None
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+        self._lru = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(payload: str) -> str:
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], key + ".png")
+
+    def _put_mem(self, key: str, png: bytes):
+        if len(png) > self.max_bytes:
+            return
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old)
+        self._lru[key] = png
+        self._bytes += len(png)
+        while self._bytes > self.max_bytes and self._lru:
+            _, dropped = self._lru.popitem(last=False)
+            self._bytes -= len(dropped)
+            self.evictions += 1
+
+    def lookup(self, payload: str) -> bytes | None:
+        """PNG già pronto (memoria, poi disco) oppure None. Non renderizza."""
+        key = self.key(payload)
+        with self._lock:
+            png = self._lru.get(key)
+            if png is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return png
+
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), "rb") as fh:
+                    png = fh.read()
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_mem(key, png)
+                return png
+            except OSError:
+                pass
+        return None
+
+    def store(self, payload: str, png: bytes):
+        """Registra un PNG appena renderizzato (conta come miss)."""
+        key = self.key(payload)
+        with self._lock:
+            self.misses += 1
+            self._put_mem(key, png)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as fh:
+                    fh.write(png)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+
+    def get_png(self, payload: str) -> bytes:
+        png = self.lookup(payload)
+        if png is None:
+            png = render_png(payload)  # fuori dal lock: è il lavoro CPU
+            self.store(payload, png)
+        return png
+
+    def data_uri(self, payload: str) -> str:
+        return "data:image/png;base64," + base64.b64encode(self.get_png(payload)).decode("ascii")
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._lru),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "disk_dir": self.disk_dir,
+            }
+
+
+# --- Rendering in parallelo (batch): process pool condiviso, creato al primo uso ---
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class QRPoolBroken(RuntimeError):
+    """Un worker del pool è morto: il pool è stato scartato, la richiesta va ritentata (503)."""
+
+
+def _get_pool(max_workers: int):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            from concurrent.futures import ProcessPoolExecutor
+            _POOL = ProcessPoolExecutor(max_workers=max_workers)
+        return _POOL
+
+
+def _drop_pool(pool):
+    # scarta il pool rotto (se nel frattempo non è già stato sostituito)
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not pool:
+            return
+        _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_pool():
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_many(payloads, cache: QRCache | None = None, max_workers: int = 2,
+                timeout: float = 60.0, inline_below: int = 4) -> list:
+    """PNG per ogni payload (stesso ordine). Usa la cache se data; i mancanti
+    sono codificati in un process pool. Entro `timeout` secondi complessivi,
+    altrimenti solleva TimeoutError; QRPoolBroken se un worker muore.
+    """
+    payloads = list(payloads)
+    out = [cache.lookup(p) if cache is not None else None for p in payloads]
+    todo = [i for i, png in enumerate(out) if png is None]
+
+    if len(todo) < inline_below:
+        for i in todo:
+            out[i] = cache.get_png(payloads[i]) if cache is not None else render_png(payloads[i])
+        return out
+
+    from concurrent.futures import wait, FIRST_EXCEPTION
+    from concurrent.futures.process import BrokenProcessPool
+    pool = _get_pool(max_workers)
+    try:
+        futures = {i: pool.submit(render_png, payloads[i]) for i in todo}
+        done, pending = wait(futures.values(), timeout=timeout, return_when=FIRST_EXCEPTION)
+        for f in pending:
+            f.cancel()
+        failed = next((f.exception() for f in done if f.exception() is not None), None)
+        if failed is not None:
+            raise failed
+        if pending:
+            raise TimeoutError(f"rendering QR non completato in {timeout}s ({len(pending)} mancanti)")
+    except BrokenProcessPool as e:
+        _drop_pool(pool)
+        raise QRPoolBroken("worker QR terminato, pool ricreato al prossimo uso") from e
+    for i, f in futures.items():
+        out[i] = f.result()
+        if cache is not None:
+            cache.store(payloads[i], out[i])
+    return out
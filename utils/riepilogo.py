@@ -0,0 +1,192 @@
+# utils/riepilogo.py
+import sqlite3
+
+# Tabella riassuntiva mantenuta dai trigger: una riga per
+# (utente, anno, mese, sorgente, categoria) con totale e numero di righe base.
+DDL_RIEPILOGO = """
+    CREATE TABLE IF NOT EXISTS riepilogo_mensile (
+        user_id   INTEGER NOT NULL,
+        anno      INTEGER NOT NULL,
+        mese_num  INTEGER NOT NULL,
+        source    TEXT NOT NULL,
+        categoria TEXT NOT NULL DEFAULT '',
+        totale    REAL NOT NULL DEFAULT 0,
+        righe     INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, anno, mese_num, source, categoria)
+    ) WITHOUT ROWID
+"""
+
+# Regole di competenza (le stesse di utils.ledger.compute_ledger).
+# {R} è il riferimento alla riga: NEW/OLD nei trigger, la tabella nel rebuild.
+SOURCES = {
+    "incassi": dict(
+        source="incassi", anno="{R}.anno", mese="{R}.mese_num",
+        categoria="''", valore="{R}.valore",
+        where="{R}.mese_num IS NOT NULL",
+    ),
+    "spese_fisse": dict(
+        source="spese_fisse", anno="{R}.anno", mese="{R}.mese_num",
+        categoria="COALESCE({R}.categoria, '')", valore="{R}.valore",
+        where="{R}.mese_num IS NOT NULL",
+    ),
+    "spese_fatture": dict(
+        source="spese_fatture", anno="{R}.anno", mese="{R}.mese_num",
+        categoria="COALESCE({R}.categoria, '')", valore="{R}.valore",
+        where="{R}.mese_num IS NOT NULL",
+    ),
+    "stipendi_personale": dict(
+        source="stipendi", anno="{R}.anno", mese="CAST({R}.mese AS INTEGER)",
+        categoria="''", valore="{R}.lordo",
+        where="CAST({R}.mese AS INTEGER) BETWEEN 1 AND 12",
+    ),
+    "fatture": dict(
+        source="fatture",
+        anno="CAST(strftime('%Y', {R}.data_inserimento) AS INTEGER)",
+        mese="CAST(strftime('%m', {R}.data_inserimento) AS INTEGER)",
+        categoria="COALESCE({R}.categoria, '')", valore="{R}.importo",
+        where="strftime('%m', {R}.data_inserimento) IS NOT NULL",
+    ),
+    # tasse: categoria = id ente, il nome si risolve in lettura (può cambiare)
+    "tasse": dict(
+        source="tasse",
+        anno="CAST(strftime('%Y', {R}.data_inserimento) AS INTEGER)",
+        mese="CAST(strftime('%m', {R}.data_inserimento) AS INTEGER)",
+        categoria="COALESCE(CAST({R}.ente_id AS TEXT), '')", valore="{R}.importo",
+        where="strftime('%m', {R}.data_inserimento) IS NOT NULL",
+    ),
+}
+
+
+def _fmt(expr: str, ref: str) -> str:
+    return expr.replace("{R}", ref)
+
+
+def _apply_sql(spec: dict, ref: str, sign: str) -> str:
+    """Statement che aggiunge (sign='+') o toglie (sign='-') la riga {ref} dal riepilogo."""
+    return f"""
+        INSERT INTO riepilogo_mensile (user_id, anno, mese_num, source, categoria, totale, righe)
+        SELECT {ref}.user_id, {_fmt(spec['anno'], ref)}, {_fmt(spec['mese'], ref)}, '{spec['source']}',
+               {_fmt(spec['categoria'], ref)}, {sign}COALESCE({_fmt(spec['valore'], ref)}, 0), {sign}1
+        WHERE {_fmt(spec['where'], ref)}
+        ON CONFLICT (user_id, anno, mese_num, source, categoria) DO UPDATE SET
+            totale = totale + excluded.totale,
+            righe  = righe + excluded.righe;"""
+
+
+def _prune_sql(spec: dict, ref: str) -> str:
+    """Elimina la riga di riepilogo rimasta senza righe base."""
+    return f"""
+        DELETE FROM riepilogo_mensile
+         WHERE user_id = {ref}.user_id AND anno = {_fmt(spec['anno'], ref)}
+           AND mese_num = {_fmt(spec['mese'], ref)} AND source = '{spec['source']}'
+           AND categoria = {_fmt(spec['categoria'], ref)} AND righe <= 0;"""
+
+
+def trigger_ddl(table: str) -> list:
+    spec = SOURCES[table]
+    return [
+        f"""CREATE TRIGGER IF NOT EXISTS rm_{table}_ins AFTER INSERT ON {table}
+        BEGIN{_apply_sql(spec, 'NEW', '')}
+        END;""",
+        f"""CREATE TRIGGER IF NOT EXISTS rm_{table}_del AFTER DELETE ON {table}
+        BEGIN{_apply_sql(spec, 'OLD', '-')}{_prune_sql(spec, 'OLD')}
+        END;""",
+        f"""CREATE TRIGGER IF NOT EXISTS rm_{table}_upd AFTER UPDATE ON {table}
+        BEGIN{_apply_sql(spec, 'OLD', '-')}{_prune_sql(spec, 'OLD')}{_apply_sql(spec, 'NEW', '')}
+        END;""",
+    ]
+
+
+def _expected_sql(table: str) -> str:
+    """Aggregato calcolato dalla tabella base, stessa forma di riepilogo_mensile."""
+    spec = SOURCES[table]
+    return f"""
+        SELECT user_id, {_fmt(spec['anno'], table)} AS anno, {_fmt(spec['mese'], table)} AS mese_num,
+               '{spec['source']}' AS source, {_fmt(spec['categoria'], table)} AS categoria,
+               SUM(COALESCE({_fmt(spec['valore'], table)}, 0)) AS totale, COUNT(*) AS righe
+        FROM {table}
+        WHERE {_fmt(spec['where'], table)}
+        GROUP BY 1, 2, 3, 5"""
+
+
+def ensure_riepilogo(conn) -> bool:
+    """Crea tabella + trigger. Ritorna True se la tabella è nuova (e quindi riempita ora)."""
+    existed = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='riepilogo_mensile'"
+    ).fetchone()
+    conn.execute(DDL_RIEPILOGO)
+    for table in SOURCES:
+        for ddl in trigger_ddl(table):
+            conn.execute(ddl)
+    if not existed:
+        rebuild_riepilogo(conn)
+    return not existed
+
+
+def rebuild_riepilogo(conn) -> int:
+    """Ricostruisce il riepilogo da zero dalle tabelle base. Ritorna le righe scritte."""
+    conn.execute("DELETE FROM riepilogo_mensile")
+    written = 0
+    for table in SOURCES:
+        cur = conn.execute(
+            "INSERT INTO riepilogo_mensile (user_id, anno, mese_num, source, categoria, totale, righe) "
+            + _expected_sql(table)
+        )
+        written += cur.rowcount or 0
+    return written
+
+
+def verify_riepilogo(conn, tolerance: float = 0.005) -> list:
+    """Confronta il riepilogo con le tabelle base. Ritorna le differenze (lista vuota = ok)."""
+    expected = {}
+    for table in SOURCES:
+        for r in conn.execute(_expected_sql(table)):
+            expected[tuple(r[:5])] = (float(r[5] or 0.0), int(r[6] or 0))
+
+    actual = {
+        tuple(r[:5]): (float(r[5] or 0.0), int(r[6] or 0))
+        for r in conn.execute(
+            "SELECT user_id, anno, mese_num, source, categoria, totale, righe FROM riepilogo_mensile"
+        )
+    }
+
+    diffs = []
+    for key in sorted(set(expected) | set(actual), key=repr):
+        exp_tot, exp_n = expected.get(key, (0.0, 0))
+        act_tot, act_n = actual.get(key, (0.0, 0))
+        if abs(exp_tot - act_tot) > tolerance or exp_n != act_n:
+            diffs.append({
+                "key": dict(zip(("user_id", "anno", "mese_num", "source", "categoria"), key)),
+                "atteso": round(exp_tot, 2), "trovato": round(act_tot, 2),
+                "righe_attese": exp_n, "righe_trovate": act_n,
+            })
+    return diffs
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Verifica/ricostruisce riepilogo_mensile")
+    parser.add_argument("db", help="percorso del file ristosmart.db")
+    parser.add_argument("--rebuild", action="store_true", help="ricostruisce se trova differenze")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    try:
+        ensure_riepilogo(conn)
+        diffs = verify_riepilogo(conn)
+        for d in diffs[:50]:
+            print("[DIFF]", d)
+        print(f"Differenze trovate: {len(diffs)}")
+        if diffs and args.rebuild:
+            n = rebuild_riepilogo(conn)
+            conn.commit()
+            print(f"Riepilogo ricostruito: {n} righe. Differenze dopo: {len(verify_riepilogo(conn))}")
+        else:
+            conn.commit()
+        return 1 if diffs and not args.rebuild else 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,179 @@
+# utils/scheduler.py
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+log = logging.getLogger("ristosmart.scheduler")
+
+# Ultima esecuzione per job, condivisa da tutti i processi che usano lo stesso DB:
+# il "claim" è un UPDATE condizionato sulla run_key, quindi un solo processo la esegue.
+DDL_SCHEDULER = """
+    CREATE TABLE IF NOT EXISTS scheduler_runs (
+        job           TEXT PRIMARY KEY,
+        last_run_key  TEXT,
+        started_at    TEXT,
+        finished_at   TEXT,
+        last_status   TEXT,       -- running | ok | error
+        last_error    TEXT,
+        last_duration REAL,
+        last_result   TEXT,
+        owner         TEXT
+    )
+"""
+
+
+def ensure_scheduler(conn):
+    conn.execute(DDL_SCHEDULER)
+
+
+class Job:
+    """Job periodico. kind: 'daily' | 'at' (HH:MM ogni giorno) | 'interval' (secondi)."""
+
+    def __init__(self, name, func, kind, every=None, at=None):
+        self.name = name
+        self.func = func
+        self.kind = kind
+        self.every = every
+        self.at = at
+
+    def run_key(self, now: datetime):
+        """Chiave del 'turno' corrente; None se il job non è ancora dovuto."""
+        if self.kind == "daily":
+            return now.date().isoformat()
+        if self.kind == "at":
+            hh, mm = (int(x) for x in self.at.split(":"))
+            if (now.hour, now.minute) < (hh, mm):
+                return None
+            return now.date().isoformat()
+        if self.kind == "interval":
+            return str(int(now.timestamp() // self.every))
+        raise ValueError(f"tipo job sconosciuto: {self.kind}")
+
+
+class Scheduler(threading.Thread):
+    """Thread che ogni `tick` secondi esegue i job dovuti (uno alla volta).
+
+    connect: callable che ritorna una connessione sqlite3 (chiusa con close()).
+    """
+
+    def __init__(self, connect, tick=30.0):
+        super().__init__(name="scheduler", daemon=True)
+        self.connect = connect
+        self.tick = float(tick)
+        self.jobs = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._halt = threading.Event()
+
+    # --- registrazione ---
+    def daily(self, name, func):
+        self.jobs[name] = Job(name, func, "daily")
+        return func
+
+    def at(self, name, hhmm, func):
+        self.jobs[name] = Job(name, func, "at", at=hhmm)
+        return func
+
+    def interval(self, name, seconds, func):
+        self.jobs[name] = Job(name, func, "interval", every=float(seconds))
+        return func
+
+    # --- ciclo ---
+    def stop(self, timeout=None):
+        self._halt.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        while not self._halt.is_set():
+            try:
+                self.run_pending()
+            except Exception as e:
+                log.warning(f"[SCHEDULER WARN] {e}")
+            self._halt.wait(self.tick)
+
+    def run_pending(self, now: datetime | None = None) -> list:
+        """Esegue i job dovuti e non ancora presi da altri processi. Ritorna i nomi eseguiti."""
+        now = now or datetime.now()
+        done = []
+        for job in list(self.jobs.values()):
+            key = job.run_key(now)
+            if key is not None and self._claim(job.name, key):
+                self._execute(job)
+                done.append(job.name)
+        return done
+
+    def run_now(self, name):
+        """Esecuzione manuale (non cambia la run_key: il turno normale resta valido)."""
+        return self._execute(self.jobs[name])
+
+    def _claim(self, name, key) -> bool:
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO scheduler_runs (job) VALUES (?)", (name,))
+                cur = conn.execute("""
+                    UPDATE scheduler_runs
+                       SET last_run_key = ?, owner = ?, last_status = 'running', started_at = ?
+                     WHERE job = ? AND (last_run_key IS NULL OR last_run_key <> ?)
+                """, (key, self.owner, datetime.now().isoformat(timespec="seconds"), name, key))
+                return cur.rowcount == 1
+        finally:
+            conn.close()
+
+    def _execute(self, job):
+        t0 = time.perf_counter()
+        status, error, result = "ok", None, None
+        try:
+            result = job.func()
+        except Exception as e:
+            status, error = "error", str(e)
+            log.warning(f"[SCHEDULER] job {job.name} fallito: {e}")
+        duration = round(time.perf_counter() - t0, 3)
+        log.info(f"[SCHEDULER] {job.name} → {status} in {duration}s {result if result is not None else ''}")
+
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO scheduler_runs (job) VALUES (?)", (job.name,))
+                conn.execute("""
+                    UPDATE scheduler_runs
+                       SET finished_at = ?, last_status = ?, last_error = ?, last_duration = ?,
+                           last_result = ?, owner = ?
+                     WHERE job = ?
+                """, (datetime.now().isoformat(timespec="seconds"), status, error, duration,
+                      None if result is None else str(result)[:2000], self.owner, job.name))
+        finally:
+            conn.close()
+        return result
+
+    def status(self) -> list:
+        conn = self.connect()
+        try:
+            rows = {r[0]: r for r in conn.execute("""
+                SELECT job, last_run_key, started_at, finished_at, last_status, last_error,
+                       last_duration, last_result, owner
+                FROM scheduler_runs
+            """)}
+        finally:
+            conn.close()
+        out = []
+        for name, job in self.jobs.items():
+            r = rows.get(name)
+            out.append({
+                "job": name,
+                "kind": job.kind,
+                "every": job.every,
+                "at": job.at,
+                "last_run_key": r[1] if r else None,
+                "started_at": r[2] if r else None,
+                "finished_at": r[3] if r else None,
+                "last_status": r[4] if r else None,
+                "last_error": r[5] if r else None,
+                "last_duration": r[6] if r else None,
+                "last_result": r[7] if r else None,
+                "owner": r[8] if r else None,
+            })
+        return out
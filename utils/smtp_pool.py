@@ -0,0 +1,176 @@
+# utils/smtp_pool.py
+import smtplib
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.outbox import build_message
+
+# Errori che indicano una sessione SMTP non più usabile → riconnessione.
+# (Gli errori di risposta del server, es. destinatario rifiutato, non riaprono la sessione.)
+_SESSION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class SessionOpenError(Exception):
+    """connect() fallito (login rifiutato, TLS, host irraggiungibile): la causa è in __cause__."""
+
+
+class _Session:
+    """Una sessione SMTP autenticata con tetto di messaggi, riaperta quando serve."""
+
+    def __init__(self, connect, max_messages):
+        self.connect = connect
+        self.max_messages = max(int(max_messages or 0), 1)
+        self.smtp = None
+        self.count = 0
+        self.reconnects = 0
+
+    def _open(self):
+        self.close()
+        try:
+            self.smtp = self.connect()
+        except Exception as e:
+            raise SessionOpenError(str(e)) from e
+        self.count = 0
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+        self.smtp = None
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.smtp is None:
+            self._open()
+        elif self.count >= self.max_messages:
+            self.reconnects += 1
+            self._open()
+        try:
+            self.smtp.sendmail(from_addr, to_addrs, msg)
+        except _SESSION_ERRORS:
+            # sessione caduta: una riconnessione e un secondo tentativo
+            self.reconnects += 1
+            self._open()
+            self.smtp.sendmail(from_addr, to_addrs, msg)
+        self.count += 1
+
+
+def send_parallel(items, connect, from_addr, sessions=4, max_per_session=100, default_from_name="RistoSmart FM"):
+    """Invia items ([{"email","subject","body","from_name"?}]) su `sessions` sessioni SMTP in parallelo.
+
+    connect: callable che ritorna uno smtplib.SMTP già pronto (EHLO/STARTTLS/login fatti).
+    I destinatari sono distribuiti a round-robin tra le sessioni; ogni sessione si
+    riapre dopo max_per_session messaggi o se cade.
+    Ritorna (results, report): results nello stesso ordine degli items.
+    """
+    items = list(items or [])
+    results = [None] * len(items)
+    if not items:
+        return [], {"messages": 0, "sent": 0, "failed": 0, "sessions": 0,
+                    "reconnects": 0, "seconds": 0.0, "msgs_per_s": 0.0}
+
+    n_sessions = max(1, min(int(sessions or 1), len(items)))
+    shards = [list(range(i, len(items), n_sessions)) for i in range(n_sessions)]
+    reconnects = []
+    lock = threading.Lock()
+
+    def worker(indices):
+        sess = _Session(connect, max_per_session)
+        try:
+            for pos, idx in enumerate(indices):
+                it = items[idx]
+                to_email = (it.get("email") or "").strip()
+                if not to_email:
+                    results[idx] = {"email": "", "ok": False, "err": "no email"}
+                    continue
+                msg = build_message(to_email, it.get("subject") or "", it.get("body") or "",
+                                    it.get("from_name") or default_from_name, from_addr)
+                try:
+                    sess.sendmail(from_addr, [to_email], msg.as_string())
+                    results[idx] = {"email": to_email, "ok": True}
+                except SessionOpenError as e:
+                    # niente un login per ogni destinatario: il resto dello shard fallisce
+                    # con lo stesso errore e l'outbox lo riprova al prossimo ciclo
+                    err = f"connessione SMTP fallita: {e}"
+                    for rest in indices[pos:]:
+                        results[rest] = {"email": (items[rest].get("email") or "").strip(), "ok": False, "err": err}
+                    break
+                except Exception as e:
+                    results[idx] = {"email": to_email, "ok": False, "err": str(e)}
+                    if isinstance(e, _SESSION_ERRORS):
+                        sess.close()  # riaperta al prossimo messaggio
+        finally:
+            sess.close()
+            with lock:
+                reconnects.append(sess.reconnects)
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_sessions, thread_name_prefix="smtp") as ex:
+        list(ex.map(worker, shards))
+    elapsed = time.perf_counter() - t0
+
+    sent = sum(1 for r in results if r and r.get("ok"))
+    report = {
+        "messages": len(items),
+        "sent": sent,
+        "failed": len(items) - sent,
+        "sessions": n_sessions,
+        "reconnects": sum(reconnects),
+        "seconds": round(elapsed, 3),
+        "msgs_per_s": round(len(items) / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    return results, report
+
+
+def check_auth_failure(messages=40, sessions=4) -> int:
+    """Con login rifiutato ogni sessione tenta connect() una volta sola. Ritorna 0 se ok."""
+    calls = []
+
+    def connect():
+        calls.append(1)
+        raise smtplib.SMTPAuthenticationError(535, b"5.7.8 credenziali non valide")
+
+    items = [{"email": f"cliente{i}@example.com", "subject": "x", "body": "x"} for i in range(messages)]
+    results, report = send_parallel(items, connect, "check@localhost", sessions=sessions)
+    ok = len(calls) == sessions and report["failed"] == messages and all("535" in r["err"] for r in results)
+    print(f"login rifiutato: {len(calls)} connect per {messages} messaggi su {sessions} sessioni "
+          f"-> {'OK' if ok else 'FAIL'}")
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    """Benchmark contro un SMTP locale, es. `python -m aiosmtpd -n -l 127.0.0.1:8025`,
+    poi dalla root del progetto: `python -m utils.smtp_pool --messages 1000`.
+    `python -m utils.smtp_pool --check` verifica solo il comportamento con login rifiutato.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark invio SMTP parallelo")
+    parser.add_argument("--check", action="store_true", help="verifica connect() con login rifiutato ed esce")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--sessions", default="1,2,4,8", help="lista di valori da provare")
+    parser.add_argument("--max-per-session", type=int, default=100)
+    args = parser.parse_args(argv)
+    if args.check:
+        return check_auth_failure()
+
+    def connect():
+        smtp = smtplib.SMTP(args.host, args.port, timeout=20)
+        smtp.ehlo()
+        return smtp
+
+    items = [{"email": f"cliente{i}@example.com", "subject": f"Test {i}", "body": "Ciao, questo è un test."}
+             for i in range(args.messages)]
+    for n in [int(x) for x in args.sessions.split(",") if x.strip()]:
+        _, report = send_parallel(items, connect, "bench@localhost", sessions=n,
+                                  max_per_session=args.max_per_session)
+        print(f"sessioni={n:>2}  {report['msgs_per_s']:>8} msg/s  "
+              f"inviati={report['sent']} falliti={report['failed']} riconnessioni={report['reconnects']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+# utils/sql_trace.py
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+from logging.handlers import RotatingFileHandler
+
+# Statistiche per statement SQL (normalizzato: letterali → ?) e log delle query
+# lente con il loro EXPLAIN QUERY PLAN. I tempi arrivano da TracedCursor
+# (utils/db_pool.py): executed() dopo ogni execute, fetched() dopo ogni fetch*.
+
+_WS = re.compile(r"\s+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_PLANNABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+# "SCAN t" senza indice = lettura di tutta la tabella ("SCAN t USING INDEX" va bene)
+_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(?!CONSTANT ROW)(\w+)(?!.*\bUSING\b)")
+
+
+@lru_cache(maxsize=4096)
+def normalize_sql(sql: str) -> str:
+    """Forma canonica dello statement: spazi compattati, letterali e liste IN come '?'."""
+    s = _WS.sub(" ", sql).strip().rstrip(";").strip()
+    s = _STRING.sub("?", s)
+    s = _NUMBER.sub("?", s)
+    return _IN_LIST.sub("IN (?...)", s)
+
+
+def describe_params(params) -> str:
+    """Parametri per il log senza dati personali: numeri e NULL in chiaro, testo/blob solo lunghezza."""
+    if params is None:
+        return ""
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    out = []
+    for k, v in items:
+        if v is None or isinstance(v, (int, float)):
+            val = repr(v)
+        elif isinstance(v, str):
+            val = f"str({len(v)})"
+        elif isinstance(v, (bytes, bytearray, memoryview)):
+            val = f"bytes({len(v)})"
+        else:
+            val = type(v).__name__
+        out.append(f"{k}={val}" if isinstance(k, str) else val)
+    return "(" + ", ".join(out) + ")"
+
+
+def explain(conn, sql: str, params) -> list:
+    """Righe di EXPLAIN QUERY PLAN, indentate come l'albero del piano."""
+    # cursore base: il piano non deve ripassare dal tracer
+    cur = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+    try:
+        rows = cur.execute("EXPLAIN QUERY PLAN " + sql, params if params is not None else ()).fetchall()
+    finally:
+        cur.close()
+    depth, out = {0: -1}, []
+    for row in rows:
+        node, parent, detail = row[0], row[1], row[3]
+        depth[node] = depth.get(parent, -1) + 1
+        out.append("  " * depth[node] + detail)
+    return out
+
+
+class _Stat:
+    __slots__ = ("sql", "count", "total", "max", "rows", "full_scan", "plan", "plan_at")
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.full_scan = None
+        self.plan = None
+        self.plan_at = 0.0
+
+
+class SqlTracer:
+    """Tempi per statement normalizzato + log rotante delle query sopra slow_ms.
+
+    Il piano di una query lenta si cattura al massimo una volta ogni plan_ttl
+    secondi per statement. Oltre max_statements forme diverse, le nuove finiscono
+    sotto '<altri>' (per non crescere senza limite con SQL costruito a mano).
+    """
+
+    OTHER = "<altri>"
+
+    def __init__(self, slow_ms: float = 100, log_path=None, max_bytes: int = 1024 * 1024,
+                 backups: int = 3, plan_ttl: float = 300, max_statements: int = 500, keep_slow: int = 100):
+        self.slow = slow_ms / 1000.0
+        self.plan_ttl = plan_ttl
+        self.max_statements = max_statements
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._recent = deque(maxlen=keep_slow)
+        self.slow_count = 0
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.log = logging.getLogger("ristosmart.slow_sql")
+        self.log.propagate = False
+        if log_path and not self.log.handlers:
+            handler = RotatingFileHandler(str(log_path), maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.log.addHandler(handler)
+            self.log.setLevel(logging.INFO)
+
+    # --- chiamati da TracedCursor ---
+    def executed(self, cursor, sql: str, params, elapsed: float):
+        key = normalize_sql(sql)
+        with self._lock:
+            st = self._stats.get(key)
+            if st is None:
+                if len(self._stats) >= self.max_statements:
+                    key = self.OTHER
+                    st = self._stats.get(key)
+                if st is None:
+                    st = self._stats[key] = _Stat(key)
+            st.count += 1
+            st.total += elapsed
+            if elapsed > st.max:
+                st.max = elapsed
+            if cursor.rowcount > 0:
+                st.rows += cursor.rowcount
+        # stato per cursore: i fetch successivi si sommano allo stesso statement
+        cursor._trace = [st, sql, params, elapsed, False]
+        if elapsed >= self.slow:
+            self._slow(cursor)
+
+    def fetched(self, cursor, elapsed: float, rows: int):
+        trace = cursor._trace
+        st = trace[0]
+        trace[3] += elapsed
+        with self._lock:
+            st.total += elapsed
+            st.rows += rows
+            if trace[3] > st.max:
+                st.max = trace[3]
+        if not trace[4] and trace[3] >= self.slow:
+            self._slow(cursor)
+
+    def _slow(self, cursor):
+        st, sql, params, elapsed, _ = cursor._trace
+        cursor._trace[4] = True
+        now = time.monotonic()
+        # params None = executemany: nessun set di parametri da usare per il piano
+        if params is not None and st.sql != self.OTHER and sql.lstrip()[:7].upper().startswith(_PLANNABLE) \
+                and (st.plan is None or now - st.plan_at > self.plan_ttl):
+            try:
+                plan = explain(cursor.connection, sql, params)
+            except sqlite3.Error as e:
+                plan = [f"EXPLAIN non disponibile: {e}"]
+            scans = sorted({m.group(1) for line in plan if (m := _FULL_SCAN.match(line.strip()))})
+            with self._lock:
+                st.plan, st.plan_at, st.full_scan = plan, now, scans
+        entry = {
+            "at": datetime.now().isoformat(timespec="seconds"),
+            "ms": round(elapsed * 1000, 2),
+            "sql": st.sql,
+            "params": describe_params(params) if params is not None else "(executemany)",
+            "plan": st.plan or [],
+            "full_scan": st.full_scan or [],
+        }
+        with self._lock:
+            self.slow_count += 1
+            self._recent.append(entry)
+        self.log.info("%.1f ms | %s | %s\n    %s", entry["ms"], entry["sql"], entry["params"],
+                      "\n    ".join(entry["plan"]) or "(piano non catturato)")
+
+    # --- lettura ---
+    def top(self, n: int = 20, order: str = "total") -> list:
+        """Statement ordinati per tempo totale (default), 'count', 'max' o 'avg'."""
+        keys = {"total": lambda s: s.total, "count": lambda s: s.count,
+                "max": lambda s: s.max, "avg": lambda s: s.total / s.count if s.count else 0.0}
+        with self._lock:
+            stats = sorted(self._stats.values(), key=keys.get(order, keys["total"]), reverse=True)[:n]
+            return [{
+                "sql": s.sql,
+                "count": s.count,
+                "total_ms": round(s.total * 1000, 2),
+                "avg_ms": round(s.total * 1000 / s.count, 3) if s.count else 0.0,
+                "max_ms": round(s.max * 1000, 2),
+                "rows": s.rows,
+                "full_scan": s.full_scan,
+                "plan": s.plan,
+            } for s in stats]
+
+    def recent_slow(self) -> list:
+        with self._lock:
+            return list(reversed(self._recent))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "since": self.started_at,
+                "slow_ms": round(self.slow * 1000, 1),
+                "statements": len(self._stats),
+                "executions": sum(s.count for s in self._stats.values()),
+                "total_ms": round(sum(s.total for s in self._stats.values()) * 1000, 1),
+                "slow_count": self.slow_count,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._recent.clear()
+            self.slow_count = 0
+            self.started_at = datetime.now().isoformat(timespec="seconds")